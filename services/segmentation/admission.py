@@ -0,0 +1,201 @@
+"""
+Admission control for CPU/GPU-bound inference work.
+----------------------------------------------------
+At most `max_concurrency` jobs run at once; up to `max_queue` more wait per
+priority lane. Anything beyond that is rejected immediately with `Overloaded`
+so the endpoint can answer 503 + Retry-After instead of piling up work the
+client will have given up on.
+
+Lanes (`interactive` and `background` by default) have their own FIFO queue,
+a weight and an optional cap on running jobs. A freed slot goes to the next
+lane in smooth weighted round-robin among lanes with waiters, so a backlog of
+background work neither blocks interactive requests nor starves itself. A job
+may carry a deadline (`time.monotonic()` seconds): it fails with
+`DeadlineExceeded` as soon as the deadline passes while it waits, and is never
+started after it, so no slot is spent on a client that has given up.
+
+All bookkeeping happens on the event loop thread; the work itself runs on a
+dedicated executor (in the caller's contextvars context, like asyncio.to_thread)
+so health checks stay responsive.
+"""
+
+import asyncio
+import contextvars
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+INTERACTIVE, BACKGROUND = "interactive", "background"
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after_s: int):
+        super().__init__("inference queue is full")
+        self.retry_after_s = retry_after_s
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, lane: str):
+        super().__init__(f"deadline passed before a {lane} inference slot was free")
+        self.lane = lane
+
+
+class Schedule(NamedTuple):
+    """Where a job queues and until when (`time.monotonic()` seconds; None = no deadline) it is worth starting."""
+    lane: str = INTERACTIVE
+    deadline: Optional[float] = None
+
+    def remaining_s(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+
+class _Lane:
+    def __init__(self, name: str, weight: int, max_active: Optional[int]):
+        self.name = name
+        self.weight = max(1, int(weight))
+        self.max_active = max_active
+        self.waiters: "deque[asyncio.Future]" = deque()
+        self.active = 0
+        self.credit = 0
+        self.granted = 0
+        self.rejected = 0
+        self.expired = 0
+
+    @property
+    def startable(self) -> bool:
+        return self.max_active is None or self.active < self.max_active
+
+    def stats(self) -> dict:
+        return {
+            "weight": self.weight,
+            "maxActive": self.max_active,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+        }
+
+
+class AdmissionGate:
+    def __init__(self, executor: Executor, max_concurrency: int, max_queue: int, retry_after_s: int = 1,
+                 lanes: Optional[Dict[str, Tuple[int, Optional[int]]]] = None):
+        """`lanes` maps lane name -> (weight, max running jobs or None); default: a single interactive lane."""
+        self.executor = executor
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.retry_after_s = max(1, int(retry_after_s))
+        self.active = 0
+        self.lanes = {
+            name: _Lane(name, weight, None if max_active is None else max(1, int(max_active)))
+            for name, (weight, max_active) in (lanes or {INTERACTIVE: (1, None)}).items()
+        }
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(lane.waiters) for lane in self.lanes.values())
+
+    @property
+    def expired(self) -> int:
+        return sum(lane.expired for lane in self.lanes.values())
+
+    def _next_lane(self) -> Optional[_Lane]:
+        """Smooth weighted round-robin over lanes that have waiters and may start another job."""
+        best, total = None, 0
+        for lane in self.lanes.values():
+            if not lane.waiters or not lane.startable:
+                continue
+            lane.credit += lane.weight
+            total += lane.weight
+            if best is None or lane.credit > best.credit:
+                best = lane
+        if best is not None:
+            best.credit -= total
+        return best
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrency:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            waiter = lane.waiters.popleft()
+            self.active += 1
+            lane.active += 1
+            lane.granted += 1
+            waiter.set_result(None)
+
+    def _expire(self, lane: _Lane, waiter: "asyncio.Future") -> None:
+        if waiter.done():
+            return
+        lane.waiters.remove(waiter)
+        lane.expired += 1
+        waiter.set_exception(DeadlineExceeded(lane.name))
+
+    async def _acquire(self, schedule: Schedule) -> _Lane:
+        lane = self.lanes.get(schedule.lane)
+        if lane is None:
+            raise ValueError(f"unknown lane '{schedule.lane}'")
+        remaining = schedule.remaining_s()
+        if remaining is not None and remaining <= 0:
+            lane.expired += 1
+            raise DeadlineExceeded(lane.name)
+        if self.active < self.max_concurrency and lane.startable and not lane.waiters:
+            self.active += 1
+            lane.active += 1
+            lane.granted += 1
+            return lane
+        if len(lane.waiters) >= self.max_queue:
+            lane.rejected += 1
+            self.rejected += 1
+            raise Overloaded(self.retry_after_s)
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        lane.waiters.append(waiter)
+        timer = loop.call_later(remaining, self._expire, lane, waiter) if remaining is not None else None
+        try:
+            # `_dispatch` hands the slot over already counted in `active`.
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(lane)
+            elif waiter in lane.waiters:
+                lane.waiters.remove(waiter)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return lane
+
+    def _release(self, lane: _Lane) -> None:
+        self.active -= 1
+        lane.active -= 1
+        self._dispatch()
+
+    async def run(self, fn: Callable[..., Any], *args: Any, schedule: Schedule = Schedule()) -> Any:
+        """Run `fn(*args)` on the executor once `schedule.lane` gets a slot.
+
+        Raises `Overloaded` if the lane's queue is full and `DeadlineExceeded` if the deadline passes first.
+        """
+        lane = await self._acquire(schedule)
+        loop = asyncio.get_running_loop()
+        try:
+            cf = self.executor.submit(contextvars.copy_context().run, fn, *args)
+        except BaseException:
+            self._release(lane)
+            raise
+        # Free the slot when the work really finishes, even if the awaiting request is cancelled.
+        cf.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release, lane))
+        return await asyncio.wrap_future(cf, loop=loop)
+
+    def stats(self) -> dict:
+        return {
+            "maxConcurrency": self.max_concurrency,
+            "maxQueue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "lanes": {name: lane.stats() for name, lane in self.lanes.items()},
+        }
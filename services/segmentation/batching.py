@@ -0,0 +1,196 @@
+"""
+Dynamic micro-batching for Mask2Former forward passes.
+-------------------------------------------------------
+Requests that arrive within a short window (M2F_BATCH_WINDOW_MS) are grouped
+by their exact model input shape and run as one batched forward pass of up to
+M2F_BATCH_MAX images. Nothing is padded to a shared size: the processor maps
+photos of one aspect ratio to one shape, so only those batch together. Each caller gets back only its own post-processed
+result through a concurrent.futures.Future.
+
+The worker is a single daemon thread, so the model is never entered from two
+threads at once through this path.
+
+`GatherBatcher` batches the forward passes of one multi-image request
+(/segment-many), where the number of images is known up front: a group runs
+as soon as it is full or once every image has either been submitted or
+resolved without inference (cache hit, error). No window is waited out.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class BatchItem:
+    __slots__ = ("key", "payload", "future")
+
+    def __init__(self, key: Hashable, payload: Any):
+        self.key = key
+        self.payload = payload
+        self.future: Future = Future()
+
+
+class MicroBatcher:
+    """
+    `run_batch(payloads)` receives payloads that share one group key and must
+    return one result per payload, in order. A result that is an exception is
+    raised to that caller only.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], window_ms: float, max_batch: int):
+        self.run_batch = run_batch
+        self.window_s = max(0.0, float(window_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._queue: "queue.Queue[BatchItem]" = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.largest = 0
+
+    def submit(self, key: Hashable, payload: Any) -> Future:
+        self._ensure_worker()
+        item = BatchItem(key, payload)
+        self._queue.put(item)
+        return item.future
+
+    def _ensure_worker(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="m2f-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> List[BatchItem]:
+        first = self._queue.get()
+        pending = [first]
+        deadline = time.monotonic() + self.window_s
+        same_key = 1
+        # Close the window early once the first item's group is full.
+        while same_key < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            if item.key == first.key:
+                same_key += 1
+        return pending
+
+    def _loop(self) -> None:
+        while True:
+            pending = self._collect()
+            groups: "dict[Hashable, List[BatchItem]]" = {}
+            for item in pending:
+                groups.setdefault(item.key, []).append(item)
+            for items in groups.values():
+                for start in range(0, len(items), self.max_batch):
+                    self._run(items[start:start + self.max_batch])
+
+    def _run(self, items: List[BatchItem]) -> None:
+        live = [it for it in items if it.future.set_running_or_notify_cancel()]
+        if not live:
+            return
+        try:
+            results = self.run_batch([it.payload for it in live])
+        except BaseException as e:
+            for it in live:
+                it.future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(live)
+        self.largest = max(self.largest, len(live))
+        for it, res in zip(live, results):
+            if isinstance(res, BaseException):
+                it.future.set_exception(res)
+            else:
+                it.future.set_result(res)
+
+    def stats(self) -> dict:
+        return {
+            "windowMs": round(self.window_s * 1000.0, 3),
+            "maxBatch": self.max_batch,
+            "batches": self.batches,
+            "items": self.items,
+            "largest": self.largest,
+            "queued": self._queue.qsize(),
+        }
+
+
+class GatherBatcher:
+    """
+    `run_batch(payloads)` is awaited with payloads that share one group key and
+    must return one result per payload, in order (exceptions go to that caller
+    only, as with MicroBatcher). Each of the `expected` images passes its token
+    to `submit` or to `finish`, or both; only the first call counts. Event-loop
+    only, like SingleFlight.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], Awaitable[List[Any]]], max_batch: int, expected: int):
+        self.run_batch = run_batch
+        self.max_batch = max(1, int(max_batch))
+        self.expected = int(expected)
+        self._seen: set = set()
+        self._groups: "Dict[Hashable, list]" = {}
+        self._tasks: set = set()
+        self.batches = 0
+        self.largest = 0
+
+    def _count(self, token: Hashable) -> None:
+        if token not in self._seen:
+            self._seen.add(token)
+            self.expected -= 1
+
+    async def submit(self, token: Hashable, key: Hashable, payload: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        group = self._groups.setdefault(key, [])
+        group.append((payload, future))
+        self._count(token)
+        if len(group) >= self.max_batch:
+            self._flush(key)
+        elif self.expected <= 0:
+            self._flush_all()
+        return await future
+
+    def finish(self, token: Hashable) -> None:
+        """`token` will not (or no longer) submit; lets partial groups run once nothing else can join them."""
+        self._count(token)
+        if self.expected <= 0:
+            self._flush_all()
+
+    def _flush_all(self) -> None:
+        for key in list(self._groups):
+            self._flush(key)
+
+    def _flush(self, key: Hashable) -> None:
+        # Submitters that went away (client disconnect) are dropped before the forward pass.
+        items = [(p, f) for p, f in self._groups.pop(key) if not f.done()]
+        if items:
+            task = asyncio.ensure_future(self._run(items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, items: list) -> None:
+        try:
+            results = await self.run_batch([p for p, _ in items])
+        except BaseException as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.largest = max(self.largest, len(items))
+        for (_, future), res in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(res, BaseException):
+                future.set_exception(res)
+            else:
+                future.set_result(res)
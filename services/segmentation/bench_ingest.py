@@ -0,0 +1,69 @@
+"""
+Micro-benchmark for image ingest (run: python bench_ingest.py [photo.jpg ...]).
+
+Compares the historical full-resolution decode + LANCZOS resize with
+`ingest.Upload.decode` (JPEG draft mode) + resize, at the default 768 px
+inference long side. Without arguments synthetic 12 MP and 48 MP JPEGs are
+used. "decoded MB" is the size of the largest pixel buffer each path holds.
+"""
+
+import io
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import ingest
+from main import _scaled_size
+
+LONG_SIDE = 768
+SIZES = ((4032, 3024), (8000, 6000))
+REPEATS = 3
+
+
+def synthetic_jpeg(w: int, h: int) -> bytes:
+    rng = np.random.default_rng(0)
+    coarse = (rng.random((h // 64 + 1, w // 64 + 1, 3)) * 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(coarse).resize((w, h), Image.BILINEAR).save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def legacy(raw: bytes) -> tuple:
+    img = Image.open(io.BytesIO(raw)).convert("RGB")
+    size = _scaled_size(img.width, img.height, LONG_SIDE)
+    return img.resize(size, Image.LANCZOS), img.width * img.height * 3
+
+
+def fast(raw: bytes) -> tuple:
+    upload = ingest.open_upload(raw)
+    size = _scaled_size(upload.width, upload.height, LONG_SIDE)
+    img = upload.decode(size)
+    out = img.resize(size, Image.LANCZOS) if img.size != size else img
+    return out, img.width * img.height * 3
+
+
+def timed(fn, raw: bytes) -> tuple:
+    out = fn(raw)
+    t0 = time.perf_counter()
+    for _ in range(REPEATS):
+        out = fn(raw)
+    return (time.perf_counter() - t0) / REPEATS * 1000.0, out
+
+
+def main() -> None:
+    inputs = [(path, open(path, "rb").read()) for path in sys.argv[1:]]
+    if not inputs:
+        inputs = [(f"synthetic {w}x{h}", synthetic_jpeg(w, h)) for w, h in SIZES]
+    print(f"{'input':<24} {'variant':<8} {'ms':>8} {'decoded MB':>11} {'mean |diff|':>12}")
+    for name, raw in inputs:
+        ms_legacy, (ref, mem_legacy) = timed(legacy, raw)
+        ms_fast, (out, mem_fast) = timed(fast, raw)
+        diff = float(np.abs(np.asarray(ref, dtype=np.int16) - np.asarray(out, dtype=np.int16)).mean()) if ref.size == out.size else float("nan")
+        print(f"{name:<24} {'legacy':<8} {ms_legacy:>8.1f} {mem_legacy / 2**20:>11.1f}")
+        print(f"{'':<24} {'ingest':<8} {ms_fast:>8.1f} {mem_fast / 2**20:>11.1f} {diff:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Memory benchmark for multi-worker serving (run: python bench_workers.py [--workers 1,2,4] [photo.jpg]).
+
+For each worker count, starts the service with
+  independent  uvicorn main:app --workers N   (every worker loads its own weights)
+  prefork      python serve.py --workers N     (weights loaded once, shared copy-on-write)
+with M2F_PRELOAD=1, waits until every worker has loaded and warmed up, sends a
+few /segment requests, then sums RSS, PSS and USS (private pages) over the whole
+process tree from /proc/<pid>/smaps_rollup. PSS is the fair total: shared pages
+are split between the processes that map them. Linux only.
+"""
+
+import argparse
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+READY_TIMEOUT_S = 900
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _tree(root: int) -> list:
+    """`root` and all of its descendants."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        pids.append(pid)
+        todo.extend(children.get(pid, []))
+    return pids
+
+
+def _memory_kb(pid: int) -> dict:
+    out = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                out[parts[0][:-1]] = int(parts[1])
+    return {"rss": out.get("Rss", 0), "pss": out.get("Pss", 0),
+            "uss": out.get("Private_Clean", 0) + out.get("Private_Dirty", 0)}
+
+
+def _photo(path: str) -> bytes:
+    if path:
+        return open(path, "rb").read()
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (1600, 1200), (160, 150, 140)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def _segment(port: int, body: bytes) -> None:
+    req = urllib.request.Request(f"http://127.0.0.1:{port}/segment", data=body,
+                                 headers={"X-Model": "mask2former_ade20k", "Content-Type": "application/octet-stream"})
+    urllib.request.urlopen(req, timeout=600).read()
+
+
+def measure(mode: str, workers: int, body: bytes, requests: int) -> dict:
+    port = _free_port()
+    if mode == "prefork":
+        cmd = [sys.executable, "serve.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "main:app", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    env = {**os.environ, "M2F_PRELOAD": "1"}
+    proc = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    ready = threading.Semaphore(0)
+
+    def read_output():
+        for line in proc.stdout:
+            try:
+                if json.loads(line).get("event") == "ready":
+                    ready.release()
+            except ValueError:
+                pass
+
+    threading.Thread(target=read_output, daemon=True).start()
+    try:
+        deadline = time.time() + READY_TIMEOUT_S
+        for _ in range(workers):
+            if not ready.acquire(timeout=max(0.0, deadline - time.time())):
+                raise RuntimeError(f"{mode} x{workers}: workers did not become ready")
+        for _ in range(requests):
+            _segment(port, body)
+        total = {"rss": 0, "pss": 0, "uss": 0}
+        pids = _tree(proc.pid)
+        for pid in pids:
+            for k, v in _memory_kb(pid).items():
+                total[k] += v
+        return {"mode": mode, "workers": workers, "processes": len(pids), **{k: v / 1024 for k, v in total.items()}}
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("photo", nargs="?", default="", help="JPEG sent to /segment (default: synthetic 1600x1200)")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    parser.add_argument("--modes", default="independent,prefork")
+    parser.add_argument("--requests", type=int, default=4, help="/segment requests before measuring")
+    args = parser.parse_args()
+
+    body = _photo(args.photo)
+    print(f"{'mode':<12} {'workers':>7} {'procs':>5} {'RSS MB':>9} {'PSS MB':>9} {'USS MB':>9}")
+    for workers in (int(x) for x in args.workers.split(",")):
+        for mode in args.modes.split(","):
+            r = measure(mode, workers, body, args.requests)
+            print(f"{r['mode']:<12} {r['workers']:>7} {r['processes']:>5} {r['rss']:>9.0f} {r['pss']:>9.0f} {r['uss']:>9.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
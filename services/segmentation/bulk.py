@@ -0,0 +1,357 @@
+"""
+Offline bulk segmentation (run: python bulk.py PHOTOS_DIR_OR_MANIFEST --out DIR).
+---------------------------------------------------------------------------------
+Precomputes masks for sample rooms and regression sets without going through
+HTTP. Uses the service's pieces end to end: model loading (artifacts, engines,
+profiles), the fused preprocessor, band post-processing, label groups and the
+/segment-batch mask encodings. The work is pipelined:
+
+  decode   thread pool: header-only open, draft decode, one resize, normalise
+  forward  main thread: batches of up to --batch inputs of the exact same shape
+  write    process pool: PNG / index-map encoding and file writes
+
+Input is a directory (walked recursively for photos) or a manifest: a JSON
+list of paths or of objects with a "file" key (like ground_truth.json, whose
+other keys are copied into the index), or a text file with one path per line.
+Relative paths resolve against the manifest's directory. Entries whose output
+path would land outside --out (e.g. "../x.jpg") are recorded as failed and skipped.
+
+Outputs mirror the input layout under --out and keep the photo's extension
+(kuchnia.jpeg.wall.png), so kuchnia.jpeg and kuchnia.HEIC never share files; a
+second entry with the same output name (up to case) is recorded as failed.
+`index.json` there records, per photo, the files written, original and mask
+sizes, and the source size and mtime. A rerun skips photos whose index entry and files are present and whose
+source is unchanged, so an interrupted run resumes where it stopped. Changing
+the model or output options starts the index over. Throughput is reported in
+images/sec. A photo that fails to decode, run or write is recorded under
+"failed" in the index and the run goes on; the next run retries it.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+
+import mask_formats
+import mask_png
+from label_groups import GROUP_BITS
+
+PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff", ".heic", ".heif"}
+INDEX_FILE = "index.json"
+# Bumped when output naming changes, so an older index is not taken as covering the new files.
+INDEX_VERSION = 2
+# Output formats: one PNG per group, or the /segment-batch compact encodings of the group-index map.
+FORMATS = ("png", "index-png", "packbits", "rle")
+_SUFFIXES = {"index-png": ".png", "packbits": ".bits", "rle": ".rle"}
+# Same groups and legend order as /segment-batch.
+GROUPS = ("wall", "window", "floor", "ceiling")
+
+
+class Item:
+    def __init__(self, path: str, rel: str, meta: Optional[dict] = None):
+        self.path = path
+        self.rel = rel
+        self.meta = meta or {}
+
+    def source(self) -> dict:
+        st = os.stat(self.path)
+        return {"bytes": st.st_size, "mtimeNs": st.st_mtime_ns}
+
+
+def collect(source: str) -> List[Item]:
+    """Photos under a directory, or the entries of a manifest, in a stable order."""
+    if os.path.isdir(source):
+        items = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in PHOTO_EXTENSIONS:
+                    path = os.path.join(root, name)
+                    items.append(Item(path, os.path.relpath(path, source)))
+        return items
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, "r", encoding="utf-8") as f:
+        text = f.read()
+    if source.lower().endswith(".json"):
+        entries = [e if isinstance(e, dict) else {"file": e} for e in json.loads(text)]
+    else:
+        entries = [{"file": line.strip()} for line in text.splitlines() if line.strip() and not line.startswith("#")]
+    items = []
+    for entry in entries:
+        rel = str(entry["file"])
+        meta = {k: v for k, v in entry.items() if k != "file"}
+        items.append(Item(rel if os.path.isabs(rel) else os.path.join(base, rel), os.path.normpath(rel).lstrip(os.sep), meta))
+    return items
+
+
+def inside(out_dir: str, rel: str) -> bool:
+    """Whether `rel` joined to `out_dir` stays under it (after `..`, absolute paths and symlinks are resolved)."""
+    root = os.path.realpath(out_dir)
+    try:
+        return os.path.commonpath([root, os.path.realpath(os.path.join(root, rel))]) == root
+    except ValueError:  # different drives
+        return False
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def write_masks(out_dir: str, rel: str, fmt: str, labels: np.ndarray, png_options: tuple) -> List[str]:
+    """Encode and write one photo's masks (process pool). `labels` is the group flag map for "png", else the group-index map."""
+    if not inside(out_dir, rel):
+        raise ValueError(f"output path {rel} is outside {out_dir}")
+    # The source extension stays in the name: kuchnia.jpeg and kuchnia.HEIC must not share masks.
+    stem = rel
+    written = []
+    if fmt == "png":
+        for group in GROUPS:
+            mask = np.where(labels & GROUP_BITS[group], 255, 0).astype(np.uint8)
+            name = f"{stem}.{group}.png"
+            _write_atomic(os.path.join(out_dir, name), mask_png.encode_mask_png(mask, *png_options))
+            written.append(name)
+        return written
+    body, _, _ = mask_formats.encode(fmt, labels, GROUPS)
+    name = stem + _SUFFIXES[fmt]
+    _write_atomic(os.path.join(out_dir, name), body)
+    return [name]
+
+
+class Index:
+    """index.json under --out: run parameters plus one entry per finished (or failed) photo."""
+
+    def __init__(self, out_dir: str, params: dict):
+        self.path = os.path.join(out_dir, INDEX_FILE)
+        self.params = params
+        self.images, self.failed = {}, {}
+        self.restarted = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return
+        if previous.get("params") == params:
+            self.images = previous.get("images", {})
+        else:
+            self.restarted = bool(previous.get("images"))
+
+    def done(self, item: Item, out_dir: str) -> bool:
+        entry = self.images.get(item.rel)
+        try:
+            return (entry is not None and entry.get("source") == item.source()
+                    and all(os.path.exists(os.path.join(out_dir, name)) for name in entry["outputs"]))
+        except OSError:
+            return False
+
+    def save(self) -> None:
+        body = {"params": self.params, "groups": list(GROUPS), "legend": mask_formats.legend_header(GROUPS),
+                "images": self.images, "failed": self.failed}
+        _write_atomic(self.path, json.dumps(body, indent=1, sort_keys=True).encode("utf-8"))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Segment a directory or manifest of photos offline.")
+    parser.add_argument("source", help="Photo directory, or manifest (.json list / text file of paths)")
+    parser.add_argument("--out", required=True, help="Output directory (masks + index.json)")
+    parser.add_argument("--format", choices=FORMATS, default="png", help="png: one mask PNG per group; else one group-index file")
+    parser.add_argument("--mask-format", choices=mask_png.MODES, default="gray", help="PNG mode of per-group masks")
+    parser.add_argument("--compress", type=int, default=mask_png.DEFAULT_COMPRESS_LEVEL, help="PNG compression level")
+    parser.add_argument("--resolution", choices=("inference", "original"), default="original",
+                        help="Masks at inference size, or at the photo size (band post-processing)")
+    parser.add_argument("--long-side", type=int, default=int(os.environ.get("M2F_LONG_SIDE", "768") or 768))
+    parser.add_argument("--batch", type=int, default=4, help="Images per forward pass (same exact input shape)")
+    parser.add_argument("--decode-workers", type=int, default=4)
+    parser.add_argument("--write-workers", type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)))
+    parser.add_argument("--engine", default=None, help="torch or onnx (default: M2F_ENGINE)")
+    parser.add_argument("--ckpt", default=None, help="Checkpoint (default: MASK2FORMER_CKPT)")
+    parser.add_argument("--profile", default=None, help="Inference profile (default: M2F_PROFILE)")
+    parser.add_argument("--force", action="store_true", help="Recompute photos already in the index")
+    args = parser.parse_args()
+
+    items = collect(args.source)
+    if not items:
+        print(f"No photos in {args.source}", file=sys.stderr)
+        return 1
+
+    # The service module loads torch and the model stack; it is imported here so the
+    # spawned write workers (which import this file) stay light.
+    import torch
+
+    import ingest
+    import inference_profile
+    import main as service
+
+    engine = args.engine or service.DEFAULT_ENGINE
+    ckpt = args.ckpt or service._checkpoint()
+    loaded = service.load_mask2former_ade20k(engine, ckpt)
+    ref = (engine, ckpt)
+    profile = loaded.engine.resolve(inference_profile.parse(args.profile) if args.profile else service.DEFAULT_PROFILE)
+    png_options = (args.mask_format, min(9, max(0, args.compress)))
+
+    os.makedirs(args.out, exist_ok=True)
+    params = {"version": INDEX_VERSION, "engine": engine, "checkpoint": ckpt, "fingerprint": loaded.fingerprint, "profile": profile.name,
+              "longSide": args.long_side, "resolution": args.resolution, "format": args.format,
+              "maskFormat": args.mask_format if args.format == "png" else None}
+    index = Index(args.out, params)
+    if index.restarted:
+        print("Model or output options changed since the last run: recomputing every photo")
+    safe, names = [], {}
+    for item in items:
+        # Case-folded: on case-insensitive filesystems x.JPG and x.jpg would still write the same files.
+        first = names.setdefault(os.path.normcase(item.rel).casefold(), item)
+        if not inside(args.out, item.rel):
+            reason = f"output path is outside {args.out}"
+        elif first is not item:
+            reason = f"same output files as {first.rel}"
+        else:
+            safe.append(item)
+            continue
+        index.failed[item.rel] = reason
+        print(f"  skipped {item.rel}: {reason}", file=sys.stderr)
+    pending = [item for item in safe if args.force or not index.done(item, args.out)]
+    print(f"{len(items)} photos, {len(safe) - len(pending)} already done, {len(pending)} to segment")
+
+    def decode(item: Item):
+        """(pixel_values, infer_size, original size) of one photo (decode pool)."""
+        with open(item.path, "rb") as f:
+            upload = ingest.open_upload(f.read())
+        infer_size = service._scaled_size(upload.width, upload.height, args.long_side)
+        img = loaded.preprocess.resize(upload.decode(loaded.preprocess.output_size(*infer_size)), infer_size)
+        return loaded.preprocess.normalize(img)[0], infer_size, upload.size
+
+    totals = dict.fromkeys(("decode wait", "forward", "postprocess", "write wait"), 0.0)
+    processed, failed = 0, len(items) - len(safe)
+    t_start = time.perf_counter()
+    decode_pool = ThreadPoolExecutor(max_workers=max(1, args.decode_workers), thread_name_prefix="bulk-decode")
+    # spawn, not fork: the parent holds the model and its thread pools.
+    write_pool = ProcessPoolExecutor(max_workers=max(1, args.write_workers), mp_context=multiprocessing.get_context("spawn"))
+    # Bounded look-ahead keeps decoded inputs (and queued label maps) from piling up in memory.
+    prefetch = max(2 * args.batch, args.decode_workers)
+    decoding: deque = deque()
+    writing: deque = deque()
+    groups: dict = {}  # exact input shape -> [(item, pixel_values, infer_size, size)]
+    todo = iter(pending)
+
+    def fail(item: Item, error: Exception) -> None:
+        nonlocal failed
+        failed += 1
+        index.failed[item.rel] = str(error)
+        print(f"  failed {item.rel}: {error}", file=sys.stderr)
+
+    def collect_writes(keep: Optional[int] = None) -> None:
+        """Record finished writes, in order; with `keep`, wait until at most `keep` are outstanding."""
+        nonlocal processed
+        while writing and (writing[0][1].done() or (keep is not None and len(writing) > keep)):
+            item, future, entry = writing.popleft()
+            t0 = time.perf_counter()
+            try:
+                entry["outputs"] = future.result()
+            except Exception as e:
+                fail(item, e)
+                continue
+            finally:
+                totals["write wait"] += time.perf_counter() - t0
+            index.images[item.rel] = entry
+            index.failed.pop(item.rel, None)
+            processed += 1
+            if processed % 25 == 0:
+                index.save()
+                elapsed = time.perf_counter() - t_start
+                print(f"  {processed}/{len(pending)}  {processed / elapsed:.2f} images/s")
+
+    def run_batch(batch: list) -> None:
+        t0 = time.perf_counter()
+        try:
+            pixel_values = torch.cat([b[1] for b in batch])
+            pixel_mask = torch.ones((len(batch),) + tuple(pixel_values.shape[-2:]), dtype=torch.int64)
+            class_logits, mask_logits = service._forward(pixel_values, pixel_mask, profile, ref)
+        except Exception as e:
+            totals["forward"] += time.perf_counter() - t0
+            if len(batch) == 1:
+                fail(batch[0][0], e)
+            else:
+                # Run the photos one by one so only the one that breaks the forward pass is recorded as failed.
+                for one in batch:
+                    run_batch([one])
+            return
+        t1 = time.perf_counter()
+        totals["forward"] += t1 - t0
+        for i, (item, _, infer_size, size) in enumerate(batch):
+            target = size if args.resolution == "original" else infer_size
+            try:
+                seg = service._postprocess(class_logits[i:i + 1], mask_logits[i:i + 1], target, ref)
+                labels = loaded.class_groups.flag_map(seg) if args.format == "png" else loaded.class_groups.index_map(seg, GROUPS)
+                entry = {"source": item.source(), "width": size[0], "height": size[1],
+                         "maskWidth": int(seg.shape[1]), "maskHeight": int(seg.shape[0])}
+            except Exception as e:
+                fail(item, e)
+                continue
+            if item.meta:
+                entry["manifest"] = item.meta
+            writing.append((item, write_pool.submit(write_masks, args.out, item.rel, args.format, labels, png_options), entry))
+        totals["postprocess"] += time.perf_counter() - t1
+        # Keep at most a couple of batches of label maps waiting for the writers.
+        collect_writes(keep=2 * args.batch)
+
+    try:
+        while True:
+            while len(decoding) < prefetch:
+                item = next(todo, None)
+                if item is None:
+                    break
+                decoding.append((item, decode_pool.submit(decode, item)))
+            if not decoding:
+                break
+            item, future = decoding.popleft()
+            t0 = time.perf_counter()
+            try:
+                pixel_values, infer_size, size = future.result()
+            except Exception as e:
+                fail(item, e)
+                continue
+            finally:
+                totals["decode wait"] += time.perf_counter() - t0
+            shape = tuple(pixel_values.shape[-2:])
+            group = groups.setdefault(shape, [])
+            group.append((item, pixel_values, infer_size, size))
+            if len(group) >= args.batch:
+                run_batch(groups.pop(shape))
+        for shape in list(groups):
+            run_batch(groups.pop(shape))
+    finally:
+        # Interrupted or not, what was written so far is recorded and picked up by the next run.
+        collect_writes(keep=0)
+        index.save()
+        decode_pool.shutdown(cancel_futures=True)
+        write_pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - t_start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Segmented {processed} photos in {elapsed:.1f} s: {rate:.2f} images/s ({failed} failed, "
+          f"{len(safe) - len(pending)} skipped)")
+    print("  main thread: " + ", ".join(f"{name} {seconds:.1f} s" for name, seconds in totals.items()))
+    print(f"  index: {index.path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
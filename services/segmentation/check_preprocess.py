@@ -0,0 +1,80 @@
+"""
+Parity check of the fused preprocessing against AutoImageProcessor (run: python check_preprocess.py photo1.jpg ...).
+
+For every photo and long side:
+  parity    fused vs processor on the same inference-size image (both resize
+            once with the processor's filter): shapes and pixel_mask must match
+            and pixel_values must agree within --atol.
+  pipeline  the service's fused path (decoded photo -> one resize) vs the
+            processor path (LANCZOS to the inference size, then the processor),
+            with the time each takes. Informational: the fused path skips one
+            resampling step, so values differ slightly.
+Exits non-zero when a parity check fails.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+from transformers import AutoImageProcessor
+
+import ingest
+import preprocess
+from main import _checkpoint, _scaled_size
+
+
+def timed(fn) -> tuple:
+    fn()
+    t0 = time.perf_counter()
+    out = fn()
+    return out, (time.perf_counter() - t0) * 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="+", help="Photos to preprocess")
+    parser.add_argument("--ckpt", default=_checkpoint())
+    parser.add_argument("--long-sides", default="768,512", help="Comma-separated inference long sides")
+    parser.add_argument("--atol", type=float, default=1e-4, help="Largest acceptable |pixel_values| difference")
+    args = parser.parse_args()
+
+    processor = AutoImageProcessor.from_pretrained(args.ckpt)
+    fused = preprocess.FusedPreprocessor(processor)
+    failed = False
+    for path in args.images:
+        raw = open(path, "rb").read()
+        for long_side in (int(x) for x in args.long_sides.split(",")):
+            upload = ingest.open_upload(raw)
+            infer_size = _scaled_size(upload.width, upload.height, long_side)
+            full = ingest.open_upload(raw).decode()
+            infer_img = full if full.size == infer_size else full.resize(infer_size, Image.LANCZOS)
+
+            ref = processor(images=infer_img, return_tensors="pt")
+            pv, pm = fused(infer_img, infer_size)
+            same_shape = tuple(pv.shape) == tuple(ref["pixel_values"].shape) and bool((pm == ref["pixel_mask"]).all())
+            diff = float((pv - ref["pixel_values"]).abs().max()) if same_shape else float("inf")
+            ok = same_shape and diff <= args.atol
+            failed |= not ok
+
+            def legacy():
+                img = ingest.open_upload(raw).decode()
+                if img.size != infer_size:
+                    img = img.resize(infer_size, Image.LANCZOS)
+                return processor(images=img, return_tensors="pt")["pixel_values"]
+
+            def service():
+                u = ingest.open_upload(raw)
+                return fused(u.decode(fused.output_size(*infer_size)), infer_size)[0]
+
+            legacy_pv, legacy_ms = timed(legacy)
+            fused_pv, fused_ms = timed(service)
+            delta = float(np.abs((fused_pv - legacy_pv).numpy()).mean()) if fused_pv.shape == legacy_pv.shape else float("nan")
+            print(f"{path} @{long_side} -> {tuple(pv.shape[-2:])}: parity max|diff|={diff:.2e} {'ok' if ok else 'FAIL'}  "
+                  f"pipeline processor {legacy_ms:.0f} ms, fused {fused_ms:.0f} ms, mean|diff|={delta:.4f}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Mask-agreement check for engines and inference profiles (run: python check_profiles.py photo1.jpg photo2.jpg ...).
+
+Segments every photo with the torch fp32 baseline and with each variant, and
+compares the wall and window masks by IoU (plus the share of identical labels).
+A variant is `[engine:]profile`, e.g. `int8`, `onnx:fp32` or `onnx:int8`.
+Exits non-zero when any variant falls below --min-iou on any photo, so it can
+gate an M2F_PROFILE / M2F_ENGINE change. Also prints the forward-pass time of each.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import inference_profile
+import main as service
+
+GROUPS = ("wall", "window")
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.count_nonzero(a | b)
+    # Both empty: the variants agree perfectly.
+    return 1.0 if union == 0 else np.count_nonzero(a & b) / union
+
+
+def segment(img: Image.Image, long_side: int, profile, engine: str) -> tuple:
+    size = service._scaled_size(img.width, img.height, long_side)
+    t0 = time.time()
+    seg = service._infer_label_map(img, size, size, profile, (engine, service._checkpoint()))
+    return seg, time.time() - t0
+
+
+def variants(specs: str) -> list:
+    """(engine, resolved profile) pairs, loading each engine once."""
+    out = []
+    for spec in specs.split(","):
+        engine, _, profile_spec = spec.strip().rpartition(":")
+        engine = engine or "torch"
+        if (engine, service._checkpoint()) not in service.loaded_models:
+            service.load_mask2former_ade20k(engine)
+        requested = inference_profile.parse(profile_spec)
+        profile = service.loaded_models[(engine, service._checkpoint())].engine.resolve(requested)
+        if profile != requested:
+            print(f"{spec}: runs as '{engine}:{profile.name}'")
+        if (engine, profile) != ("torch", inference_profile.BASELINE) and (engine, profile) not in out:
+            out.append((engine, profile))
+    return out
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="+", help="Photos to segment")
+    parser.add_argument("--variants", default="int8,bf16,channels-last,int8+channels-last",
+                        help="Comma-separated [engine:]profile variants to compare with torch fp32")
+    parser.add_argument("--min-iou", type=float, default=0.95, help="Lowest acceptable wall/window IoU")
+    parser.add_argument("--long-side", type=int, default=service._env_long_side())
+    args = parser.parse_args()
+
+    service.load_mask2former_ade20k("torch")
+    baseline = inference_profile.BASELINE
+    to_compare = variants(args.variants)
+    groups = service.class_groups
+
+    failed = False
+    for path in args.images:
+        # Upright pixels, like the service; the EXIF orientation tag is dropped so it is not applied twice.
+        img = ImageOps.exif_transpose(Image.open(path).convert("RGB"))
+        segment(img, args.long_side, baseline, "torch")  # first call pays one-time setup
+        ref, ref_s = segment(img, args.long_side, baseline, "torch")
+        ref_masks = groups.masks(ref, GROUPS)
+        print(f"{path} {img.width}x{img.height}: torch:fp32 {ref_s * 1000:.0f} ms")
+        for engine, profile in to_compare:
+            segment(img, args.long_side, profile, engine)
+            seg, s = segment(img, args.long_side, profile, engine)
+            masks = groups.masks(seg, GROUPS)
+            scores = {g: iou(ref_masks[g] > 0, masks[g] > 0) for g in GROUPS}
+            ok = all(v >= args.min_iou for v in scores.values())
+            failed |= not ok
+            detail = " ".join(f"{g}_iou={v:.4f}" for g, v in scores.items())
+            same = float(np.mean(seg == ref))
+            print(f"  {engine + ':' + profile.name:<28} {s * 1000:>7.0f} ms  {detail}  labels_equal={same:.4f}  {'ok' if ok else 'FAIL'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
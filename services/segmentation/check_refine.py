@@ -0,0 +1,74 @@
+"""
+Parity check of the boundary-band post-processing against the processor (run: python check_refine.py photo1.jpg ...).
+
+For every photo, runs the model once at the inference size (--long-side), then
+builds the label map at the inference size and at the photo size two ways:
+  processor  post_process_semantic_segmentation (all class scores interpolated)
+  band       refine.band_label_map (class scores interpolated at boundaries only)
+and reports differing pixels, the share of pixels in the boundary band and the
+time each takes. The processor path can run out of memory on large photos;
+that is reported instead of a parity result.
+Exits non-zero when more than --tolerance of the pixels differ.
+"""
+
+import argparse
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+import engines
+import ingest
+import inference_profile
+import preprocess
+import refine
+from main import _checkpoint, _scaled_size
+
+
+def timed(fn) -> tuple:
+    t0 = time.perf_counter()
+    out = fn()
+    return out, (time.perf_counter() - t0) * 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="+", help="Photos to segment")
+    parser.add_argument("--ckpt", default=_checkpoint())
+    parser.add_argument("--long-side", type=int, default=768, help="Inference long side")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="Largest acceptable share of differing pixels (float ties)")
+    args = parser.parse_args()
+
+    processor, engine = engines.load("torch", args.ckpt, "cpu")
+    fused = preprocess.FusedPreprocessor(processor)
+    failed = False
+    for path in args.images:
+        upload = ingest.open_upload(open(path, "rb").read())
+        infer_size = _scaled_size(upload.width, upload.height, args.long_side)
+        pixel_values, pixel_mask = fused(upload.decode(fused.output_size(*infer_size)), infer_size)
+        with torch.inference_mode():
+            class_logits, mask_logits = engine.forward(pixel_values, pixel_mask, inference_profile.BASELINE)
+            outputs = SimpleNamespace(class_queries_logits=class_logits, masks_queries_logits=mask_logits)
+            mixed = refine.mixed_cells(refine.class_scores(class_logits, mask_logits).argmax(0).numpy())
+            for label, (w, h) in (("inference", infer_size), ("original", upload.size)):
+                band, band_ms = timed(lambda: refine.band_label_map(refine.class_scores(class_logits, mask_logits), (w, h), np.int64))
+                y0, _, _ = refine._axis(h, mixed.shape[0])
+                x0, _, _ = refine._axis(w, mixed.shape[1])
+                share = float(mixed[y0[:, None], x0[None, :]].mean())
+                try:
+                    ref, ref_ms = timed(lambda: processor.post_process_semantic_segmentation(outputs, target_sizes=[(h, w)])[0].numpy())
+                except RuntimeError as e:
+                    print(f"{path} {label} {w}x{h}: band {share:.1%} of pixels, {band_ms:.0f} ms; processor failed ({str(e).splitlines()[0][:80]})")
+                    continue
+                diff = float(np.mean(ref != band))
+                ok = diff <= args.tolerance
+                failed |= not ok
+                print(f"{path} {label} {w}x{h}: differing pixels {diff:.2e} {'ok' if ok else 'FAIL'}  "
+                      f"band {share:.1%} of pixels; processor {ref_ms:.0f} ms, band {band_ms:.0f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
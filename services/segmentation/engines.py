@@ -0,0 +1,87 @@
+"""
+Inference engines behind /segment and /segment-batch.
+-----------------------------------------------------
+An engine turns preprocessed `pixel_values` into Mask2Former query logits;
+preprocessing and post-processing (the label map) are shared, so every engine
+produces the same `seg`.
+
+  torch  Transformers PyTorch model (local artifact if exported), any profile
+  onnx   ONNX Runtime CPU sessions exported by `python onnx_engine.py export`
+
+Engines expose:
+  name                        engine id used in X-Model / M2F_ENGINE
+  id2label                    class names of the loaded checkpoint
+  resolve(profile)            the subset of `profile` this engine can run
+  forward(pv, pm, profile)    fp32 (class_queries_logits, masks_queries_logits); raises
+                              UnsupportedInputSize if it has no graph for the input size
+  device_string()             where the forward pass runs
+  stats()                     engine details for GET /device
+"""
+
+import inference_profile
+import model_artifact
+
+ENGINES = ("torch", "onnx")
+
+
+class UnsupportedInputSize(ValueError):
+    """The engine has no graph that fits a (padded) model input of `size`; `supported` lists the (w, h) it has."""
+
+    def __init__(self, engine: str, size: tuple, supported: list):
+        w, h = size
+        super().__init__(
+            f"No exported {engine} input shape fits {w}x{h} (exported: {', '.join(f'{sw}x{sh}' for sw, sh in supported)})"
+        )
+        self.engine = engine
+        self.size = size
+        self.supported = supported
+
+
+class TorchEngine:
+    name = "torch"
+
+    def __init__(self, model, device: str):
+        self.model = model
+        self.device = device
+        self.id2label = model.config.id2label
+        self.variants = inference_profile.ProfiledModels()
+
+    def resolve(self, profile):
+        return inference_profile.resolve(profile, self.device)
+
+    def forward(self, pixel_values, pixel_mask, profile):
+        return self.variants.forward(self.model, profile, self.device, pixel_values.to(self.device), pixel_mask.to(self.device))
+
+    def device_string(self) -> str:
+        try:
+            return str(next(self.model.parameters()).device)
+        except Exception:
+            return "unknown"
+
+    def stats(self) -> dict:
+        return {"engine": self.name, "device": self.device_string(), "profilesBuilt": self.variants.built()}
+
+
+def load_torch(ckpt: str, device: str):
+    """(processor, TorchEngine) from a local artifact when one exists, else from Transformers."""
+    from transformers import AutoImageProcessor, Mask2FormerForUniversalSegmentation
+
+    # A local artifact (python model_artifact.py export) loads with memory-mapped, zero-copy weights.
+    artifact = model_artifact.find_artifact(ckpt)
+    if artifact is not None:
+        processor, model = model_artifact.load_artifact(artifact, device)
+    else:
+        processor = AutoImageProcessor.from_pretrained(ckpt)
+        model = Mask2FormerForUniversalSegmentation.from_pretrained(ckpt).to(device).eval()
+    return processor, TorchEngine(model, device)
+
+
+def load(name: str, ckpt: str, device: str):
+    """(processor, engine) for engine `name`."""
+    if name == "torch":
+        return load_torch(ckpt, device)
+    if name == "onnx":
+        # onnxruntime is only imported when the ONNX engine is actually used.
+        import onnx_engine
+        return onnx_engine.load_onnx(ckpt)
+    raise ValueError(f"Unknown engine '{name}' (supported: {', '.join(ENGINES)})")
@@ -0,0 +1,148 @@
+"""
+Selectable inference profiles.
+-------------------------------
+A profile is a "+"-joined set of options applied on top of the stock fp32
+eager model (e.g. `int8+channels-last`); `fp32` is the baseline.
+
+  int8           dynamic int8 quantization of every nn.Linear (CPU only)
+  bf16           bfloat16 autocast (CPU with AVX512-BF16/AMX, or CUDA)
+  channels-last  channels-last memory format for weights and inputs
+  compile        torch.compile (falls back to eager if compilation fails)
+
+`int8` and `bf16` are exclusive: dynamically quantized linears take fp32 input.
+Options the device cannot run are dropped by `resolve`, so the reported name
+is always the profile that actually ran.
+
+Variants other than the baseline hold their own copy of the weights; they are
+built on first use and dropped on model reload.
+"""
+
+import copy
+import logging
+import os
+import threading
+from typing import Dict, NamedTuple, Optional
+
+import torch
+
+import telemetry
+
+OPTIONS = ("int8", "bf16", "channels-last", "compile")
+
+
+class Profile(NamedTuple):
+    int8: bool = False
+    bf16: bool = False
+    channels_last: bool = False
+    compile: bool = False
+
+    @property
+    def name(self) -> str:
+        return "+".join(opt for opt, on in zip(OPTIONS, self) if on) or "fp32"
+
+
+BASELINE = Profile()
+
+
+def parse(spec: Optional[str]) -> Profile:
+    """Profile from a spec such as `int8+channels-last`. Raises ValueError for unknown options."""
+    parts = {p.strip().lower() for p in (spec or "").replace(",", "+").split("+") if p.strip()}
+    parts.discard("fp32")
+    unknown = parts - set(OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown profile option(s) {', '.join(sorted(unknown))} (supported: fp32, {', '.join(OPTIONS)})")
+    if {"int8", "bf16"} <= parts:
+        raise ValueError("Profile options 'int8' and 'bf16' cannot be combined")
+    return Profile(*(opt in parts for opt in OPTIONS))
+
+
+def bf16_supported(device: str) -> bool:
+    try:
+        if device == "cuda":
+            return bool(torch.cuda.is_bf16_supported())
+        if device == "cpu":
+            return bool(torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        pass
+    return False
+
+
+def resolve(profile: Profile, device: str) -> Profile:
+    """Drop the options `device` cannot run."""
+    return profile._replace(
+        int8=profile.int8 and device == "cpu",
+        bf16=profile.bf16 and bf16_supported(device),
+    )
+
+
+def configure_threads() -> dict:
+    """Apply M2F_INTRA_THREADS / M2F_INTER_THREADS (process-wide; call before the first forward pass)."""
+    intra = int(os.environ.get("M2F_INTRA_THREADS", "0") or 0)
+    inter = int(os.environ.get("M2F_INTER_THREADS", "0") or 0)
+    if intra > 0:
+        torch.set_num_threads(intra)
+    if inter > 0:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError as e:  # only allowed before any inter-op work has started
+            telemetry.log_event("inter_threads_ignored", level=logging.WARNING, error=str(e))
+    return {"intra": torch.get_num_threads(), "inter": torch.get_num_interop_threads()}
+
+
+class _Variant:
+    def __init__(self, module: torch.nn.Module, profile: Profile, device: str):
+        self.module = module
+        self.profile = profile
+        self.device = device
+        self.compiled = torch.compile(module) if profile.compile else None
+
+    def __call__(self, pixel_values: torch.Tensor, pixel_mask: torch.Tensor):
+        if self.profile.channels_last:
+            pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+        autocast_device = "cuda" if self.device == "cuda" else "cpu"
+        with torch.inference_mode(), torch.autocast(autocast_device, dtype=torch.bfloat16, enabled=self.profile.bf16):
+            if self.compiled is not None:
+                try:
+                    return self.compiled(pixel_values=pixel_values, pixel_mask=pixel_mask)
+                except Exception as e:
+                    telemetry.log_event("compile_failed", level=logging.WARNING, profile=self.profile.name, error=str(e))
+                    self.compiled = None
+            return self.module(pixel_values=pixel_values, pixel_mask=pixel_mask)
+
+
+class ProfiledModels:
+    """Per-profile variants of one base model."""
+
+    def __init__(self):
+        self._variants: Dict[Profile, _Variant] = {}
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._variants.clear()
+
+    def built(self) -> list:
+        return sorted(p.name for p in self._variants)
+
+    def _build(self, base: torch.nn.Module, profile: Profile, device: str) -> _Variant:
+        module = base
+        if profile.int8 or profile.channels_last:
+            module = copy.deepcopy(base)
+        if profile.int8:
+            module = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        if profile.channels_last:
+            module = module.to(memory_format=torch.channels_last)
+        return _Variant(module.eval(), profile, device)
+
+    def variant(self, base: torch.nn.Module, profile: Profile, device: str) -> _Variant:
+        with self._lock:
+            v = self._variants.get(profile)
+            if v is None:
+                v = self._build(base, profile, device)
+                self._variants[profile] = v
+            return v
+
+    def forward(self, base: torch.nn.Module, profile: Profile, device: str, pixel_values: torch.Tensor, pixel_mask: torch.Tensor):
+        """(class_queries_logits, masks_queries_logits) as fp32, whatever the profile computed in."""
+        outputs = self.variant(base, profile, device)(pixel_values, pixel_mask)
+        return outputs.class_queries_logits.float(), outputs.masks_queries_logits.float()
@@ -0,0 +1,109 @@
+"""
+Image ingest: header-first size guards and reduced-scale, EXIF-aware decode.
+----------------------------------------------------------------------------
+`open_upload` only parses the image header, so oversized uploads are refused
+before any pixel is decoded. `Upload.decode(size)` then decodes straight to
+roughly the inference size: JPEGs use draft mode (libjpeg DCT scaling by 1/2,
+1/4 or 1/8, never below the requested size), so a 48 MP photo headed for a
+768 px forward pass decodes at ~1/4-1/8 of the pixels. The EXIF orientation is
+applied in the same step.
+
+`Upload.size` is the displayed (EXIF-oriented) size of the original photo;
+masks and X-Original-Size refer to it regardless of how it was decoded.
+"""
+
+import io
+import os
+from typing import Optional, Tuple
+
+from PIL import Image
+
+try:
+    # Optional: HEIC/HEIF uploads (iPhone originals) when pillow-heif is installed.
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+# Pixel and byte limits shared by every endpoint that accepts an image.
+MAX_PIXELS = int(os.environ.get("M2F_MAX_PIXELS", "50000000"))  # ~7000x7000
+MAX_BYTES = int(float(os.environ.get("M2F_MAX_UPLOAD_MB", "50")) * 1024 * 1024)
+# M2F_JPEG_DRAFT=0 always decodes JPEGs at full resolution (before the LANCZOS resize).
+JPEG_DRAFT = (os.environ.get("M2F_JPEG_DRAFT") or "1").strip().lower() in {"1", "true", "yes", "on"}
+EXIF_ORIENTATION = 0x0112
+
+# EXIF orientation -> transpose that displays the stored pixels upright (as ImageOps.exif_transpose).
+_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# Orientations whose displayed width is the stored height.
+_SWAPS_AXES = {5, 6, 7, 8}
+
+
+def orientation_transpose(orientation: int) -> Optional[Image.Transpose]:
+    """Transpose that displays pixels stored with EXIF `orientation` upright, or None."""
+    return _TRANSPOSE.get(orientation)
+
+
+class TooLarge(ValueError):
+    """Upload exceeds MAX_BYTES or MAX_PIXELS (413)."""
+
+
+def _orientation(image: Image.Image) -> int:
+    try:
+        return int(image.getexif().get(EXIF_ORIENTATION, 1))
+    except Exception:
+        return 1
+
+
+class Upload:
+    """An uploaded photo opened header-only."""
+
+    def __init__(self, image: Image.Image):
+        self.image = image
+        self.format = image.format
+        self.orientation = _orientation(image)
+        w, h = image.size
+        self.stored_size = (w, h)
+        self.size = (h, w) if self.orientation in _SWAPS_AXES else (w, h)
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def decode(self, min_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+        """Upright RGB pixels, at least `min_size` (w, h, displayed orientation) where reduced decoding applies."""
+        image = self.image
+        if JPEG_DRAFT and min_size is not None and self.format == "JPEG" and tuple(min_size) != self.size:
+            w, h = int(min_size[0]), int(min_size[1])
+            # draft() works in stored orientation and is a no-op once the pixels are loaded.
+            image.draft("RGB", (h, w) if self.orientation in _SWAPS_AXES else (w, h))
+        image = image.convert("RGB")
+        transpose = _TRANSPOSE.get(self.orientation)
+        return image.transpose(transpose) if transpose is not None else image
+
+
+def open_upload(raw: bytes) -> Upload:
+    """Header-only open with the shared size guards. Raises TooLarge, or ValueError if unreadable."""
+    if len(raw) > MAX_BYTES:
+        raise TooLarge(f"Image too large: {len(raw) / (1024 * 1024):.1f}MB (max {MAX_BYTES / (1024 * 1024):.0f}MB)")
+    try:
+        image = Image.open(io.BytesIO(raw))
+    except Image.DecompressionBombError as e:
+        raise TooLarge(str(e))
+    except Exception as e:
+        raise ValueError(str(e))
+    w, h = image.size
+    if w * h > MAX_PIXELS:
+        raise TooLarge(f"Image dimensions too large: {w}x{h} pixels (max {MAX_PIXELS})")
+    return Upload(image)
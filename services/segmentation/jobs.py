@@ -0,0 +1,148 @@
+"""
+In-memory store for asynchronous segmentation jobs.
+---------------------------------------------------
+`POST /jobs` registers a job and returns its id right away; the work runs as
+an event-loop task and its result (the label map plus what is needed to
+encode it) stays here until it is fetched, deleted, or expires.
+
+Bounds: at most `max_jobs` jobs in any state, and at most `max_bytes` of
+results. Finished jobs expire `ttl_s` after they finish; when a bound is hit
+the oldest finished jobs go first. Unfinished jobs are never evicted, so a
+store full of them rejects new work (JobStoreFull). Event-loop only, like
+SingleFlight.
+"""
+
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import telemetry
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobStoreFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, params: Any):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = QUEUED
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        # Stage timings of the job itself (the POST request has its own Server-Timing).
+        self.timer = telemetry.StageTimer()
+        self.result: Any = None
+        self.result_bytes = 0
+        self.error: Optional[tuple] = None  # (HTTP status, detail)
+        self.task = None
+
+    def start(self) -> None:
+        self.status = RUNNING
+        self.started = time.time()
+
+    def finish(self, status: str, result: Any = None, result_bytes: int = 0, error: Optional[tuple] = None) -> None:
+        self.status = status
+        self.finished = time.time()
+        self.result, self.result_bytes, self.error = result, int(result_bytes), error
+
+    def info(self) -> Dict[str, Any]:
+        end = self.finished or time.time()
+        info = {
+            "id": self.id,
+            "status": self.status,
+            "createdAt": round(self.created, 3),
+            "queuedMs": int(((self.started or end) - self.created) * 1000),
+            "runMs": int((end - self.started) * 1000) if self.started else 0,
+            "stages": self.timer.ms(),
+        }
+        if self.error is not None:
+            info["error"] = {"status": self.error[0], "detail": self.error[1]}
+        return info
+
+
+class JobStore:
+    def __init__(self, max_jobs: int, max_bytes: int, ttl_s: float):
+        self.max_jobs = max(1, int(max_jobs))
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_s = float(ttl_s)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._bytes = 0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    @property
+    def unfinished(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.status not in FINISHED)
+
+    def create(self, params: Any) -> Job:
+        self._expire()
+        if len(self._jobs) >= self.max_jobs and not self._evict_finished(lambda: len(self._jobs) >= self.max_jobs):
+            self.rejected += 1
+            raise JobStoreFull(f"{self.max_jobs} jobs are already queued or running")
+        job = Job(params)
+        self._jobs[job.id] = job
+        self.created += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._expire()
+        return self._jobs.get(job_id)
+
+    def remove(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self._bytes -= job.result_bytes
+        return job
+
+    def finished(self, job: Job) -> None:
+        """Account for a job's result once it has finished; may evict older finished jobs to stay under max_bytes."""
+        if self._jobs.get(job.id) is not job:
+            return  # deleted while running
+        # Finished jobs move to the end, so eviction and expiry order is by finish time.
+        self._jobs.move_to_end(job.id)
+        self._bytes += job.result_bytes
+        self._evict_finished(lambda: self._bytes > self.max_bytes, keep=job.id)
+        if self._bytes > self.max_bytes:
+            # The result alone exceeds the budget: keep the job, drop its result.
+            self._bytes -= job.result_bytes
+            job.finish(FAILED, error=(507, f"Result of {job.result_bytes} bytes exceeds the job store budget ({self.max_bytes} bytes)"))
+
+    def _evict_finished(self, over, keep: Optional[str] = None) -> bool:
+        """Drop the oldest finished jobs while `over()`; returns whether `over()` is now false."""
+        for job_id in [i for i, j in self._jobs.items() if j.status in FINISHED and i != keep]:
+            if not over():
+                break
+            self.remove(job_id)
+            self.evicted += 1
+        return not over()
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.ttl_s
+        for job_id in [i for i, j in self._jobs.items() if j.finished is not None and j.finished < cutoff]:
+            self.remove(job_id)
+            self.expired += 1
+
+    def stats(self) -> dict:
+        return {
+            "jobs": len(self._jobs),
+            "unfinished": self.unfinished,
+            "bytes": self._bytes,
+            "maxJobs": self.max_jobs,
+            "maxBytes": self.max_bytes,
+            "ttlS": self.ttl_s,
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "rejected": self.rejected,
+        }
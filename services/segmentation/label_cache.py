@@ -0,0 +1,81 @@
+"""
+In-process LRU cache for post-processed Mask2Former label maps.
+----------------------------------------------------------------
+The web tier asks for wall, window and attached masks of the same photo in
+three separate /segment calls. Caching the `seg` label map (one class id per
+pixel) means only the first call pays for inference; the rest only extract a
+mask and encode a PNG.
+
+Entries are keyed by a digest of the raw upload plus every parameter that
+changes the label map (checkpoint, long side, output size), and evicted in
+LRU order once the byte budget is exceeded.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import numpy as np
+
+
+def image_digest(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+
+class LabelMapCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            seg = self._entries.get(key)
+            if seg is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return seg
+
+    def put(self, key: Hashable, seg: np.ndarray) -> None:
+        size = int(seg.nbytes)
+        if not self.enabled or size > self.max_bytes:
+            return
+        # Cached arrays are shared between requests; make accidental in-place edits fail loudly.
+        seg.setflags(write=False)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= int(old.nbytes)
+            self._entries[key] = seg
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= int(evicted.nbytes)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,156 @@
+"""
+ADE20K class groups and their precompiled lookup tables.
+---------------------------------------------------------
+Each model class id maps to a bit-flag byte (one bit per group: wall, window,
+attached, floor, ceiling). Extracting masks is then a table lookup over the
+label map instead of one `seg == idx` scan per matching class id.
+
+`ClassGroupLUT` is compiled once per model load; custom `X-Labels` sets are
+compiled on first use and kept in a small LRU.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Sequence
+
+import numpy as np
+
+WALLISH = {"wall"}
+WINDOWISH = {"window", "windowpane", "glass", "sliding door", "french door", "patio door", "balcony door", "balcony window", "door"}
+ATTACHED = {
+    "curtain", "curtains", "drape", "drapery", "blinds", "shade", "roller blind", "venetian blind", "rod", "hanger",
+    "sconce", "lamp", "socket", "switch", "outlet", "radiator", "heater", "vent", "air conditioner",
+    "mirror", "painting", "paintings", "picture", "pictures", "poster", "posters", "frame", "frames", "clock", "tv",
+    "shelf", "shelves", "bookcase", "bookcases", "bookshelf", "bookshelves",
+    "plant", "plants", "potted plant"
+}
+FLOORISH = {
+    "floor", "floor-wood", "floor-marble", "floor-tile", "floor-stone", "floor-mat", "floor-other",
+    "rug", "carpet", "mat", "carpet tile", "floor mat"
+}
+CEILINGISH = {
+    "ceiling", "ceiling-white", "roof", "ceiling-other"
+}
+
+# Order defines the bit of each group in the flag map (wall = bit 0, ...).
+GROUPS = (
+    ("wall", WALLISH),
+    ("window", WINDOWISH),
+    ("attached", ATTACHED),
+    ("floor", FLOORISH),
+    ("ceiling", CEILINGISH),
+)
+GROUP_BITS = {name: 1 << i for i, (name, _) in enumerate(GROUPS)}
+
+_CUSTOM_LUTS_MAX = 64
+
+
+def _pair_lut(lut: np.ndarray) -> np.ndarray:
+    """uint16 -> uint16 table applying a 256-entry uint8 LUT to both bytes of a pixel pair."""
+    v = np.arange(65536, dtype=np.uint32)
+    lo = lut[v & 0xFF].astype(np.uint16)
+    hi = lut[v >> 8].astype(np.uint16)
+    if np.little_endian:
+        return lo | (hi << 8)
+    return hi | (lo << 8)
+
+
+class ClassGroupLUT:
+    def __init__(self, id2label: dict):
+        self.id2label = id2label
+        ids = [int(k) for k in id2label]
+        # Sized to cover every value the label map dtype can hold, so indexing never goes out of range.
+        size = max(256, (max(ids) + 1) if ids else 0)
+        self.label2ids: Dict[str, list] = {}
+        for k, v in id2label.items():
+            self.label2ids.setdefault(str(v).lower(), []).append(int(k))
+        self.flags = np.zeros(size, dtype=np.uint8)
+        for name, members in GROUPS:
+            for idx in self._ids_for(members):
+                self.flags[idx] |= GROUP_BITS[name]
+        self._size = size
+        self._tables: Dict[int, tuple] = {}
+        self._index_tables: Dict[tuple, tuple] = {}
+        self._custom: "OrderedDict[frozenset, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flags_table = self._compile(self.flags)
+
+    def _ids_for(self, names: Iterable[str]) -> list:
+        out = []
+        for name in {str(n).lower() for n in names}:
+            out.extend(self.label2ids.get(name, ()))
+        return out
+
+    def _compile(self, lut: np.ndarray) -> tuple:
+        # numpy casts uint8 indices to intp before gathering; looking up two pixels per
+        # uint16 index halves the work for the common uint8 label map.
+        return lut, (_pair_lut(lut[:256]) if self._size == 256 else None)
+
+    @staticmethod
+    def _apply(table: tuple, seg: np.ndarray) -> np.ndarray:
+        lut, pair = table
+        if pair is not None and seg.dtype == np.uint8 and seg.flags.c_contiguous and seg.size % 2 == 0:
+            return pair[seg.reshape(-1).view(np.uint16)].view(np.uint8).reshape(seg.shape)
+        return lut[seg]
+
+    def _group_table(self, bits: int) -> tuple:
+        """Per-class 0/255 table for the union of the groups in `bits`."""
+        table = self._tables.get(bits)
+        if table is None:
+            table = self._compile(np.where(self.flags & bits, 255, 0).astype(np.uint8))
+            self._tables[bits] = table
+        return table
+
+    def flag_map(self, seg: np.ndarray) -> np.ndarray:
+        """Bit-flag map with every group membership, in one pass over `seg`."""
+        return self._apply(self._flags_table, seg)
+
+    def group_mask(self, seg: np.ndarray, *groups: str) -> np.ndarray:
+        """0/255 mask of the union of `groups`, in one pass over `seg`."""
+        bits = 0
+        for g in groups:
+            bits |= GROUP_BITS[g]
+        return self._apply(self._group_table(bits), seg)
+
+    def masks(self, seg: np.ndarray, groups: Sequence[str]) -> Dict[str, np.ndarray]:
+        """0/255 masks for several groups: one lookup pass over `seg`, then two shifts per group."""
+        fm = self.flag_map(seg)
+        out = {}
+        for g in groups:
+            k = GROUP_BITS[g].bit_length() - 1
+            # Move bit k to the sign bit, then sign-extend: 0 -> 0x00, 1 -> 0xFF.
+            m = np.left_shift(fm, 7 - k)
+            sm = m.view(np.int8)
+            np.right_shift(sm, 7, out=sm)
+            out[g] = m
+        return out
+
+    def index_map(self, seg: np.ndarray, groups: Sequence[str]) -> np.ndarray:
+        """uint8 map of 1-based positions in `groups` (0 = no group), in one pass over `seg`."""
+        key = tuple(groups)
+        table = self._index_tables.get(key)
+        if table is None:
+            lut = np.zeros(self._size, dtype=np.uint8)
+            # Earlier groups win where a class belongs to several of them.
+            for i in range(len(key) - 1, -1, -1):
+                lut[(self.flags & GROUP_BITS[key[i]]) != 0] = i + 1
+            table = self._compile(lut)
+            self._index_tables[key] = table
+        return self._apply(table, seg)
+
+    def label_mask(self, seg: np.ndarray, labels: Iterable[str]) -> np.ndarray:
+        """0/255 mask for an arbitrary label-name set (e.g. from X-Labels)."""
+        key = frozenset(str(x).strip().lower() for x in labels if str(x).strip())
+        with self._lock:
+            table = self._custom.get(key)
+            if table is not None:
+                self._custom.move_to_end(key)
+        if table is None:
+            lut = np.zeros(self._size, dtype=np.uint8)
+            lut[self._ids_for(key)] = 255
+            table = self._compile(lut)
+            with self._lock:
+                self._custom[key] = table
+                while len(self._custom) > _CUSTOM_LUTS_MAX:
+                    self._custom.popitem(last=False)
+        return self._apply(table, seg)
@@ -0,0 +1,201 @@
+"""
+Persistent on-disk store for post-processed label maps.
+-------------------------------------------------------
+A second tier behind LabelMapCache that survives restarts and is shared by
+every worker pointing at the same directory (M2F_STORE_DIR). Each entry is a
+`.npy` file (uint8 for ADE20K) served with `np.load(mmap_mode="r")`, so a hit
+costs a file open and page-cache reads, never a decode or a forward pass. A
+JSON sidecar next to it records the parameters it was computed with.
+
+Files are named by the SHA-256 of the cache key and fanned out over 256
+subdirectories. Writes go to a temporary file in the same directory and are
+renamed into place, so readers (and concurrent writers of the same key, which
+produce the same content) only ever see complete files. Reads refresh the
+file's mtime; once the directory (label maps and sidecars) exceeds `max_bytes`,
+the least recently used entries are deleted down to 90% of it, so one directory
+scan makes room for many writes. Processes that still map a deleted file keep
+reading it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Hashable, Optional
+
+import numpy as np
+
+import telemetry
+
+# Temporary files older than this are leftovers of a crashed writer.
+_STALE_TMP_S = 3600
+# Eviction frees space down to this fraction of max_bytes.
+_LOW_WATER = 0.9
+
+
+def _key_id(key: Hashable) -> str:
+    return hashlib.sha256(json.dumps(key, default=str).encode("utf-8")).hexdigest()
+
+
+class LabelMapStore:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+        if self.enabled:
+            os.makedirs(self.root, exist_ok=True)
+            self._bytes = self._scan()[0]
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root) and self.max_bytes > 0
+
+    def _path(self, key: Hashable) -> str:
+        key_id = _key_id(key)
+        return os.path.join(self.root, key_id[:2], key_id + ".npy")
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        path = self._path(key)
+        try:
+            seg = np.load(path, mmap_mode="r", allow_pickle=False)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            # Truncated or foreign file: drop it and recompute.
+            telemetry.log_event("label_store_corrupt", level=logging.WARNING, path=path, error=str(e))
+            self._remove(path)
+            with self._lock:
+                self.misses += 1
+                self.errors += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return seg
+
+    def put(self, key: Hashable, seg: np.ndarray) -> None:
+        """Write `seg` atomically; errors are logged, never raised (the store is an optimisation)."""
+        if not self.enabled or seg.nbytes > self.max_bytes:
+            return
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            sidecar = {"key": key, "shape": list(seg.shape), "dtype": str(seg.dtype), "created": round(time.time(), 3)}
+            self._write_atomic(path[:-len(".npy")] + ".json", lambda f: f.write(json.dumps(sidecar, default=str).encode("utf-8")))
+            self._write_atomic(path, lambda f: np.save(f, np.ascontiguousarray(seg), allow_pickle=False))
+            size = os.path.getsize(path) + os.path.getsize(path[:-len(".npy")] + ".json")
+        except OSError as e:
+            with self._lock:
+                self.errors += 1
+            telemetry.log_event("label_store_write_failed", level=logging.WARNING, path=path, error=str(e))
+            return
+        with self._lock:
+            self.writes += 1
+            self._bytes += size
+            over = self._bytes > self.max_bytes
+        if over:
+            self._evict()
+
+    @staticmethod
+    def _write_atomic(path: str, write) -> None:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _scan(self) -> tuple:
+        """(total bytes, [(mtime, size, path)]) of the entries, sidecars included; removes stale temporary files."""
+        npy, sidecars = {}, {}
+        now = time.time()
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                stem, ext = os.path.splitext(entry.path)
+                if ext == ".npy":
+                    npy[stem] = (st.st_mtime, st.st_size)
+                elif ext == ".json":
+                    sidecars[stem] = (st.st_mtime, st.st_size)
+                elif ext == ".tmp" and now - st.st_mtime > _STALE_TMP_S:
+                    self._remove(entry.path)
+        entries = [(mtime, size + sidecars.pop(stem, (0, 0))[1], stem + ".npy") for stem, (mtime, size) in npy.items()]
+        # A sidecar without its label map (a writer died in between) is evicted like an entry.
+        entries += [(mtime, size, stem + ".json") for stem, (mtime, size) in sidecars.items()]
+        return sum(size for _, size, _ in entries), entries
+
+    def _evict(self) -> None:
+        if not self._evicting.acquire(blocking=False):
+            return  # another thread of this process is already evicting
+        try:
+            self._evict_lru()
+        finally:
+            self._evicting.release()
+
+    def _evict_lru(self) -> None:
+        # Other workers write to the same directory: re-measure it instead of trusting the local total.
+        total, entries = self._scan()
+        evicted = 0
+        low_water = int(self.max_bytes * _LOW_WATER)
+        for _, size, path in sorted(entries):
+            if total <= low_water:
+                break
+            if self._remove(path):
+                total -= size
+                evicted += 1
+        with self._lock:
+            self._bytes = total
+            self.evictions += evicted
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.unlink(path)
+        except OSError:
+            return False
+        if path.endswith(".npy"):
+            try:
+                os.unlink(path[:-len(".npy")] + ".json")
+            except OSError:
+                pass
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "dir": self.root or None,
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "errors": self.errors,
+            }
@@ -6,29 +6,114 @@ Fast, reliable Mask2Former segmentation for curtain visualization.
 Endpoints:
   POST /segment       - Single mask (wall+window+attached union)  
   POST /segment-batch - All masks in one inference (4x faster)
+  POST /segment-many  - Several photos per call (multipart in, multipart/mixed streamed out)
+  POST /jobs          - /segment-batch as an asynchronous job (202 + id)
+  GET  /jobs/{id}     - Job status, then its masks; DELETE /jobs/{id} cancels
   GET  /              - Health check
+  GET  /ready         - Readiness (503 until the model is loaded and warm when M2F_PRELOAD=1)
   GET  /device        - Device info
+  GET  /metrics       - Prometheus metrics (stage timings, queue, cache, memory)
 
 IMPORTANT: Experimental /measure endpoint moved to experimental/local-cv branch
            to preserve core segmentation performance (40s→4s restoration).
 """
 
-import io
+import asyncio
+import json
+import logging
+import math
 import os
 import time
-from typing import List
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Dict, List, NamedTuple, Optional
 
 import numpy as np
 from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from PIL import Image
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
 import base64
 
-# Lazy globals
+from admission import BACKGROUND, INTERACTIVE, AdmissionGate, DeadlineExceeded, Overloaded, Schedule
+from batching import GatherBatcher, MicroBatcher
+from label_cache import LabelMapCache, image_digest
+from label_store import LabelMapStore
+from single_flight import SingleFlight
+import engines
+import ingest
+import jobs
+import inference_profile
+import mask_formats
+import mask_png
+import model_artifact
+import perceptual
+import preprocess
+import quality
+import refine
+import telemetry
+import tiled
+from label_groups import ATTACHED, CEILINGISH, FLOORISH, WALLISH, WINDOWISH, ClassGroupLUT  # noqa: F401
+
+# Lazy globals (processor/model/class_groups track the default checkpoint)
 processor = None
-model = None
+model = None  # Transformers model of the torch engine, when loaded
 loaded_key = None
+class_groups = None  # ClassGroupLUT compiled from the checkpoint's id2label at load time
+
+
+class LoadedModel(NamedTuple):
+    processor: object
+    engine: object  # see engines.py
+    class_groups: ClassGroupLUT
+    preprocess: preprocess.FusedPreprocessor
+    fingerprint: str  # changes when a local checkpoint's files change (part of the label-map keys)
+
+
+# (engine name, checkpoint) -> LoadedModel; several checkpoints can serve side by side.
+loaded_models = {}
+# (engine name, checkpoint) -> seconds the last load took (exported on /metrics).
+model_load_seconds = {}
+
+
+def _env_flag(name: str, default: str = "0") -> bool:
+    return (os.environ.get(name) or default).strip().lower() in {"1", "true", "yes", "on"}
+
+
+# With M2F_PRELOAD the model is loaded and warmed in the background at startup and
+# /ready answers 503 until that finishes; otherwise the replica is ready immediately
+# and the model loads lazily on the first request.
+PRELOAD = _env_flag("M2F_PRELOAD")
+ready_state = {"ready": not PRELOAD, "error": None, "loadMs": None, "warmupMs": None}
+
 
-app = FastAPI(title="Segmentation Service (Mask2Former)", version="0.3.0")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    task = asyncio.create_task(_preload()) if PRELOAD else None
+    yield
+    if task is not None and not task.done():
+        task.cancel()
+
+
+app = FastAPI(title="Segmentation Service (Mask2Former)", version="0.3.0", lifespan=lifespan)
+# Server-Timing header, per-stage histograms and request metrics for every request (see telemetry.py).
+app.add_middleware(telemetry.TelemetryMiddleware)
+
+# Post-processed label maps keyed by image digest + inference params. 0 disables.
+label_cache = LabelMapCache(int(float(os.environ.get("M2F_CACHE_MB", "256")) * 1024 * 1024))
+# Optional second tier on disk (.npy, mmap), shared by workers and kept across restarts. Unset M2F_STORE_DIR disables.
+label_store = LabelMapStore(os.environ.get("M2F_STORE_DIR", ""), int(float(os.environ.get("M2F_STORE_MB", "2048")) * 1024 * 1024))
+# Re-exports of a recent photo (other format, size or compression) reuse its label map (see perceptual.py).
+# Off by default (-1 bits): a shifted shot of the same wall can match too, so deployments or requests opt in.
+near_dups = perceptual.NearDupIndex(
+    int(os.environ.get("M2F_NEAR_DUP_ENTRIES", "2048")),
+    int(os.environ.get("M2F_NEAR_DUP_BITS", "-1")),
+    float(os.environ.get("M2F_NEAR_DUP_ASPECT", "0.01")),
+)
 
 # Device selection: CUDA → MPS → CPU
 import torch
@@ -42,22 +127,27 @@ try:
 except Exception:
     DEVICE = "cpu"
 
+# Process-wide torch thread pools (M2F_INTRA_THREADS / M2F_INTER_THREADS); 0 keeps torch defaults.
+thread_config = inference_profile.configure_threads()
+# Default inference profile (M2F_PROFILE, e.g. `int8+channels-last`); X-Profile overrides per request.
+DEFAULT_PROFILE = inference_profile.parse(os.environ.get("M2F_PROFILE", "fp32"))
 
-WALLISH = {"wall"}
-WINDOWISH = {"window", "windowpane", "glass", "sliding door", "french door", "patio door", "balcony door", "balcony window", "door"}
-ATTACHED = {
-    "curtain", "curtains", "drape", "drapery", "blinds", "shade", "roller blind", "venetian blind", "rod", "hanger",
-    "sconce", "lamp", "socket", "switch", "outlet", "radiator", "heater", "vent", "air conditioner",
-    "mirror", "painting", "paintings", "picture", "pictures", "poster", "posters", "frame", "frames", "clock", "tv",
-    "shelf", "shelves", "bookcase", "bookcases", "bookshelf", "bookshelves",
-    "plant", "plants", "potted plant"
-}
-FLOORISH = {
-    "floor", "floor-wood", "floor-marble", "floor-tile", "floor-stone", "floor-mat", "floor-other",
-    "rug", "carpet", "mat", "carpet tile", "floor mat"
-}
-CEILINGISH = {
-    "ceiling", "ceiling-white", "roof", "ceiling-other"
+# X-Model values and the engine each one runs on; plain `mask2former_ade20k` follows M2F_ENGINE.
+DEFAULT_ENGINE = os.environ.get("M2F_ENGINE", "torch").strip().lower()
+if DEFAULT_ENGINE not in engines.ENGINES:
+    raise ValueError(f"Unknown M2F_ENGINE '{DEFAULT_ENGINE}' (supported: {', '.join(engines.ENGINES)})")
+# `fused` (default): one resize + vectorized normalization (preprocess.py); `processor`: AutoImageProcessor.
+FUSED_PREPROCESS = (os.environ.get("M2F_PREPROCESS") or "fused").strip().lower() != "processor"
+# `band` (default): class scores are interpolated only near class boundaries (refine.py); `processor`: post_process_semantic_segmentation.
+BAND_POSTPROCESS = (os.environ.get("M2F_POSTPROCESS") or "band").strip().lower() != "processor"
+# X-Resolution: tiled (see tiled.py). Tile side 0 = the model's native input size; tiles per forward pass.
+TILE_SIZE = int(os.environ.get("M2F_TILE_SIZE", "0") or 0)
+TILE_OVERLAP = int(os.environ.get("M2F_TILE_OVERLAP", "128") or 0)
+TILE_BATCH = max(1, int(os.environ.get("M2F_TILE_BATCH", "4") or 1))
+MODEL_KEYS = {
+    "mask2former_ade20k": DEFAULT_ENGINE,
+    "mask2former_ade20k_torch": "torch",
+    "mask2former_ade20k_onnx": "onnx",
 }
 
 
@@ -75,305 +165,1200 @@ def _device_string() -> str:
 
 
 def mask_from_labels(seg: np.ndarray, id2label: dict, keep: List[str]) -> np.ndarray:
-    keep_set = {str(k).lower() for k in keep}
-    h, w = seg.shape
-    out = np.zeros((h, w), dtype=np.uint8)
-    label2ids = {}
-    for k, v in id2label.items():
-        name = str(v).lower()
-        label2ids.setdefault(name, []).append(int(k))
-    keep_ids = set()
-    for name in keep_set:
-        if name in label2ids:
-            keep_ids.update(label2ids[name])
-    for idx in keep_ids:
-        out[seg == idx] = 255
-    return out
+    lut = class_groups if class_groups is not None and class_groups.id2label is id2label else ClassGroupLUT(id2label)
+    return lut.label_mask(seg, keep)
 
 
 def rgba_png_from_binary_mask(mask: np.ndarray) -> bytes:
-    if mask.dtype != np.uint8:
-        mask = mask.astype(np.uint8)
-    h, w = mask.shape
-    rgba = np.ones((h, w, 4), dtype=np.uint8) * 255
-    rgba[..., 3] = np.where(mask > 0, 0, 255).astype(np.uint8)
-    img = Image.fromarray(rgba, mode="RGBA")
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    return buf.getvalue()
-
-
-def load_mask2former_ade20k():
-    global processor, model
-    from transformers import AutoImageProcessor, Mask2FormerForUniversalSegmentation
-    ckpt = os.environ.get("MASK2FORMER_CKPT", "facebook/mask2former-swin-large-ade-semantic")
-    processor = AutoImageProcessor.from_pretrained(ckpt)
-    model = Mask2FormerForUniversalSegmentation.from_pretrained(ckpt).to(DEVICE).eval()
+    return mask_png.encode_mask_png(mask, "rgba")
+
+
+def _png_options(request: Request) -> tuple:
+    """(mode, compress_level) from X-Mask-Format / X-PNG-Compress; defaults keep the RGBA contract."""
+    mode = (request.headers.get("X-Mask-Format") or "rgba").strip().lower()
+    if mode not in mask_png.MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown X-Mask-Format '{mode}' (supported: {', '.join(mask_png.MODES)})")
     try:
-        _ = next(model.parameters()).device
-        print(f"[load] Mask2Former loaded to {_device_string()}")
-    except Exception:
-        print(f"[load] Mask2Former loaded to {_device_string()}")
+        level = int(request.headers.get("X-PNG-Compress") or mask_png.DEFAULT_COMPRESS_LEVEL)
+    except ValueError:
+        level = mask_png.DEFAULT_COMPRESS_LEVEL
+    return mode, min(9, max(0, level))
+
+
+def _checkpoint() -> str:
+    return os.environ.get("MASK2FORMER_CKPT", "facebook/mask2former-swin-large-ade-semantic")
+
+
+def _default_ref() -> tuple:
+    return DEFAULT_ENGINE, _checkpoint()
+
+
+def _weights_dir(engine_name: str, ckpt: str) -> Optional[str]:
+    """Directory the engine loads `ckpt` from: ONNX export, local artifact, local checkpoint or hub cache snapshot."""
+    if engine_name == "onnx":
+        import onnx_engine
+        return onnx_engine.find_onnx(ckpt)
+    path = model_artifact.find_artifact(ckpt) or (ckpt if os.path.isdir(ckpt) else None)
+    if path is not None:
+        return path
+    try:
+        from huggingface_hub import try_to_load_from_cache
+    except ImportError:
+        return None
+    # .../snapshots/<commit>/config.json of the revision from_pretrained resolved.
+    found = try_to_load_from_cache(ckpt, "config.json")
+    return os.path.dirname(found) if isinstance(found, str) else None
+
+
+def _checkpoint_fingerprint(path: Optional[str], ckpt: str) -> str:
+    """Path, names, sizes and mtimes of the files in `path` (the weights directory), so new weights never hit old label maps."""
+    if path is None:
+        return ckpt
+    # Hub snapshot entries are symlinks into the blob store: stat() follows them to the weight files.
+    entries = sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in os.scandir(path) if e.is_file())
+    return image_digest(json.dumps([os.path.realpath(path), entries]).encode("utf-8"))[:16]
+
+
+def load_mask2former_ade20k(engine_name: str = DEFAULT_ENGINE, ckpt: Optional[str] = None) -> LoadedModel:
+    global processor, model, class_groups
+    ckpt = ckpt or _checkpoint()
+    reload = (engine_name, ckpt) in loaded_models
+    t0 = time.perf_counter()
+    proc, engine = engines.load(engine_name, ckpt, DEVICE)
+    model_load_seconds[(engine_name, ckpt)] = time.perf_counter() - t0
+    weights = _weights_dir(engine_name, ckpt)
+    loaded = LoadedModel(proc, engine, ClassGroupLUT(engine.id2label), preprocess.FusedPreprocessor(proc), _checkpoint_fingerprint(weights, ckpt))
+    loaded_models[(engine_name, ckpt)] = loaded
+    if ckpt == _checkpoint():
+        processor, class_groups = proc, loaded.class_groups
+        if engine_name == "torch":
+            model = engine.model
+    if reload:
+        # Weights may have changed on disk; never serve label maps from the previous load.
+        label_cache.clear()
+    telemetry.log_event("model_loaded", checkpoint=ckpt, engine=engine_name, device=engine.device_string(), source=weights,
+                        load_ms=round(model_load_seconds[(engine_name, ckpt)] * 1000, 1))
+    return loaded
+
+
+def _scaled_size(width: int, height: int, long_side: int) -> tuple:
+    """(w, h) used for inference after the optional long-side pre-scale (never upscales)."""
+    if long_side <= 0:
+        return width, height
+    target = max(64, long_side)
+    if max(width, height) <= target:
+        return width, height
+    if width >= height:
+        return target, max(1, round(height * target / width))
+    return max(1, round(width * target / height)), target
+
+
+def _fitting_long_side(ref: tuple, width: int, height: int, long_side: int, supported: list) -> Optional[int]:
+    """Largest long-side pre-scale (at most `long_side`) whose model input fits one of the `supported` (w, h), else None."""
+    output_size = loaded_models[ref].preprocess.output_size
+    top = max(width, height) if long_side <= 0 else min(max(64, long_side), max(width, height))
+    for side in range(top, 63, -1):
+        out_w, out_h = output_size(*_scaled_size(width, height, side))
+        if any(out_w <= w and out_h <= h for w, h in supported):
+            return side
+    return None
+
+
+def _unsupported_size_detail(e: "engines.UnsupportedInputSize", img: ingest.Upload, long_side: int, ref: tuple,
+                             tiled_mode: bool) -> str:
+    """422 detail for an input size the engine has no graph for, naming a long side that would fit if one does."""
+    w, h = e.size
+    if tiled_mode:
+        return f"{e}; tiled inference needs a graph for the tile size: re-export with --shapes {w}x{h}"
+    side = _fitting_long_side(ref, img.width, img.height, long_side, e.supported)
+    if side is None:
+        return f"{e}; no M2F_LONG_SIDE fits this aspect ratio: re-export with --shapes {w}x{h}"
+    return f"{e}; M2F_LONG_SIDE (or X-Scale-Long-Side) {side} fits, or re-export with --shapes {w}x{h}"
+
+
+def _label_dtype(n_labels: int):
+    # ADE20K has 150 classes: uint8 is 8x smaller than the int64 post-processing output.
+    return np.uint8 if n_labels <= 256 else np.uint16
+
+
+def _compact_labels(seg: np.ndarray, n_labels: int) -> np.ndarray:
+    return seg.astype(_label_dtype(n_labels), copy=False)
+
+
+def _forward(pixel_values: "torch.Tensor", pixel_mask: "torch.Tensor", profile=inference_profile.BASELINE, ref: Optional[tuple] = None):
+    """One forward pass of the (engine, checkpoint) `ref` under `profile`; returns fp32 (class_queries_logits, masks_queries_logits)."""
+    loaded = loaded_models[ref or _default_ref()]
+    return loaded.engine.forward(pixel_values, pixel_mask, profile)
+
+
+def _postprocess(class_logits: "torch.Tensor", mask_logits: "torch.Tensor", target_size: tuple, ref: Optional[tuple] = None) -> np.ndarray:
+    """Semantic label map at `target_size` (w, h) for a single image's query logits."""
+    loaded = loaded_models[ref or _default_ref()]
+    if BAND_POSTPROCESS:
+        with torch.inference_mode():
+            scores = refine.class_scores(class_logits, mask_logits)
+            return refine.band_label_map(scores, target_size, _label_dtype(len(loaded.class_groups.id2label)))
+    outputs = SimpleNamespace(class_queries_logits=class_logits, masks_queries_logits=mask_logits)
+    with torch.inference_mode():
+        seg_list = loaded.processor.post_process_semantic_segmentation(
+            outputs, target_sizes=[(int(target_size[1]), int(target_size[0]))]
+        )
+    return _compact_labels(seg_list[0].cpu().numpy(), len(loaded.class_groups.id2label))
+
+
+def _run_batch(payloads: list) -> list:
+    """MicroBatcher callback: one batched forward pass, then per-caller post-processing."""
+    pixel_values = torch.cat([p[0] for p in payloads])
+    pixel_mask = torch.cat([p[1] for p in payloads])
+    # The batch key includes model and profile, so every payload in a batch shares them.
+    ref = payloads[0][4]
+    class_logits, mask_logits = _forward(pixel_values, pixel_mask, payloads[0][3], ref)
+    results = []
+    for i, (_, _, target_size, _, _) in enumerate(payloads):
+        try:
+            results.append(_postprocess(class_logits[i:i + 1], mask_logits[i:i + 1], target_size, ref))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+# Micro-batching is opt-in: with a 0 ms window every request runs its own forward pass.
+_batch_window_ms = float(os.environ.get("M2F_BATCH_WINDOW_MS", "0"))
+batcher = (
+    MicroBatcher(_run_batch, _batch_window_ms, int(os.environ.get("M2F_BATCH_MAX", "8")))
+    if _batch_window_ms > 0 else None
+)
+
+# Decode + preprocess + forward run on a dedicated pool behind an admission gate so the
+# event loop (health checks, cache hits) never blocks on the model. With batching on,
+# enough slots are needed for a full batch to be in flight at once.
+_infer_concurrency = int(os.environ.get("M2F_INFER_CONCURRENCY", str(batcher.max_batch if batcher else 1)))
+infer_gate = AdmissionGate(
+    ThreadPoolExecutor(max_workers=max(1, _infer_concurrency), thread_name_prefix="m2f-infer"),
+    max_concurrency=_infer_concurrency,
+    max_queue=int(os.environ.get("M2F_QUEUE_MAX", "16")),
+    retry_after_s=int(os.environ.get("M2F_RETRY_AFTER_S", "1")),
+    # X-Priority lanes: weighted share of freed slots, and a cap so background work always leaves a slot free.
+    lanes={
+        INTERACTIVE: (int(os.environ.get("M2F_INTERACTIVE_WEIGHT", "4")), None),
+        BACKGROUND: (int(os.environ.get("M2F_BACKGROUND_WEIGHT", "1")),
+                     int(os.environ.get("M2F_BACKGROUND_MAX_ACTIVE", str(max(1, _infer_concurrency - 1))))),
+    },
+)
+# Cheap CPU work (hashing, mask extraction, PNG/base64 encoding) is never shed.
+cpu_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("M2F_CPU_WORKERS", "4")), thread_name_prefix="m2f-cpu")
+# One lock per (engine, checkpoint): loading one checkpoint never blocks requests for another.
+_model_locks: Dict[tuple, asyncio.Lock] = {}
+
+# X-Latency-Budget-MS picks a (checkpoint, long side) rung from online latency measurements (see quality.py).
+latency = quality.LatencyTracker()
+quality_controller = quality.QualityController(
+    quality.parse_ladder(os.environ.get("M2F_QUALITY_LADDER"), _checkpoint(), int(os.environ.get("M2F_LONG_SIDE", "768") or 768)),
+    latency,
+)
+_background_loads = set()
+# Label maps being computed right now, keyed like label_cache (see single_flight.py).
+inflight = SingleFlight()
+# POST /jobs: results wait in a bounded in-memory store until fetched, deleted or expired (see jobs.py).
+job_store = jobs.JobStore(
+    int(os.environ.get("M2F_JOBS_MAX", "64")),
+    int(float(os.environ.get("M2F_JOBS_MB", "512")) * 1024 * 1024),
+    float(os.environ.get("M2F_JOBS_TTL_S", "600")),
+)
+# Jobs running at once; the rest stay `queued` in the store instead of filling the inference queue.
+_job_slots = asyncio.Semaphore(max(1, int(os.environ.get("M2F_JOBS_CONCURRENCY", str(infer_gate.max_concurrency)))))
+
+# Scrape-time values for /metrics; request and stage histograms are recorded by the middleware.
+telemetry.REGISTRY.gauge_fn("m2f_inference_queue_depth", "Inference jobs waiting for a slot", lambda: infer_gate.queued)
+telemetry.REGISTRY.gauge_fn("m2f_inference_active", "Inference jobs running", lambda: infer_gate.active)
+telemetry.REGISTRY.counter_fn("m2f_inference_rejected_total", "Requests shed with 503 because the queue was full", lambda: infer_gate.rejected)
+telemetry.REGISTRY.gauge_fn("m2f_lane_queue_depth", "Inference jobs waiting for a slot, per priority lane",
+                            lambda: {(name, ): len(lane.waiters) for name, lane in infer_gate.lanes.items()}, ("lane",))
+telemetry.REGISTRY.gauge_fn("m2f_lane_active", "Inference jobs running, per priority lane",
+                            lambda: {(name, ): lane.active for name, lane in infer_gate.lanes.items()}, ("lane",))
+telemetry.REGISTRY.counter_fn("m2f_lane_rejected_total", "Requests shed with 503, per priority lane",
+                              lambda: {(name, ): lane.rejected for name, lane in infer_gate.lanes.items()}, ("lane",))
+telemetry.REGISTRY.counter_fn("m2f_lane_deadline_dropped_total", "Requests dropped with 504 because their deadline passed before inference",
+                              lambda: {(name, ): lane.expired for name, lane in infer_gate.lanes.items()}, ("lane",))
+telemetry.REGISTRY.gauge_fn("m2f_model_load_seconds", "Duration of the last load of each model",
+                            lambda: dict(model_load_seconds), ("engine", "checkpoint"))
+telemetry.REGISTRY.counter_fn("m2f_label_cache_hits_total", "Label-map cache hits", lambda: label_cache.stats()["hits"])
+telemetry.REGISTRY.counter_fn("m2f_label_cache_misses_total", "Label-map cache misses", lambda: label_cache.stats()["misses"])
+telemetry.REGISTRY.counter_fn("m2f_label_cache_evictions_total", "Label-map cache evictions", lambda: label_cache.stats()["evictions"])
+telemetry.REGISTRY.counter_fn("m2f_coalesced_total", "Requests served from an identical in-flight inference", lambda: inflight.shared)
+telemetry.REGISTRY.gauge_fn("m2f_inflight_label_maps", "Distinct label maps being computed", lambda: inflight.inflight)
+telemetry.REGISTRY.counter_fn("m2f_label_store_hits_total", "Label maps served from the on-disk store", lambda: label_store.stats()["hits"])
+telemetry.REGISTRY.counter_fn("m2f_label_store_writes_total", "Label maps written to the on-disk store", lambda: label_store.stats()["writes"])
+telemetry.REGISTRY.counter_fn("m2f_label_store_evictions_total", "On-disk label maps evicted", lambda: label_store.stats()["evictions"])
+telemetry.REGISTRY.gauge_fn("m2f_label_store_bytes", "Bytes in the on-disk label-map store", lambda: label_store.stats()["bytes"])
+telemetry.REGISTRY.counter_fn("m2f_near_dup_matches_total", "Label maps reused from a near-duplicate upload", lambda: near_dups.matches)
+telemetry.REGISTRY.gauge_fn("m2f_jobs", "Jobs in the job store", lambda: len(job_store))
+telemetry.REGISTRY.gauge_fn("m2f_jobs_unfinished", "Jobs queued or running", lambda: job_store.unfinished)
+telemetry.REGISTRY.gauge_fn("m2f_label_cache_bytes", "Bytes held by the label-map cache", lambda: label_cache.stats()["bytes"])
+
+
+def _cache_hit_ratio() -> Optional[float]:
+    stats = label_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return stats["hits"] / lookups if lookups else None
+
+
+telemetry.REGISTRY.gauge_fn("m2f_label_cache_hit_ratio", "Label-map cache hits / lookups", _cache_hit_ratio)
+if batcher is not None:
+    telemetry.REGISTRY.counter_fn("m2f_batches_total", "Micro-batches run", lambda: batcher.stats()["batches"])
+    telemetry.REGISTRY.counter_fn("m2f_batched_items_total", "Requests run in micro-batches", lambda: batcher.stats()["items"])
+
+
+async def _offload(fn, *args):
+    # Bound to the request context so stage timings recorded on the worker land on this request.
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, telemetry.bind(fn, *args))
+
+
+async def _ensure_model(model_key: str, reload_flag: bool, ckpt: Optional[str] = None) -> tuple:
+    """Load `ckpt` (default MASK2FORMER_CKPT) on the engine behind `model_key` if needed; returns its (engine, checkpoint) ref."""
+    global loaded_key
+    ref = (MODEL_KEYS[model_key], ckpt or _checkpoint())
+    if ref in loaded_models and not reload_flag:
+        loaded_key = model_key
+        return ref
+    async with _model_locks.setdefault(ref, asyncio.Lock()):
+        # Re-checked under the lock: a concurrent caller may have finished the load while this one waited.
+        if reload_flag or ref not in loaded_models:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, load_mask2former_ade20k, *ref)
+            except FileNotFoundError as e:
+                raise HTTPException(status_code=503, detail=f"Model '{model_key}' is not available: {e}")
+        loaded_key = model_key
+    return ref
+
+
+def _infer_label_map(img, infer_size: tuple, target_size: tuple, profile=inference_profile.BASELINE,
+                     ref: Optional[tuple] = None) -> np.ndarray:
+    """Decode, resize and run Mask2Former on `img` (ingest.Upload or PIL image); return the label map at `target_size` (w, h). Blocking."""
+    ref = ref or _default_ref()
+    pixel_values, pixel_mask = _prepare_input(img, infer_size, ref)
+    if batcher is None:
+        with telemetry.stage("forward"):
+            class_logits, mask_logits = _forward(pixel_values, pixel_mask, profile, ref)
+        with telemetry.stage("postprocess"):
+            return _postprocess(class_logits, mask_logits, target_size, ref)
+    # Model + profile + exact input (H, W) is the batch key (nothing is padded): only same-shaped inputs on one model variant can share a forward pass.
+    key = (ref, profile, tuple(pixel_values.shape[-2:]))
+    # The batch runs on the batcher thread, so the batch window and post-processing count as `forward` here.
+    with telemetry.stage("forward"):
+        return batcher.submit(key, (pixel_values, pixel_mask, target_size, profile, ref)).result()
+
+
+def _prepare_input(img, infer_size: tuple, ref: tuple) -> tuple:
+    """(pixel_values, pixel_mask) of `img` (ingest.Upload or PIL image) at `infer_size`: decode, resize, normalise. Blocking."""
+    loaded = loaded_models[ref]
+    upload = img if isinstance(img, ingest.Upload) else ingest.Upload(img)
+    # The fused path resizes once, straight to the model input size (which can exceed the inference size).
+    decode_size = loaded.preprocess.output_size(*infer_size) if FUSED_PREPROCESS else infer_size
+    try:
+        with telemetry.stage("decode"):
+            # Reduced-scale decode (JPEG draft) to no less than the size needed next, upright per EXIF.
+            img = upload.decode(decode_size)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cannot decode image: {e}")
+    if FUSED_PREPROCESS:
+        with telemetry.stage("resize"):
+            img = loaded.preprocess.resize(img, infer_size)
+        with telemetry.stage("preprocess"):
+            pixel_values, pixel_mask = loaded.preprocess.normalize(img)
+    else:
+        infer_img = img
+        if infer_size != img.size:
+            try:
+                with telemetry.stage("resize"):
+                    infer_img = img.resize((int(infer_size[0]), int(infer_size[1])), Image.LANCZOS)
+            except Exception as e:
+                telemetry.log_event("resize_failed", level=logging.WARNING, error=str(e))
+        with telemetry.stage("preprocess"):
+            inputs = loaded.processor(images=infer_img, return_tensors="pt")
+        pixel_values = inputs["pixel_values"]
+        pixel_mask = inputs["pixel_mask"]
+    return pixel_values, pixel_mask
+
+
+def _tile_geometry(loaded: LoadedModel) -> tuple:
+    """(tile side, overlap) in pixels: multiples of 32, overlap below the tile side."""
+    tile = TILE_SIZE if TILE_SIZE > 0 else min(loaded.preprocess.output_size(1, 1))
+    tile = max(64, math.ceil(tile / 32) * 32)
+    overlap = min(max(0, TILE_OVERLAP) // 32 * 32, tile // 2)
+    return tile, overlap
+
+
+def _infer_tiled_label_map(img: ingest.Upload, profile=inference_profile.BASELINE, ref: Optional[tuple] = None) -> np.ndarray:
+    """Full-resolution label map of `img` from overlapping native-size tiles (tiled.py). Blocking."""
+    ref = ref or _default_ref()
+    loaded = loaded_models[ref]
+    try:
+        with telemetry.stage("decode"):
+            rgb = np.asarray(img.decode())
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cannot decode image: {e}")
+    tile, overlap = _tile_geometry(loaded)
+
+    def forward(pixel_values):
+        pixel_mask = torch.ones((pixel_values.shape[0],) + tuple(pixel_values.shape[-2:]), dtype=torch.int64)
+        return loaded.engine.forward(pixel_values, pixel_mask, profile)
+
+    dtype = _label_dtype(len(loaded.class_groups.id2label))
+    # Tiles are already batched, so this path bypasses the micro-batcher.
+    return tiled.tiled_label_map(rgb, tile, overlap, TILE_BATCH, loaded.preprocess.normalize_array, forward, dtype)
+
+
+def _open_upload(raw: bytes) -> ingest.Upload:
+    """Header-only open with the shared size guards (413 too large, 400 unreadable)."""
+    if not raw:
+        raise HTTPException(status_code=400, detail="Empty body (expected image bytes)")
+    try:
+        return ingest.open_upload(raw)
+    except ingest.TooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Cannot decode image: {e}")
+
+
+def _timed(fn, *args):
+    """(fn(*args), elapsed ms), measured on the worker thread so queue wait is excluded."""
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - t0) * 1000
+
+
+def _stored_label_map(key) -> Optional[np.ndarray]:
+    seg = label_cache.get(key) if label_cache.enabled else None
+    if seg is None and label_store.enabled:
+        seg = label_store.get(key)
+    return seg
+
+
+async def _cached_label_map(raw: bytes, img: ingest.Upload, long_side: int, target_size: tuple, profile, ref: tuple,
+                            tiled_mode: bool = False, schedule: Schedule = Schedule(), many: Optional[GatherBatcher] = None,
+                            near_bits: Optional[int] = None):
+    """Label map for `raw`, served from `label_cache` or `label_store` when possible. Returns (seg, cache_status).
+
+    `near_bits` (X-Near-Dup-Bits) overrides M2F_NEAR_DUP_BITS for this request; -1 disables near-duplicate reuse.
+
+    Inference queues in `schedule.lane` and is dropped (504) if `schedule.deadline` passes first.
+    With `many` (/segment-many), a miss joins that request's batched forward passes instead.
+    """
+    if tiled_mode:
+        infer_size = target_size = img.size
+        infer = (_infer_tiled_label_map, img, profile, ref)
+        variant = _latency_variant(ref, profile, "tiled")
+    else:
+        infer_size = _scaled_size(img.width, img.height, long_side)
+        infer = (_infer_label_map, img, infer_size, target_size, profile, ref)
+        variant = _latency_variant(ref, profile, infer_size != tuple(target_size))
+    # The output size is part of the key: endpoints share a map only when their X-Resolution gives the same target size.
+    with telemetry.stage("hash"):
+        key = (await _offload(image_digest, raw), infer_size, ref, loaded_models[ref].fingerprint, tuple(target_size), profile.name, tiled_mode)
+    seg = label_cache.get(key) if label_cache.enabled else None
+    if seg is not None:
+        return seg, "hit"
+    if label_store.enabled:
+        with telemetry.stage("store"):
+            seg = await _offload(label_store.get, key)
+        if seg is not None:
+            label_cache.put(key, seg)
+            return seg, "disk"
+    phash = None
+    max_distance = near_dups.threshold(near_bits)
+    if max_distance >= 0:
+        with telemetry.stage("phash"):
+            phash = await _offload(perceptual.dhash, img, raw)
+        # Everything in the key except the bytes and the sizes derived from them.
+        reuse_params = (ref, key[3], profile.name, tiled_mode, long_side, tuple(target_size) == img.size)
+        match = near_dups.find(reuse_params, phash, img.size, max_distance)
+        if match is not None:
+            seg = await _offload(_stored_label_map, match.key)
+            if seg is None:
+                near_dups.discard(match.key)
+            else:
+                if seg.shape != (target_size[1], target_size[0]):
+                    with telemetry.stage("rescale"):
+                        seg = await _offload(_upsample_nearest, seg, (int(target_size[0]), int(target_size[1])))
+                return seg, f"near:{match.distance}"
+
+    started = False  # whether this caller's own compute() ran (it started the flight)
+
+    async def compute():
+        nonlocal started
+        started = True
+        try:
+            t0 = time.perf_counter()
+            if many is not None:
+                # Decoded on the CPU pool, concurrently with the request's other photos (stages recorded inside).
+                pixel_values, pixel_mask = await _offload(_prepare_input, img, infer_size, ref)
+                seg = await many.submit(img, (ref, profile, tuple(pixel_values.shape[-2:])),
+                                        (pixel_values, pixel_mask, target_size, profile, ref))
+            else:
+                seg, service_ms = await infer_gate.run(_timed, *infer, schedule=schedule)
+                telemetry.record("queue", max(0.0, time.perf_counter() - t0 - service_ms / 1000))
+                latency.observe(ref[1], long_side, variant, service_ms)
+        except Overloaded as e:
+            raise HTTPException(
+                status_code=503,
+                detail="Segmentation queue is full, retry later",
+                headers={"Retry-After": str(e.retry_after_s)},
+            )
+        except DeadlineExceeded as e:
+            telemetry.record("queue", time.perf_counter() - t0)
+            raise HTTPException(status_code=504, detail=f"X-Deadline-MS expired before inference started: {e}")
+        except engines.UnsupportedInputSize as e:
+            raise HTTPException(status_code=422, detail=_unsupported_size_detail(e, img, long_side, ref, tiled_mode))
+        label_cache.put(key, seg)
+        if phash is not None:
+            near_dups.add(key, reuse_params, phash, img.size)
+        if label_store.enabled:
+            # Written in the background; the response does not wait for the disk.
+            cpu_executor.submit(label_store.put, key, seg)
+        return seg
+
+    if many is not None:
+        # Not shared through single-flight: a batch waits for the request's other images, so nothing may wait on it.
+        return await compute(), "miss" if label_cache.enabled else "off"
+    # Identical uploads already in flight (parallel wall/window/attached calls, double submits) share one inference.
+    t0 = time.perf_counter()
+    while True:
+        try:
+            seg, shared = await inflight.do(key, compute)
+            break
+        except HTTPException as e:
+            # The shared flight queued in its starter's lane and died of the starter's deadline. A waiter whose own
+            # deadline still holds goes again under its own schedule (joining or starting the next flight).
+            remaining = schedule.remaining_s()
+            if e.status_code != 504 or started or (remaining is not None and remaining <= 0):
+                raise
+    if shared:
+        telemetry.record("coalesced", time.perf_counter() - t0)
+        return seg, "coalesced"
+    return seg, "miss" if label_cache.enabled else "off"
+
+
+# X-Resolution: `inference` returns masks at inference size (plus scale factors),
+# `original-nearest` argmaxes at inference size and nearest-upsamples the uint8 map,
+# `original-bilinear` interpolates all class logits to the photo size before the argmax,
+# `tiled` runs the full-resolution photo as overlapping native-size tiles (no downscale, see tiled.py).
+RESOLUTION_POLICIES = ("inference", "original-nearest", "original-bilinear", "tiled")
+
+
+def _env_long_side() -> int:
+    try:
+        return int(os.environ.get("M2F_LONG_SIDE", "768"))
+    except ValueError:
+        return 768
+
+
+def _warmup() -> None:
+    """One forward pass at the configured inference size so one-time kernel/allocator setup is paid before traffic."""
+    long_side = _env_long_side() if _env_long_side() > 0 else 768
+    img = Image.new("RGB", (long_side, max(1, round(long_side * 3 / 4))), (128, 128, 128))
+    ref = _default_ref()
+    _infer_label_map(img, img.size, img.size, loaded_models[ref].engine.resolve(DEFAULT_PROFILE), ref)
+
+
+async def _preload() -> None:
+    try:
+        t0 = time.time()
+        await _ensure_model("mask2former_ade20k", False)
+        # Other checkpoints of the quality ladder, so the controller can switch without a cold load.
+        for ckpt in dict.fromkeys(r.ckpt for r in quality_controller.ladder):
+            await _ensure_model("mask2former_ade20k", False, ckpt)
+        ready_state["loadMs"] = int((time.time() - t0) * 1000)
+        t0 = time.time()
+        await infer_gate.run(_warmup)
+        ready_state["warmupMs"] = int((time.time() - t0) * 1000)
+        ready_state["ready"] = True
+        telemetry.log_event("ready", load_ms=ready_state["loadMs"], warmup_ms=ready_state["warmupMs"])
+    except Exception as e:
+        ready_state["error"] = str(e)
+        telemetry.log_event("preload_failed", level=logging.ERROR, error=str(e))
+
+
+def _resolution_policy(request: Request, default: str) -> str:
+    policy = (request.headers.get("X-Resolution") or default).strip().lower()
+    if policy not in RESOLUTION_POLICIES:
+        raise HTTPException(status_code=400, detail=f"Unknown X-Resolution '{policy}' (supported: {', '.join(RESOLUTION_POLICIES)})")
+    return policy
+
+
+def _latency_budget(request: Request) -> Optional[float]:
+    value = (request.headers.get("X-Latency-Budget-MS") or "").strip()
+    if not value:
+        return None
+    try:
+        budget = float(value)
+    except ValueError:
+        budget = 0
+    if budget <= 0:
+        raise HTTPException(status_code=400, detail=f"Invalid X-Latency-Budget-MS '{value}' (expected a positive number)")
+    return budget
+
+
+def _near_dup_bits(request: Request) -> Optional[int]:
+    """X-Near-Dup-Bits: this request's near-duplicate threshold (-1 = no reuse), or None for M2F_NEAR_DUP_BITS."""
+    value = (request.headers.get("X-Near-Dup-Bits") or "").strip()
+    if not value:
+        return None
+    try:
+        bits = int(value)
+    except ValueError:
+        bits = perceptual.HASH_BITS + 1
+    if not -1 <= bits <= perceptual.HASH_BITS:
+        raise HTTPException(status_code=400, detail=f"Invalid X-Near-Dup-Bits '{value}' (expected -1..{perceptual.HASH_BITS})")
+    return bits
+
+
+def _schedule(request: Request, default_lane: str = INTERACTIVE) -> Schedule:
+    """Lane from X-Priority and deadline from X-Deadline-MS (milliseconds from now, i.e. from when the headers arrived)."""
+    lane = (request.headers.get("X-Priority") or default_lane).strip().lower()
+    if lane not in infer_gate.lanes:
+        raise HTTPException(status_code=400, detail=f"Unknown X-Priority '{lane}' (supported: {', '.join(infer_gate.lanes)})")
+    value = (request.headers.get("X-Deadline-MS") or "").strip()
+    if not value:
+        return Schedule(lane)
+    try:
+        deadline_ms = float(value)
+    except ValueError:
+        deadline_ms = 0
+    if deadline_ms <= 0:
+        raise HTTPException(status_code=400, detail=f"Invalid X-Deadline-MS '{value}' (expected a positive number)")
+    return Schedule(lane, time.monotonic() + deadline_ms / 1000)
+
+
+def _latency_variant(ref: tuple, profile, upsampled) -> tuple:
+    """Everything besides checkpoint and long side that changes the cost of a label map (`upsampled` may be "tiled")."""
+    mode = upsampled if isinstance(upsampled, str) else ("original" if upsampled else "inference")
+    return ref[0], profile.name, mode
+
+
+def _queue_wait_ms() -> float:
+    """Expected wait for an inference slot: rounds of queued work ahead, at the typical job time."""
+    ahead = infer_gate.active + infer_gate.queued - infer_gate.max_concurrency + 1
+    if ahead <= 0 or latency.typical_ms is None:
+        return 0.0
+    return math.ceil(ahead / infer_gate.max_concurrency) * latency.typical_ms
+
+
+def _load_in_background(model_key: str, ckpt: str) -> None:
+    if (MODEL_KEYS[model_key], ckpt) in loaded_models or (model_key, ckpt) in _background_loads:
+        return
+    _background_loads.add((model_key, ckpt))
+    task = asyncio.create_task(_ensure_model(model_key, False, ckpt))
+
+    def _done(t):
+        _background_loads.discard((model_key, ckpt))
+        if not t.cancelled() and t.exception() is not None:
+            telemetry.log_event("background_load_failed", level=logging.ERROR, checkpoint=ckpt, error=str(t.exception()))
+
+    task.add_done_callback(_done)
+
+
+async def _choose_quality(model_key: str, ref: tuple, profile, budget_ms: float, upsampled: bool):
+    """(ref, long_side, headers) of the best ladder rung that fits `budget_ms` right now."""
+    engine = ref[0]
+    wait_ms = _queue_wait_ms()
+    rung, predicted = quality_controller.choose(
+        budget_ms, _latency_variant(ref, profile, upsampled), wait_ms, lambda r: (engine, r.ckpt) in loaded_models
+    )
+    # Rungs on checkpoints that are not loaded yet become eligible once their background load finishes.
+    for r in quality_controller.ladder:
+        _load_in_background(model_key, r.ckpt)
+    # Only when no ladder checkpoint is loaded at all does the chosen one load inline.
+    ref = await _ensure_model(model_key, False, rung.ckpt)
+    headers = {
+        "X-Quality": rung.label,
+        "X-Checkpoint": rung.ckpt,
+        "X-Latency-Budget-MS": str(int(budget_ms)),
+        "X-Predicted-MS": str(int(predicted)) if predicted is not None else "unknown",
+        "X-Queue-Wait-MS": str(int(wait_ms)),
+    }
+    return ref, rung.long_side, headers
+
+
+def _request_profile(request: Request):
+    """Profile from X-Profile (default M2F_PROFILE); the engine drops the options it cannot run."""
+    spec = request.headers.get("X-Profile")
+    try:
+        return inference_profile.parse(spec) if spec and spec.strip() else DEFAULT_PROFILE
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _model_key(request: Request) -> str:
+    model_key = (request.headers.get("X-Model") or "").strip()
+    if not model_key:
+        raise HTTPException(status_code=400, detail="Missing X-Model header")
+    if model_key not in MODEL_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unknown model '{model_key}' (supported: {', '.join(MODEL_KEYS)})")
+    return model_key
+
+
+def _upsample_nearest(seg: np.ndarray, size: tuple) -> np.ndarray:
+    """Nearest-neighbour resize of a label map to `size` (w, h); class ids are never blended."""
+    mode = "L" if seg.dtype == np.uint8 else "I;16"
+    return np.asarray(Image.fromarray(np.ascontiguousarray(seg), mode=mode).resize(size, Image.NEAREST))
+
+
+async def _policy_label_map(raw: bytes, img: ingest.Upload, long_side: int, policy: str, profile, ref: tuple,
+                            schedule: Schedule = Schedule(), many: Optional[GatherBatcher] = None, near_bits: Optional[int] = None):
+    """Label map sized according to the resolution policy. Returns (seg, cache_status)."""
+    if policy == "tiled":
+        return await _cached_label_map(raw, img, long_side, img.size, profile, ref, tiled_mode=True, schedule=schedule,
+                                       near_bits=near_bits)
+    infer_size = _scaled_size(img.width, img.height, long_side)
+    if policy == "original-bilinear":
+        return await _cached_label_map(raw, img, long_side, img.size, profile, ref, schedule=schedule, many=many, near_bits=near_bits)
+    # Both remaining policies share the cached inference-size map.
+    seg, cache_status = await _cached_label_map(raw, img, long_side, infer_size, profile, ref, schedule=schedule, many=many,
+                                                near_bits=near_bits)
+    if policy == "original-nearest" and infer_size != img.size:
+        with telemetry.stage("upsample"):
+            seg = await _offload(_upsample_nearest, seg, img.size)
+    return seg, cache_status
+
+
+def _resolution_headers(policy: str, seg: np.ndarray, original_size: tuple, loaded: LoadedModel) -> dict:
+    h, w = seg.shape
+    width, height = original_size
+    headers = {
+        "X-Resolution": policy,
+        "X-Original-Size": f"{width}x{height}",
+        "X-Mask-Size": f"{w}x{h}",
+        # Multiply mask coordinates by these to get original-photo coordinates.
+        "X-Scale-X": f"{width / w:.6f}",
+        "X-Scale-Y": f"{height / h:.6f}",
+    }
+    if policy == "tiled":
+        tile, overlap = _tile_geometry(loaded)
+        cols, rows = tiled.grid(width, height, tile, overlap)
+        headers["X-Tiles"] = f"{cols}x{rows}"
+        headers["X-Tile-Size"] = str(tile)
+    return headers
+
+
+def _cache_headers(status: str) -> dict:
+    stats = label_cache.stats()
+    # Near-duplicate reuse reports as `near:<hamming distance>`.
+    status, _, distance = status.partition(":")
+    headers = {
+        "X-Cache": status,
+        "X-Cache-Hits": str(stats["hits"]),
+        "X-Cache-Misses": str(stats["misses"]),
+    }
+    if distance:
+        headers["X-Reuse-Distance"] = f"{distance}/{perceptual.HASH_BITS}"
+        headers["X-Reuse-Confidence"] = f"{1 - int(distance) / perceptual.HASH_BITS:.3f}"
+    return headers
+
+
+def _segment_png(seg: np.ndarray, groups: ClassGroupLUT, x_mask: str, labels_header: str, png_options: tuple) -> bytes:
+    """Mask selected by X-Mask / X-Labels, encoded as the /segment PNG (RGBA unless negotiated)."""
+    with telemetry.stage("masks"):
+        if x_mask in ("wall", "window", "attached"):
+            labels = [x.strip() for x in labels_header.split(',') if x.strip()] if labels_header else []
+            out_mask = groups.label_mask(seg, labels) if labels else groups.group_mask(seg, x_mask)
+        else:
+            out_mask = groups.group_mask(seg, "wall", "window", "attached")
+
+    with telemetry.stage("encode"):
+        return mask_png.encode_mask_png(out_mask, *png_options)
 
 
 @app.post("/segment")
 async def segment(request: Request):
-    global loaded_key
     t0 = time.time()
-    model_key = (request.headers.get("X-Model") or "").strip()
     reload_flag = (request.headers.get("X-Reload") or "0").strip().lower() in {"1", "true", "yes", "on"}
     x_mask = (request.headers.get("X-Mask") or "combined").strip().lower()
     labels_header = (request.headers.get("X-Labels") or "").strip()
-    if not model_key:
-        raise HTTPException(status_code=400, detail="Missing X-Model header")
-    if model_key != "mask2former_ade20k":
-        raise HTTPException(status_code=400, detail=f"Unknown model '{model_key}' (only 'mask2former_ade20k' is supported)")
+    model_key = _model_key(request)
 
-    raw = await request.body()
-    if not raw:
-        raise HTTPException(status_code=400, detail="Empty body (expected image bytes)")
-    try:
-        img = Image.open(io.BytesIO(raw)).convert("RGB")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Cannot decode image: {e}")
+    # Masks at inference size by default (much faster than post-processing at original size)
+    policy = _resolution_policy(request, "inference")
+    png_options = _png_options(request)
+    profile = _request_profile(request)
+    budget_ms = _latency_budget(request)
+    schedule = _schedule(request)
+    near_bits = _near_dup_bits(request)
 
-    if reload_flag or loaded_key != model_key:
-        load_mask2former_ade20k()
-        loaded_key = model_key
+    with telemetry.stage("body"):
+        raw = await request.body()
+    # Header-only open: the full decode is skipped when the label map is cached.
+    img = _open_upload(raw)
+
+    ref = await _ensure_model(model_key, reload_flag)
+    profile = loaded_models[ref].engine.resolve(profile)
 
     # Optional long-side pre-scale for inference (header overrides env). 0 disables.
     try:
         scale_hdr = request.headers.get("X-Scale-Long-Side")
         env_long = int(os.environ.get("M2F_LONG_SIDE", "768"))
         long_side = int(scale_hdr) if scale_hdr is not None and str(scale_hdr).strip() != "" else env_long
-        print(f"[seg] X-Scale-Long-Side header: {scale_hdr}, env M2F_LONG_SIDE: {os.environ.get('M2F_LONG_SIDE', 'not set')}, using: {long_side}")
-    except Exception as e:
+    except Exception:
         long_side = 768
-        print(f"[seg] Scale header parse error: {e}, using default: {long_side}")
     long_side = int(long_side)
+    quality_headers = {}
+    # A latency budget picks checkpoint + long side, unless the client fixed the long side itself (tiles have none).
+    if budget_ms is not None and policy != "tiled" and not (request.headers.get("X-Scale-Long-Side") or "").strip():
+        ref, long_side, quality_headers = await _choose_quality(model_key, ref, profile, budget_ms, policy == "original-bilinear")
+    loaded = loaded_models[ref]
 
-    assert processor is not None and model is not None
-    with torch.inference_mode():
-        infer_img = img
-        print(f"[seg] Original image size: {img.width}x{img.height}")
-        if long_side > 0:
-            LW = max(img.width, img.height)
-            target = max(64, long_side)
-            print(f"[seg] Long side={LW}, target={target}, will_resize={LW > target}")
-            if LW > target:
-                if img.width >= img.height:
-                    new_w, new_h = target, max(1, round(img.height * target / img.width))
-                else:
-                    new_h, new_w = target, max(1, round(img.width * target / img.height))
-                try:
-                    infer_img = img.resize((int(new_w), int(new_h)), Image.LANCZOS)
-                    print(f"[seg] Resized to: {infer_img.width}x{infer_img.height}")
-                except Exception as e:
-                    infer_img = img
-                    print(f"[seg] Resize failed: {e}")
-        else:
-            print(f"[seg] Scaling disabled (long_side={long_side})")
-
-        inputs = processor(images=infer_img, return_tensors="pt").to(DEVICE)
-        outputs = model(**inputs)
-        # Use inference size for post-processing, not original size (much faster)
-        seg_list = processor.post_process_semantic_segmentation(
-            outputs, target_sizes=[(infer_img.height, infer_img.width)]
-        )
-        seg = seg_list[0].cpu().numpy()
-        print(f"[seg] Segmentation output size: {seg.shape}")
-
-    def _parse_labels(lbls: str):
-        return [x.strip() for x in lbls.split(',') if x.strip()]
-
-    wall_set = _parse_labels(labels_header) if labels_header and x_mask == "wall" else list(WALLISH)
-    window_set = _parse_labels(labels_header) if labels_header and x_mask == "window" else list(WINDOWISH)
-    attached_set = _parse_labels(labels_header) if labels_header and x_mask == "attached" else list(ATTACHED)
-
-    wall_mask = mask_from_labels(seg, model.config.id2label, wall_set)
-    window_mask = mask_from_labels(seg, model.config.id2label, window_set)
-    attached_mask = mask_from_labels(seg, model.config.id2label, attached_set)
-
-    if x_mask == "wall":
-        out_mask = wall_mask
-    elif x_mask == "window":
-        out_mask = window_mask
-    elif x_mask == "attached":
-        out_mask = attached_mask
-    else:
-        out_mask = np.where((wall_mask > 0) | (window_mask > 0) | (attached_mask > 0), 255, 0).astype(np.uint8)
+    infer_size = img.size if policy == "tiled" else _scaled_size(img.width, img.height, long_side)
+    seg, cache_status = await _policy_label_map(raw, img, long_side, policy, profile, ref, schedule, near_bits=near_bits)
 
-    png_bytes = rgba_png_from_binary_mask(out_mask)
+    png_bytes = await _offload(_segment_png, seg, loaded.class_groups, x_mask, labels_header, png_options)
 
-    try:
-        _mdev = str(next(model.parameters()).device)
-    except Exception:
-        _mdev = "unknown"
-    try:
-        _idev = str(inputs.get("pixel_values").device if hasattr(inputs, "get") else inputs["pixel_values"].device)
-    except Exception:
-        _idev = "unknown"
+    _mdev = loaded.engine.device_string()
     headers = {
         "X-Device": _device_string(),
         "X-ModelDevice": _mdev,
-        "X-InputDevice": _idev,
+        # Inputs are always moved to the model device before the forward pass.
+        "X-InputDevice": _mdev,
+        "X-Engine": ref[0],
+        "X-Mask-Format": png_options[0],
+        "X-Priority": schedule.lane,
+        **_cache_headers(cache_status),
+        **quality_headers,
     }
     try:
-        headers["X-Scale-Applied"] = "1" if infer_img is not img else "0"
-        if infer_img is not img:
-            headers["X-Scale-Size"] = f"{infer_img.width}x{infer_img.height}"
-            headers["X-Scale-Long-Side"] = str(max(infer_img.width, infer_img.height))
-        else:
-            headers["X-Scale-Long-Side"] = str(max(img.width, img.height))
+        scaled = infer_size != img.size
+        headers["X-Scale-Applied"] = "1" if scaled else "0"
+        if scaled:
+            headers["X-Scale-Size"] = f"{infer_size[0]}x{infer_size[1]}"
+        headers["X-Scale-Long-Side"] = str(max(infer_size))
+        headers.update(_resolution_headers(policy, seg, img.size, loaded))
     except Exception:
         pass
     try:
         headers["X-Elapsed-MS"] = str(int((time.time() - t0) * 1000))
-        print(f"[seg] OK model={model_key} device={headers.get('X-Device','?')} elapsed_ms={headers['X-Elapsed-MS']}")
+        headers["X-Profile"] = profile.name
+        telemetry.log_request("segment", model=model_key, engine=ref[0], checkpoint=ref[1], profile=profile.name,
+                              size=f"{img.width}x{img.height}", long_side=long_side, mask_size=headers.get("X-Mask-Size"),
+                              cache=cache_status, priority=schedule.lane, elapsed_ms=int(headers["X-Elapsed-MS"]))
     except Exception:
         pass
     return Response(content=png_bytes, media_type="image/png", headers=headers)
 
 
-@app.post("/segment-batch")
-async def segment_batch(request: Request):
-    """
-    PERFORMANCE OPTIMIZED: Return all masks (wall, floor, ceiling, window) from ONE inference.
-    This is 4× faster than calling /segment four times sequentially.
-    
-    Returns JSON with base64-encoded PNG masks instead of a single PNG response.
-    """
-    global loaded_key
-    t0 = time.time()
-    model_key = (request.headers.get("X-Model") or "").strip()
-    reload_flag = (request.headers.get("X-Reload") or "0").strip().lower() in {"1", "true", "yes", "on"}
-    
-    if not model_key:
-        raise HTTPException(status_code=400, detail="Missing X-Model header")
-    if model_key != "mask2former_ade20k":
-        raise HTTPException(status_code=400, detail=f"Unknown model '{model_key}' (only 'mask2former_ade20k' is supported)")
+# Group order of the compact /segment-batch formats (index 1..n in the legend).
+BATCH_GROUPS = ("wall", "window", "floor", "ceiling")
 
-    raw = await request.body()
-    if not raw:
-        raise HTTPException(status_code=400, detail="Empty body (expected image bytes)")
-    
-    # Safety check: reject uploads >50MB to prevent memory issues
-    if len(raw) > 50 * 1024 * 1024:
-        raise HTTPException(status_code=413, detail=f"Image too large: {len(raw)/(1024*1024):.1f}MB (max 50MB)")
-    
+
+def _batch_body(seg: np.ndarray, groups: ClassGroupLUT, width: int, height: int, fmt: str, original_size: tuple, png_options: tuple):
+    """Encode /segment-batch masks (width x height) as `fmt`. Returns (body, media_type, extra_headers)."""
+    if fmt == "json":
+        return _batch_json(seg, groups, width, height, original_size, png_options), "application/json", {"X-Mask-Format": png_options[0]}
+    if seg.shape != (height, width):
+        raise HTTPException(status_code=500, detail=f"Label map dimension mismatch: {seg.shape} vs image {height}x{width}")
     try:
-        img = Image.open(io.BytesIO(raw)).convert("RGB")
-        # Verify image dimensions are reasonable
-        if img.width * img.height > 50_000_000:  # ~7000x7000 pixels max
-            raise ValueError(f"Image dimensions too large: {img.width}x{img.height} pixels")
+        with telemetry.stage("masks"):
+            index_map = groups.index_map(seg, BATCH_GROUPS)
+        with telemetry.stage("encode"):
+            return mask_formats.encode(fmt, index_map, BATCH_GROUPS)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Cannot decode image: {e}")
+        raise HTTPException(status_code=500, detail=f"Mask encoding failed: {e}")
 
-    if reload_flag or loaded_key != model_key:
-        load_mask2former_ade20k()
-        loaded_key = model_key
 
-    # Optional long-side pre-scale for inference
+def _batch_json(seg: np.ndarray, groups: ClassGroupLUT, width: int, height: int, original_size: tuple, png_options: tuple) -> bytes:
+    """All /segment-batch masks from one label map, as JSON with base64 RGBA PNGs."""
     try:
-        scale_hdr = request.headers.get("X-Scale-Long-Side")
-        env_long = int(os.environ.get("M2F_LONG_SIDE", "768"))
-        long_side = int(scale_hdr) if scale_hdr is not None and str(scale_hdr).strip() != "" else env_long
-    except Exception:
-        long_side = 768
-    long_side = int(long_side)
+        with telemetry.stage("masks"):
+            masks = groups.masks(seg, ("wall", "window", "floor", "ceiling"))
+        wall_mask, window_mask, floor_mask, ceiling_mask = masks["wall"], masks["window"], masks["floor"], masks["ceiling"]
 
-    assert processor is not None and model is not None
-    
-    # SINGLE MODEL INFERENCE - this is the expensive operation
-    try:
-        with torch.inference_mode():
-            infer_img = img
-            if long_side > 0:
-                LW = max(img.width, img.height)
-                target = max(64, long_side)
-                if LW > target:
-                    if img.width >= img.height:
-                        new_w, new_h = target, max(1, round(img.height * target / img.width))
-                    else:
-                        new_h, new_w = target, max(1, round(img.width * target / img.height))
-                    try:
-                        infer_img = img.resize((int(new_w), int(new_h)), Image.LANCZOS)
-                    except Exception:
-                        infer_img = img
-            
-            inputs = processor(images=infer_img, return_tensors="pt").to(DEVICE)
-            outputs = model(**inputs)
-            seg_list = processor.post_process_semantic_segmentation(
-                outputs, target_sizes=[(img.height, img.width)]
-            )
-            seg = seg_list[0].cpu().numpy()
-    except RuntimeError as e:
-        if "Invalid buffer size" in str(e) or "out of memory" in str(e).lower():
-            raise HTTPException(status_code=422, detail=f"Image caused GPU/memory error - try smaller image or different format: {e}")
-        raise HTTPException(status_code=500, detail=f"Model inference failed: {e}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Segmentation processing failed: {e}")
-
-    # Extract all masks from the SAME segmentation result (cheap operations)
-    try:
-        wall_mask = mask_from_labels(seg, model.config.id2label, list(WALLISH))
-        window_mask = mask_from_labels(seg, model.config.id2label, list(WINDOWISH))
-        floor_mask = mask_from_labels(seg, model.config.id2label, list(FLOORISH))
-        ceiling_mask = mask_from_labels(seg, model.config.id2label, list(CEILINGISH))
-        
         # Sanity check mask dimensions
         for name, mask in [("wall", wall_mask), ("window", window_mask), ("floor", floor_mask), ("ceiling", ceiling_mask)]:
-            if mask.shape[0] != img.height or mask.shape[1] != img.width:
-                raise ValueError(f"{name} mask dimension mismatch: {mask.shape} vs image {img.height}x{img.width}")
+            if mask.shape[0] != height or mask.shape[1] != width:
+                raise ValueError(f"{name} mask dimension mismatch: {mask.shape} vs image {height}x{width}")
             if mask.nbytes > 100 * 1024 * 1024:  # 100MB sanity check
                 raise ValueError(f"{name} mask too large: {mask.nbytes/(1024*1024):.1f}MB")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Mask extraction failed: {e}")
 
-    # Convert to PNG bytes
+    # Convert to PNG bytes (the four masks are compressed concurrently)
+    encode_t0 = time.perf_counter()
     try:
-        wall_png = rgba_png_from_binary_mask(wall_mask)
-        window_png = rgba_png_from_binary_mask(window_mask)
-        floor_png = rgba_png_from_binary_mask(floor_mask)
-        ceiling_png = rgba_png_from_binary_mask(ceiling_mask)
+        pngs = mask_png.encode_many(masks, *png_options)
+        wall_png, window_png, floor_png, ceiling_png = pngs["wall"], pngs["window"], pngs["floor"], pngs["ceiling"]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PNG encoding failed: {e}")
 
     # Return all masks as JSON with base64-encoded PNGs
-    import json as _json
     try:
         payload = {
             "wall": base64.b64encode(wall_png).decode("utf-8"),
             "floor": base64.b64encode(floor_png).decode("utf-8"),
             "ceiling": base64.b64encode(ceiling_png).decode("utf-8"),
             "window": base64.b64encode(window_png).decode("utf-8"),
-            "width": int(img.width),
-            "height": int(img.height),
+            "width": int(width),
+            "height": int(height),
         }
+        if (width, height) != tuple(original_size):
+            payload["originalWidth"] = int(original_size[0])
+            payload["originalHeight"] = int(original_size[1])
+            payload["scaleX"] = original_size[0] / width
+            payload["scaleY"] = original_size[1] / height
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Base64 encoding failed: {e}")
+    body = json.dumps(payload).encode("utf-8")
+    telemetry.record("encode", time.perf_counter() - encode_t0)
+    return body
 
-    elapsed_ms = int((time.time() - t0) * 1000)
+
+class BatchParams(NamedTuple):
+    """/segment-batch parameters, read from the headers up front (jobs run after their request has returned)."""
+    model_key: str
+    reload: bool
+    fmt: str
+    policy: str
+    png_options: tuple
+    profile: object
+    budget_ms: Optional[float]
+    scale_long_side: str  # X-Scale-Long-Side as sent ("" = M2F_LONG_SIDE)
+    schedule: Schedule
+    near_bits: Optional[int]  # X-Near-Dup-Bits (None = M2F_NEAR_DUP_BITS)
+
+
+class BatchLabelMap(NamedTuple):
+    seg: np.ndarray
+    cache_status: str
+    ref: tuple
+    profile: object
+    long_side: int
+    quality_headers: dict
+
+
+def _batch_params(request: Request, default_lane: str = INTERACTIVE) -> BatchParams:
+    reload_flag = (request.headers.get("X-Reload") or "0").strip().lower() in {"1", "true", "yes", "on"}
+    fmt = mask_formats.negotiate(request.headers.get("X-Format"), request.headers.get("Accept"))
+    if fmt is None:
+        raise HTTPException(status_code=400, detail=f"Unknown X-Format (supported: {', '.join(mask_formats.FORMATS)})")
+    policy = _resolution_policy(request, os.environ.get("M2F_BATCH_RESOLUTION", "original-bilinear"))
+    png_options = _png_options(request)
+    profile = _request_profile(request)
+    budget_ms = _latency_budget(request)
+    model_key = _model_key(request)
+    return BatchParams(model_key, reload_flag, fmt, policy, png_options, profile, budget_ms,
+                       (request.headers.get("X-Scale-Long-Side") or "").strip(), _schedule(request, default_lane), _near_dup_bits(request))
+
+
+async def _batch_label_map(params: BatchParams, raw: bytes, img: ingest.Upload, many: Optional[GatherBatcher] = None) -> BatchLabelMap:
+    """Load the model, pick the long side (or quality rung) and compute the label map for `params`."""
+    ref = await _ensure_model(params.model_key, params.reload)
+    profile = loaded_models[ref].engine.resolve(params.profile)
+
+    # Optional long-side pre-scale for inference
     try:
-        print(f"[seg-batch] OK device={_device_string()} elapsed_ms={elapsed_ms} masks=4")
+        long_side = int(params.scale_long_side) if params.scale_long_side else int(os.environ.get("M2F_LONG_SIDE", "768"))
     except Exception:
-        pass
+        long_side = 768
+    quality_headers = {}
+    if params.budget_ms is not None and params.policy != "tiled" and not params.scale_long_side:
+        ref, long_side, quality_headers = await _choose_quality(params.model_key, ref, profile, params.budget_ms, params.policy == "original-bilinear")
 
+    # SINGLE MODEL INFERENCE - this is the expensive operation (skipped on cache hit)
+    try:
+        seg, cache_status = await _policy_label_map(raw, img, long_side, params.policy, profile, ref, params.schedule, many,
+                                                    params.near_bits)
+    except HTTPException:
+        raise
+    except RuntimeError as e:
+        if "Invalid buffer size" in str(e) or "out of memory" in str(e).lower():
+            raise HTTPException(status_code=422, detail=f"Image caused GPU/memory error - try smaller image or different format: {e}")
+        raise HTTPException(status_code=500, detail=f"Model inference failed: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Segmentation processing failed: {e}")
+    return BatchLabelMap(seg, cache_status, ref, profile, long_side, quality_headers)
+
+
+async def _batch_encode(result: BatchLabelMap, policy: str, original_size: tuple, fmt: str, png_options: tuple) -> tuple:
+    """(body, media_type, headers) of the /segment-batch response for a computed label map."""
+    loaded = loaded_models[result.ref]
+    # Extract all masks from the SAME segmentation result (cheap operations)
+    mask_h, mask_w = result.seg.shape
+    body, media_type, fmt_headers = await _offload(_batch_body, result.seg, loaded.class_groups, mask_w, mask_h, fmt, original_size, png_options)
     headers = {
         "X-Device": _device_string(),
-        "X-Elapsed-MS": str(elapsed_ms),
+        "X-Profile": result.profile.name,
+        "X-Engine": result.ref[0],
+        **_cache_headers(result.cache_status),
+        **result.quality_headers,
+        **_resolution_headers(policy, result.seg, original_size, loaded),
+        **fmt_headers,
     }
+    return body, media_type, headers
+
+
+@app.post("/segment-batch")
+async def segment_batch(request: Request):
+    """
+    PERFORMANCE OPTIMIZED: Return all masks (wall, floor, ceiling, window) from ONE inference.
+    This is 4× faster than calling /segment four times sequentially.
     
+    Returns JSON with base64-encoded PNG masks instead of a single PNG response, unless
+    a compact format is negotiated via X-Format or Accept (see mask_formats.py).
+    """
+    t0 = time.time()
+    params = _batch_params(request)
+
+    with telemetry.stage("body"):
+        raw = await request.body()
+    # Byte and pixel limits (M2F_MAX_UPLOAD_MB / M2F_MAX_PIXELS) are checked before any decoding.
+    img = _open_upload(raw)
+
+    result = await _batch_label_map(params, raw, img)
+    body, media_type, headers = await _batch_encode(result, params.policy, img.size, params.fmt, params.png_options)
+
+    elapsed_ms = int((time.time() - t0) * 1000)
+    telemetry.log_request("segment_batch", model=params.model_key, engine=result.ref[0], checkpoint=result.ref[1], profile=result.profile.name,
+                          size=f"{img.width}x{img.height}", long_side=result.long_side, mask_size=headers["X-Mask-Size"],
+                          cache=result.cache_status, format=params.fmt, priority=params.schedule.lane, elapsed_ms=elapsed_ms)
+    headers["X-Elapsed-MS"] = str(elapsed_ms)
+    headers["X-Priority"] = params.schedule.lane
     return Response(
-        content=_json.dumps(payload).encode("utf-8"),
-        media_type="application/json",
+        content=body,
+        media_type=media_type,
         headers=headers
     )
 
 
+# POST /segment-many: file parts per call, header pixels summed over them, images per batched forward pass.
+MANY_MAX_IMAGES = int(os.environ.get("M2F_MANY_MAX_IMAGES", "32"))
+MANY_MAX_PIXELS = int(os.environ.get("M2F_MANY_MAX_PIXELS", "100000000"))
+MANY_MAX_BYTES = int(float(os.environ.get("M2F_MANY_MAX_MB", "200")) * 1024 * 1024)
+MANY_BATCH = max(1, int(os.environ.get("M2F_MANY_BATCH", "4")))
+
+
+def _multipart_part(boundary: str, headers: dict, body: bytes) -> bytes:
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    return f"--{boundary}\r\n{head}\r\n".encode("latin-1") + body + b"\r\n"
+
+
+def _content_disposition(filename: str) -> str:
+    """attachment header for a client-supplied filename: ASCII fallback without quotes/CR/LF, plus RFC 5987 filename*."""
+    fallback = "".join(ch if 32 <= ord(ch) < 127 and ch not in '"\\' else "_" for ch in filename) or "image"
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{urllib.parse.quote(filename, safe="")}'
+
+
+def _many_error(index: int, filename: str, status: int, detail) -> tuple:
+    body = json.dumps({"index": index, "filename": filename, "status": status, "detail": detail}).encode("utf-8")
+    return body, {"Content-Type": "application/json", "X-Status": str(status)}
+
+
+async def _capped_stream(request: Request, max_bytes: int, detail: str):
+    """The request body, failing with 413 as soon as more than `max_bytes` have arrived (chunked bodies included)."""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise HTTPException(status_code=413, detail=detail)
+        yield chunk
+
+
+@app.post("/segment-many")
+async def segment_many(request: Request):
+    """
+    Several photos in one call: multipart/form-data with one file part per photo, same headers as /segment-batch.
+    Answers multipart/mixed with one part per photo, streamed as each finishes (X-Part-Index = request order).
+    A photo that fails gets a JSON error part with its status instead of failing the call.
+    """
+    t0 = time.time()
+    params = _batch_params(request)
+    if not (request.headers.get("Content-Type") or "").lower().startswith("multipart/form-data"):
+        raise HTTPException(status_code=415, detail="Expected a multipart/form-data body with one file part per image")
+    too_large = f"Request body exceeds {MANY_MAX_BYTES / (1024 * 1024):.0f}MB per call (M2F_MANY_MAX_MB)"
+    try:
+        declared = int(request.headers.get("Content-Length") or 0)
+    except ValueError:
+        declared = 0
+    if declared > MANY_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=too_large)
+    with telemetry.stage("body"):
+        # Counted while it streams in: a chunked body without Content-Length is cut off at the cap, not spooled whole.
+        parser = MultiPartParser(request.headers, _capped_stream(request, MANY_MAX_BYTES, too_large),
+                                 max_files=MANY_MAX_IMAGES, max_fields=MANY_MAX_IMAGES)
+        try:
+            form = await parser.parse()
+        except MultiPartException as e:
+            raise HTTPException(status_code=400, detail=e.message)
+        try:
+            files = [value for _, value in form.multi_items() if isinstance(value, UploadFile)]
+            filenames = [f.filename for f in files]
+            raws = [await f.read() for f in files]
+        finally:
+            await form.close()
+    if not files:
+        raise HTTPException(status_code=400, detail="No image parts in the multipart body")
+
+    # Header-only opens: unreadable or oversized photos become error parts, the pixel cap applies to the rest.
+    uploads, errors = {}, {}
+    for i, raw in enumerate(raws):
+        try:
+            uploads[i] = _open_upload(raw)
+        except HTTPException as e:
+            errors[i] = (e.status_code, e.detail)
+    total_pixels = sum(img.width * img.height for img in uploads.values())
+    if total_pixels > MANY_MAX_PIXELS:
+        raise HTTPException(status_code=413, detail=f"Images total {total_pixels} pixels (max {MANY_MAX_PIXELS} per call, M2F_MANY_MAX_PIXELS)")
+
+    async def run_batch(payloads: list) -> list:
+        t_gate = time.perf_counter()
+        segs, service_ms = await infer_gate.run(_timed, _run_batch, payloads, schedule=params.schedule)
+        telemetry.record("queue", max(0.0, time.perf_counter() - t_gate - service_ms / 1000))
+        telemetry.record("forward", service_ms / 1000)
+        return segs
+
+    many = GatherBatcher(run_batch, MANY_BATCH, len(uploads))
+
+    async def one(i: int, img: ingest.Upload) -> tuple:
+        try:
+            result = await _batch_label_map(params, raws[i], img, many)
+            body, media_type, headers = await _batch_encode(result, params.policy, img.size, params.fmt, params.png_options)
+            return i, body, {"Content-Type": media_type, "X-Status": "200", **headers}
+        except HTTPException as e:
+            return (i, *_many_error(i, filenames[i], e.status_code, e.detail))
+        except Exception as e:
+            return (i, *_many_error(i, filenames[i], 500, f"Segmentation processing failed: {e}"))
+        finally:
+            many.finish(img)
+
+    tasks = [asyncio.create_task(one(i, img)) for i, img in uploads.items()]
+    boundary = uuid.uuid4().hex
+    stats = {"ok": 0, "failed": len(errors)}
+
+    async def parts():
+        try:
+            for i, (status, detail) in errors.items():
+                body, headers = _many_error(i, filenames[i], status, detail)
+                headers.update({"X-Part-Index": str(i), "Content-Disposition": _content_disposition(filenames[i] or str(i))})
+                yield _multipart_part(boundary, headers, body)
+            for done in asyncio.as_completed(tasks):
+                i, body, headers = await done
+                stats["ok" if headers["X-Status"] == "200" else "failed"] += 1
+                headers.update({"X-Part-Index": str(i), "Content-Disposition": _content_disposition(filenames[i] or str(i))})
+                yield _multipart_part(boundary, headers, body)
+            yield f"--{boundary}--\r\n".encode("latin-1")
+        finally:
+            # Client went away mid-stream: stop the photos not yet done (running batches finish and are cached).
+            for task in tasks:
+                task.cancel()
+            telemetry.log_request("segment_many", model=params.model_key, images=len(files), pixels=total_pixels,
+                                  ok=stats["ok"], failed=stats["failed"], batches=many.batches, largest_batch=many.largest,
+                                  format=params.fmt, priority=params.schedule.lane, elapsed_ms=int((time.time() - t0) * 1000))
+
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}",
+                             headers={"X-Images": str(len(files)), "X-Priority": params.schedule.lane})
+
+
+async def _run_job(job: jobs.Job, raw: bytes, img: ingest.Upload) -> None:
+    """Compute a job's label map in the background; the store keeps it for GET /jobs/{id}."""
+    telemetry.use(job.timer)
+    try:
+        async with _job_slots:
+            job.start()
+            while True:
+                try:
+                    result = await _batch_label_map(job.params, raw, img)
+                    break
+                except HTTPException as e:
+                    # A full inference queue (synchronous traffic) delays the job instead of failing it.
+                    if e.status_code != 503 or "Retry-After" not in (e.headers or {}):
+                        raise
+                    await asyncio.sleep(infer_gate.retry_after_s)
+        job.finish(jobs.DONE, (result, img.size), result.seg.nbytes)
+    except asyncio.CancelledError:
+        job.finish(jobs.CANCELLED)
+        raise
+    except HTTPException as e:
+        job.finish(jobs.FAILED, error=(e.status_code, e.detail))
+    except Exception as e:
+        job.finish(jobs.FAILED, error=(500, f"Segmentation processing failed: {e}"))
+    finally:
+        job_store.finished(job)
+        for name, seconds in job.timer.stages.items():
+            telemetry.stage_seconds.observe(("job", name), seconds)
+        info = job.info()
+        telemetry.log_request("job", id=job.id, status=job.status, model=job.params.model_key, priority=job.params.schedule.lane, size=f"{img.width}x{img.height}",
+                              queued_ms=info["queuedMs"], run_ms=info["runMs"], error=info.get("error"))
+
+
+def _get_job(job_id: str) -> jobs.Job:
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired job '{job_id}'")
+    return job
+
+
+@app.post("/jobs")
+async def create_job(request: Request):
+    """
+    Asynchronous /segment-batch: same headers and body, answers 202 with a job id at once.
+    Poll GET /jobs/{id} (202 + status JSON until done, then the masks); DELETE /jobs/{id} cancels.
+    """
+    # Jobs are bulk work: they queue in the background lane unless X-Priority says otherwise.
+    params = _batch_params(request, BACKGROUND)
+    with telemetry.stage("body"):
+        raw = await request.body()
+    img = _open_upload(raw)
+    try:
+        job = job_store.create(params)
+    except jobs.JobStoreFull as e:
+        raise HTTPException(status_code=503, detail=f"Job store is full, retry later: {e}", headers={"Retry-After": str(infer_gate.retry_after_s)})
+    job.task = asyncio.create_task(_run_job(job, raw, img))
+    return JSONResponse(status_code=202, content=job.info(), headers={"Location": f"/jobs/{job.id}"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    """Status while queued/running (202), the masks once done (X-Format / Accept / X-Mask-Format may differ from the POST), the error if failed."""
+    job = _get_job(job_id)
+    job_headers = {"X-Job-Id": job.id, "X-Job-Status": job.status}
+    if job.status in (jobs.QUEUED, jobs.RUNNING):
+        return JSONResponse(status_code=202, content=job.info(), headers={**job_headers, "Retry-After": "1"})
+    if job.status != jobs.DONE:
+        status = job.error[0] if job.error else 500
+        return JSONResponse(status_code=status, content=job.info(), headers=job_headers)
+
+    params = job.params
+    x_format, accept = request.headers.get("X-Format"), request.headers.get("Accept")
+    # Without an explicit choice (no X-Format, Accept naming no binary format) the POST's format applies.
+    fmt = mask_formats.negotiate(x_format, accept) if x_format or mask_formats.negotiate(None, accept) != "json" else params.fmt
+    if fmt is None:
+        raise HTTPException(status_code=400, detail=f"Unknown X-Format (supported: {', '.join(mask_formats.FORMATS)})")
+    png_options = _png_options(request) if request.headers.get("X-Mask-Format") or request.headers.get("X-PNG-Compress") else params.png_options
+    result, original_size = job.result
+    body, media_type, headers = await _batch_encode(result, params.policy, original_size, fmt, png_options)
+    headers.update(job_headers)
+    headers["X-Job-Timing"] = ", ".join(f"{name};dur={ms}" for name, ms in job.timer.ms().items())
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+@app.delete("/jobs/{job_id}")
+async def delete_job(job_id: str):
+    """Cancel a queued or running job, or drop a finished one. A running inference completes (and is cached), its result is discarded."""
+    job = job_store.remove(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired job '{job_id}'")
+    if job.task is not None and not job.task.done():
+        job.task.cancel()
+    return Response(status_code=204)
+
+
 @app.get("/")
 async def root():
-    return {"ok": True, "device": _device_string(), "loaded": loaded_key}
+    return {"ok": True, "device": _device_string(), "loaded": loaded_key, "ready": ready_state["ready"], "inference": infer_gate.stats(),
+            "singleFlight": inflight.stats(), "jobs": job_store.stats(), "labelStore": label_store.stats(),
+            "nearDups": near_dups.stats()}
+
+
+@app.get("/ready")
+async def ready():
+    status = 200 if ready_state["ready"] else 503
+    return JSONResponse(status_code=status, content={**ready_state, "loaded": loaded_key})
 
 
 @app.get("/device")
@@ -398,6 +1383,18 @@ async def device_info():
             "cudaName": cuda_name,
             "mps": mps,
             "loadedModel": loaded_key,
+            "batching": batcher.stats() if batcher is not None else None,
+            "engine": DEFAULT_ENGINE,
+            "models": [{"checkpoint": ckpt, **m.engine.stats()} for (_, ckpt), m in loaded_models.items()],
+            "quality": {"ladder": [r.label for r in quality_controller.ladder], "latency": latency.stats()},
+            "profile": DEFAULT_PROFILE.name,
+            "bf16Supported": inference_profile.bf16_supported(DEVICE),
+            "threads": thread_config,
         }
     except Exception:
         return {"device": _device_string(), "backend": DEVICE, "loadedModel": loaded_key}
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(telemetry.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,97 @@
+"""
+Compact binary encodings for multi-group mask responses.
+---------------------------------------------------------
+/segment-batch defaults to JSON with one base64 RGBA PNG per group. Clients
+that want every mask from one small payload can negotiate instead:
+
+  index-png  image/png                 8-bit grayscale PNG, pixel = group index (0 = none)
+  packbits   application/x-packbits    one np.packbits plane per group (row-major, MSB first),
+                                       concatenated in legend order
+  rle        application/x-rle         runs over the row-major group-index map, each run is
+                                       <u1 value><u4 little-endian length>
+
+Width, height and the group legend travel in response headers.
+"""
+
+import io
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+FORMATS = {
+    "json": "application/json",
+    "index-png": "image/png",
+    "packbits": "application/x-packbits",
+    "rle": "application/x-rle",
+}
+
+_RLE_DTYPE = np.dtype([("value", "u1"), ("length", "<u4")])
+
+
+def negotiate(x_format: Optional[str], accept: Optional[str]) -> Optional[str]:
+    """Pick a format from X-Format (wins) or Accept. Returns None for an unknown X-Format."""
+    if x_format:
+        fmt = x_format.strip().lower()
+        return fmt if fmt in FORMATS else None
+    if accept:
+        media = [part.split(";")[0].strip().lower() for part in accept.split(",")]
+        for fmt, mime in FORMATS.items():
+            if fmt != "json" and mime in media:
+                return fmt
+    return "json"
+
+
+def legend_header(groups: Sequence[str]) -> str:
+    return ",".join(f"{i + 1}={g}" for i, g in enumerate(groups))
+
+
+def index_png(index_map: np.ndarray, compress_level: int = 6) -> bytes:
+    buf = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(index_map, dtype=np.uint8), mode="L").save(
+        buf, format="PNG", compress_level=compress_level
+    )
+    return buf.getvalue()
+
+
+def packbits_planes(index_map: np.ndarray, n_groups: int) -> Tuple[bytes, int]:
+    """Concatenated bit planes (group 1..n) and the byte length of one plane."""
+    flat = index_map.reshape(-1)
+    planes = [np.packbits(flat == (i + 1)) for i in range(n_groups)]
+    plane_bytes = int(planes[0].nbytes) if planes else 0
+    return b"".join(p.tobytes() for p in planes), plane_bytes
+
+
+def rle(index_map: np.ndarray) -> Tuple[bytes, int]:
+    """Run-length encoded row-major index map and the number of runs."""
+    flat = index_map.reshape(-1)
+    if flat.size == 0:
+        return b"", 0
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    runs = np.empty(starts.size, dtype=_RLE_DTYPE)
+    runs["value"] = flat[starts]
+    runs["length"] = np.diff(np.append(starts, flat.size))
+    return runs.tobytes(), int(starts.size)
+
+
+def encode(fmt: str, index_map: np.ndarray, groups: Sequence[str]) -> Tuple[bytes, str, dict]:
+    """Encode a group-index map as `fmt` (any format except json). Returns (body, media_type, headers)."""
+    h, w = index_map.shape
+    headers = {
+        "X-Format": fmt,
+        "X-Width": str(int(w)),
+        "X-Height": str(int(h)),
+        "X-Groups": legend_header(groups),
+    }
+    if fmt == "index-png":
+        body = index_png(index_map)
+    elif fmt == "packbits":
+        body, plane_bytes = packbits_planes(index_map, len(groups))
+        headers["X-Plane-Bytes"] = str(plane_bytes)
+    elif fmt == "rle":
+        body, n_runs = rle(index_map)
+        headers["X-RLE-Runs"] = str(n_runs)
+        headers["X-RLE-Layout"] = "u8 value, u32le length"
+    else:
+        raise ValueError(f"Unsupported binary format '{fmt}'")
+    return body, FORMATS[fmt], headers
@@ -0,0 +1,59 @@
+"""
+Binary mask PNG encoders.
+--------------------------
+  rgba  RGBA, white, mask = alpha 0 / background = alpha 255 (historical contract)
+  gray  8-bit grayscale, mask = 255
+  1bit  1-bit grayscale, mask = 1 (smallest and fastest to compress)
+
+Masks are 0/255 (or any non-zero = mask) uint8 arrays. zlib releases the GIL,
+so `encode_many` compresses several masks concurrently on a small pool.
+"""
+
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+MODES = ("rgba", "gray", "1bit")
+DEFAULT_COMPRESS_LEVEL = int(os.environ.get("M2F_PNG_COMPRESS", "6"))
+
+_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("M2F_PNG_WORKERS", "4")), thread_name_prefix="m2f-png")
+
+
+def _to_image(mask: np.ndarray, mode: str) -> Image.Image:
+    if mask.dtype != np.uint8:
+        mask = (mask > 0).astype(np.uint8)
+    h, w = mask.shape
+    if mode == "rgba":
+        rgba = np.empty((h, w, 4), dtype=np.uint8)
+        rgba[..., :3] = 255
+        alpha = rgba[..., 3]
+        # Write alpha in place: bool -> uint8 into the strided channel, then scale to 0/255.
+        np.equal(mask, 0, out=alpha)
+        alpha *= 255
+        return Image.fromarray(rgba, mode="RGBA")
+    if mode == "gray":
+        if not mask.flags.c_contiguous:
+            mask = np.ascontiguousarray(mask)
+        return Image.frombuffer("L", (w, h), mask, "raw", "L", 0, 1)
+    if mode == "1bit":
+        packed = np.packbits(mask > 0, axis=1)
+        return Image.frombuffer("1", (w, h), packed, "raw", "1", 0, 1)
+    raise ValueError(f"Unknown mask PNG mode '{mode}' (supported: {', '.join(MODES)})")
+
+
+def encode_mask_png(mask: np.ndarray, mode: str = "rgba", compress_level: int = DEFAULT_COMPRESS_LEVEL) -> bytes:
+    buf = io.BytesIO()
+    _to_image(mask, mode).save(buf, format="PNG", compress_level=int(compress_level))
+    return buf.getvalue()
+
+
+def encode_many(masks: Dict[str, np.ndarray], mode: str = "rgba", compress_level: int = DEFAULT_COMPRESS_LEVEL) -> Dict[str, bytes]:
+    """Encode several masks concurrently; returns PNG bytes keyed like `masks`."""
+    if len(masks) <= 1:
+        return {k: encode_mask_png(m, mode, compress_level) for k, m in masks.items()}
+    futures = {k: _pool.submit(encode_mask_png, m, mode, compress_level) for k, m in masks.items()}
+    return {k: f.result() for k, f in futures.items()}
@@ -0,0 +1,146 @@
+"""
+Self-contained local model artifact with memory-mapped weights.
+----------------------------------------------------------------
+`from_pretrained` resolves the Hub cache, builds a randomly initialised model
+and copies every weight into it. The artifact skips all of that:
+
+  <M2F_ARTIFACT_DIR>/<ckpt with "/" -> "--">/
+    config.json                model config
+    preprocessor_config.json   image processor settings
+    model.safetensors          weights, contiguous, one file
+    artifact.json              source checkpoint + format version
+
+Loading builds the module skeleton with empty (meta) parameters and assigns
+tensors that are views into a copy-on-write mmap of model.safetensors, so
+nothing is copied: pages are faulted in on first use and several replicas on
+one host share a single copy through the OS page cache.
+
+Export once per checkpoint:
+  python model_artifact.py export [--ckpt facebook/mask2former-swin-large-ade-semantic] [--out DIR]
+"""
+
+import argparse
+import json
+import os
+import struct
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+
+FORMAT_VERSION = 1
+WEIGHTS_FILE = "model.safetensors"
+MANIFEST_FILE = "artifact.json"
+
+# safetensors dtype -> (numpy dtype used for the raw view, torch dtype to reinterpret as)
+_DTYPES = {
+    "F64": (np.float64, None),
+    "F32": (np.float32, None),
+    "F16": (np.float16, None),
+    "BF16": (np.uint16, torch.bfloat16),
+    "I64": (np.int64, None),
+    "I32": (np.int32, None),
+    "I16": (np.int16, None),
+    "I8": (np.int8, None),
+    "U8": (np.uint8, None),
+    "BOOL": (np.bool_, None),
+}
+
+
+def default_artifact_root() -> str:
+    return os.environ.get("M2F_ARTIFACT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "artifacts"))
+
+
+def artifact_path(ckpt: str, root: Optional[str] = None) -> str:
+    return os.path.join(root or default_artifact_root(), ckpt.strip("/").replace("/", "--"))
+
+
+def find_artifact(ckpt: str) -> Optional[str]:
+    """Artifact directory for `ckpt` if a complete export exists, else None."""
+    if os.path.isfile(os.path.join(ckpt, MANIFEST_FILE)):
+        return ckpt
+    path = artifact_path(ckpt)
+    if os.path.isfile(os.path.join(path, MANIFEST_FILE)) and os.path.isfile(os.path.join(path, WEIGHTS_FILE)):
+        return path
+    return None
+
+
+def export_artifact(ckpt: str, out_dir: str) -> str:
+    from safetensors.torch import save_file
+    from transformers import AutoImageProcessor, Mask2FormerForUniversalSegmentation
+
+    os.makedirs(out_dir, exist_ok=True)
+    processor = AutoImageProcessor.from_pretrained(ckpt)
+    model = Mask2FormerForUniversalSegmentation.from_pretrained(ckpt).eval()
+    processor.save_pretrained(out_dir)
+    model.config.save_pretrained(out_dir)
+    # Materialise tied/shared tensors as independent contiguous blocks so every tensor is a plain slice.
+    state = {k: v.detach().contiguous().clone() for k, v in model.state_dict().items()}
+    tmp = os.path.join(out_dir, WEIGHTS_FILE + ".tmp")
+    save_file(state, tmp, metadata={"format": "pt"})
+    os.replace(tmp, os.path.join(out_dir, WEIGHTS_FILE))
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w") as f:
+        json.dump({"version": FORMAT_VERSION, "checkpoint": ckpt, "torch": torch.__version__, "created": int(time.time())}, f, indent=2)
+    return out_dir
+
+
+def mmap_state_dict(path: str) -> dict:
+    """Tensors backed by a copy-on-write mmap of a .safetensors file (no reads, no copies)."""
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+    # mode "c" maps MAP_PRIVATE: shared page-cache pages until (never, for inference) written.
+    buf = np.memmap(path, dtype=np.uint8, mode="c")
+    data_start = 8 + header_len
+    state = {}
+    for name, info in header.items():
+        np_dtype, torch_view = _DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        raw = buf[data_start + begin:data_start + end]
+        if (data_start + begin) % np.dtype(np_dtype).itemsize:
+            raw = np.array(raw)  # misaligned (not produced by export_artifact): fall back to a copy
+        arr = raw.view(np_dtype).reshape(info["shape"])
+        t = torch.from_numpy(arr)
+        state[name] = t.view(torch_view) if torch_view is not None else t
+    return state
+
+
+def load_artifact(path: str, device: str = "cpu"):
+    """(processor, model) from an exported artifact directory."""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoImageProcessor, Mask2FormerForUniversalSegmentation
+    from transformers.modeling_utils import no_init_weights
+
+    processor = AutoImageProcessor.from_pretrained(path, local_files_only=True)
+    config = AutoConfig.from_pretrained(path, local_files_only=True)
+    # Skip random initialisation too: every tensor is replaced by the mmap view below.
+    with init_empty_weights(), no_init_weights():
+        model = Mask2FormerForUniversalSegmentation(config)
+    state = mmap_state_dict(os.path.join(path, WEIGHTS_FILE))
+    model.load_state_dict(state, strict=True, assign=True)
+    leftover = [n for n, p in list(model.named_parameters()) + list(model.named_buffers()) if p.is_meta]
+    if leftover:
+        raise RuntimeError(f"Artifact {path} is missing tensors: {leftover[:5]}")
+    model.eval()
+    if device != "cpu":
+        model = model.to(device)
+    return processor, model
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export a Mask2Former checkpoint as a memory-mappable local artifact.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    exp = sub.add_parser("export")
+    exp.add_argument("--ckpt", default=os.environ.get("MASK2FORMER_CKPT", "facebook/mask2former-swin-large-ade-semantic"))
+    exp.add_argument("--out", default=None, help="Output directory (default: $M2F_ARTIFACT_DIR/<ckpt>)")
+    args = parser.parse_args()
+    out = args.out or artifact_path(args.ckpt)
+    t0 = time.time()
+    export_artifact(args.ckpt, out)
+    print(f"[artifact] exported {args.ckpt} -> {out} in {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+ONNX Runtime CPU engine.
+-------------------------
+The traced Mask2Former graph bakes in its input size (the deformable-attention
+level shapes become constants), so the export holds one graph per input shape:
+
+  <M2F_ARTIFACT_DIR>/<ckpt>/onnx/
+    config.json, preprocessor_config.json
+    model-<W>x<H>.onnx          fp32 graph for padded input W x H
+    model-<W>x<H>.int8.onnx     dynamically quantized graph (--int8)
+    onnx.json                   manifest: shapes, int8, opset
+
+The default shapes are what the image processor produces for common photo
+aspect ratios at M2F_LONG_SIDE. At inference time the input is zero-padded
+(the processor's own padding value) into the smallest exported shape that
+fits and the mask logits are cropped back, so post-processing sees exactly
+the geometry of the PyTorch path. Sessions are created on first use of a shape.
+
+  python onnx_engine.py export [--ckpt ...] [--long-side 768] [--aspects 4:3,3:4,16:9,9:16,1:1] [--shapes 864x640] [--int8]
+
+M2F_ORT_OPT (disable|basic|extended|all, default all) sets the graph
+optimization level; M2F_INTRA_THREADS / M2F_INTER_THREADS size the session
+thread pools.
+"""
+
+import argparse
+import inspect
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+import engines
+import inference_profile
+import model_artifact
+import telemetry
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = "onnx.json"
+DEFAULT_ASPECTS = "4:3,3:4,16:9,9:16,1:1"
+DEFAULT_OPSET = 17
+
+
+def _size_str(shape: Tuple[int, int]) -> str:
+    return f"{shape[1]}x{shape[0]}"
+
+
+def _parse_size(text: str) -> Tuple[int, int]:
+    """(h, w) from a `WxH` string."""
+    w, h = text.lower().split("x")
+    return int(h), int(w)
+
+
+def _graph_file(shape: Tuple[int, int], int8: bool) -> str:
+    return f"model-{_size_str(shape)}{'.int8' if int8 else ''}.onnx"
+
+
+def onnx_path(ckpt: str) -> str:
+    return os.path.join(model_artifact.artifact_path(ckpt), "onnx")
+
+
+def find_onnx(ckpt: str) -> Optional[str]:
+    """ONNX export directory for `ckpt` (or `ckpt` itself if it is one), else None."""
+    for path in (ckpt, os.path.join(ckpt, "onnx"), onnx_path(ckpt)):
+        if os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+            return path
+    return None
+
+
+def default_shapes(processor, long_side: int, aspects: str = DEFAULT_ASPECTS) -> List[Tuple[int, int]]:
+    """Padded (h, w) the processor produces for photos of these aspect ratios pre-scaled to `long_side`."""
+    from PIL import Image
+
+    shapes = []
+    for aspect in aspects.split(","):
+        aw, ah = (float(x) for x in aspect.split(":"))
+        if aw >= ah:
+            size = (long_side, max(1, round(long_side * ah / aw)))
+        else:
+            size = (max(1, round(long_side * aw / ah)), long_side)
+        pixel_values = processor(images=Image.new("RGB", size), return_tensors="pt")["pixel_values"]
+        shape = tuple(int(x) for x in pixel_values.shape[-2:])
+        if shape not in shapes:
+            shapes.append(shape)
+    return shapes
+
+
+class _Logits(torch.nn.Module):
+    """Tuple-returning wrapper for tracing; the model ignores pixel_mask, so it is not a graph input."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        outputs = self.model(pixel_values=pixel_values)
+        return outputs.class_queries_logits, outputs.masks_queries_logits
+
+
+def export_onnx(ckpt: str, out_dir: str, shapes: List[Tuple[int, int]], int8: bool = False, opset: int = DEFAULT_OPSET) -> str:
+    import engines
+
+    processor, engine = engines.load_torch(ckpt, "cpu")
+    os.makedirs(out_dir, exist_ok=True)
+    processor.save_pretrained(out_dir)
+    engine.model.config.save_pretrained(out_dir)
+    wrapper = _Logits(engine.model).eval()
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # the TorchScript exporter handles the data-dependent shapes by tracing them
+    for shape in shapes:
+        path = os.path.join(out_dir, _graph_file(shape, False))
+        t0 = time.time()
+        with torch.inference_mode():
+            torch.onnx.export(
+                wrapper, (torch.zeros(1, 3, *shape),), path + ".tmp",
+                input_names=["pixel_values"],
+                output_names=["class_queries_logits", "masks_queries_logits"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "class_queries_logits": {0: "batch"}, "masks_queries_logits": {0: "batch"}},
+                opset_version=opset,
+                **kwargs,
+            )
+        os.replace(path + ".tmp", path)
+        if int8:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            qpath = os.path.join(out_dir, _graph_file(shape, True))
+            quantize_dynamic(path, qpath + ".tmp", weight_type=QuantType.QInt8)
+            os.replace(qpath + ".tmp", qpath)
+        print(f"[onnx] exported {_size_str(shape)} in {time.time() - t0:.1f}s")
+    # The manifest goes last: a directory without it is never picked up.
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w") as f:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "checkpoint": ckpt,
+            "shapes": [_size_str(s) for s in shapes],
+            "int8": bool(int8),
+            "opset": opset,
+            "torch": torch.__version__,
+            "created": int(time.time()),
+        }, f, indent=2)
+    return out_dir
+
+
+_OPT_LEVELS = ("disable", "basic", "extended", "all")
+
+
+def _session_options():
+    import onnxruntime as ort
+
+    level = os.environ.get("M2F_ORT_OPT", "all").strip().lower()
+    options = ort.SessionOptions()
+    options.graph_optimization_level = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    }.get(level, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    intra = int(os.environ.get("M2F_INTRA_THREADS", "0") or 0)
+    inter = int(os.environ.get("M2F_INTER_THREADS", "0") or 0)
+    if intra > 0:
+        options.intra_op_num_threads = intra
+    if inter > 0:
+        options.inter_op_num_threads = inter
+    return options, level if level in _OPT_LEVELS else "all"
+
+
+class OrtEngine:
+    name = "onnx"
+
+    def __init__(self, path: str, id2label: dict):
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.id2label = id2label
+        self.shapes = [_parse_size(s) for s in manifest["shapes"]]
+        self.int8 = bool(manifest.get("int8"))
+        self._options, self.optimization = _session_options()
+        self._sessions: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, profile):
+        # Only the int8 option has an ONNX counterpart (the quantized graphs).
+        return inference_profile.Profile(int8=profile.int8 and self.int8)
+
+    def _bucket(self, h: int, w: int) -> Tuple[int, int]:
+        fits = [s for s in self.shapes if s[0] >= h and s[1] >= w]
+        if not fits:
+            raise engines.UnsupportedInputSize("ONNX", (w, h), [(sw, sh) for sh, sw in self.shapes])
+        return min(fits, key=lambda s: s[0] * s[1])
+
+    def _session(self, shape: Tuple[int, int], int8: bool):
+        import onnxruntime as ort
+
+        key = (shape, int8)
+        with self._lock:
+            sess = self._sessions.get(key)
+            if sess is None:
+                t0 = time.time()
+                sess = ort.InferenceSession(
+                    os.path.join(self.path, _graph_file(shape, int8)), self._options, providers=["CPUExecutionProvider"]
+                )
+                self._sessions[key] = sess
+                telemetry.log_event("onnx_session_created", path=self.path, graph=_graph_file(shape, int8),
+                                    load_ms=round((time.time() - t0) * 1000, 1))
+        return sess
+
+    def forward(self, pixel_values, pixel_mask, profile):
+        b, c, h, w = pixel_values.shape
+        bh, bw = self._bucket(h, w)
+        x = pixel_values.detach().cpu().numpy().astype(np.float32, copy=False)
+        if (bh, bw) != (h, w):
+            padded = np.zeros((b, c, bh, bw), dtype=np.float32)
+            padded[:, :, :h, :w] = x
+            x = padded
+        class_logits, mask_logits = self._session((bh, bw), profile.int8).run(None, {"pixel_values": x})
+        # Mask logits are at a fixed fraction of the input size: keep the part covering the unpadded input.
+        mh, mw = mask_logits.shape[-2:]
+        mask_logits = np.ascontiguousarray(mask_logits[..., : mh * h // bh, : mw * w // bw])
+        return torch.from_numpy(class_logits), torch.from_numpy(mask_logits)
+
+    def device_string(self) -> str:
+        return "cpu (onnxruntime)"
+
+    def stats(self) -> dict:
+        return {
+            "engine": self.name,
+            "device": self.device_string(),
+            "shapes": [_size_str(s) for s in self.shapes],
+            "int8": self.int8,
+            "graphOptimization": self.optimization,
+            "sessions": sorted(_graph_file(s, q) for s, q in self._sessions),
+        }
+
+
+def load_onnx(ckpt: str):
+    """(processor, OrtEngine) from the ONNX export of `ckpt`."""
+    from transformers import AutoConfig, AutoImageProcessor
+
+    path = find_onnx(ckpt)
+    if path is None:
+        raise FileNotFoundError(f"No ONNX export for {ckpt} (run: python onnx_engine.py export --ckpt {ckpt})")
+    processor = AutoImageProcessor.from_pretrained(path, local_files_only=True)
+    config = AutoConfig.from_pretrained(path, local_files_only=True)
+    return processor, OrtEngine(path, config.id2label)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export a Mask2Former checkpoint to ONNX for the onnxruntime engine.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    exp = sub.add_parser("export")
+    exp.add_argument("--ckpt", default=os.environ.get("MASK2FORMER_CKPT", "facebook/mask2former-swin-large-ade-semantic"))
+    exp.add_argument("--out", default=None, help="Output directory (default: $M2F_ARTIFACT_DIR/<ckpt>/onnx)")
+    exp.add_argument("--long-side", type=int, default=int(os.environ.get("M2F_LONG_SIDE", "768") or 768))
+    exp.add_argument("--aspects", default=DEFAULT_ASPECTS, help="Photo aspect ratios (W:H) to export input shapes for")
+    exp.add_argument("--shapes", default="", help="Extra padded input shapes as WxH, comma-separated")
+    exp.add_argument("--int8", action="store_true", help="Also write dynamically quantized int8 graphs")
+    exp.add_argument("--opset", type=int, default=DEFAULT_OPSET)
+    args = parser.parse_args()
+
+    from transformers import AutoImageProcessor
+
+    artifact = model_artifact.find_artifact(args.ckpt)
+    processor = AutoImageProcessor.from_pretrained(artifact or args.ckpt)
+    shapes = default_shapes(processor, args.long_side, args.aspects) if args.aspects else []
+    for s in filter(None, (x.strip() for x in args.shapes.split(","))):
+        if _parse_size(s) not in shapes:
+            shapes.append(_parse_size(s))
+    out = args.out or onnx_path(args.ckpt)
+    t0 = time.time()
+    export_onnx(args.ckpt, out, shapes, int8=args.int8, opset=args.opset)
+    print(f"[onnx] exported {args.ckpt} -> {out} ({', '.join(_size_str(s) for s in shapes)}) in {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Near-duplicate uploads via perceptual hashing.
+----------------------------------------------
+The label cache and store are keyed by the exact upload bytes, so the same room
+re-exported (HEIC and JPEG, a smaller copy, a recompressed messenger version)
+misses them. `dhash` reduces the upright photo to a 9x9 grayscale thumbnail (box
+filter) and keeps the signs of its horizontal and vertical gradients: 128 bits
+that survive re-encoding and resizing but change with the content. JPEGs are
+hashed from a separate 1/8-scale draft decode; other formats (PNG, HEIC) have
+no reduced decode, so they are hashed from the request's own upload, whose
+loaded pixels the inference decode then reuses instead of decoding again.
+
+`NearDupIndex` remembers the hash, size and cache key of recent label maps.
+`find` returns the closest entry computed with the same parameters whose hash
+is within `max_distance` bits and whose aspect ratio matches within
+`aspect_tolerance`; the caller reuses that label map, rescaled. Small shifts or
+crops (below ~1/8 of the frame) are not told apart from re-encodes, so reuse is
+opt-in (the service defaults to -1, off) and `max_distance` should stay low.
+Event-loop only, like SingleFlight.
+"""
+
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import ingest
+
+HASH_SIZE = 8
+HASH_BITS = 2 * HASH_SIZE * HASH_SIZE
+
+
+def dhash(upload: ingest.Upload, raw: bytes) -> int:
+    """128-bit difference hash of the upright photo `upload` (opened from `raw`)."""
+    if upload.format == "JPEG" and ingest.JPEG_DRAFT:
+        # A fresh Upload: draft() applies once per image, and the request's own Upload decodes at inference size later.
+        upload = ingest.open_upload(raw)
+        upload.image.draft("RGB", (8 * HASH_SIZE, 8 * HASH_SIZE))
+    # PIL loads the pixels once per image: the inference decode of the same Upload reuses them.
+    image = upload.image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE + 1), Image.BOX)
+    # The thumbnail is square, so orienting it after the reduction gives the same pixels as before.
+    transpose = ingest.orientation_transpose(upload.orientation)
+    if transpose is not None:
+        image = image.transpose(transpose)
+    a = np.asarray(image, dtype=np.int16)
+    bits = np.concatenate([
+        (a[:HASH_SIZE, 1:] > a[:HASH_SIZE, :-1]).ravel(),
+        (a[1:, :HASH_SIZE] > a[:-1, :HASH_SIZE]).ravel(),
+    ])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class Match(NamedTuple):
+    key: Hashable
+    distance: int
+    size: Tuple[int, int]
+
+    @property
+    def confidence(self) -> float:
+        return 1.0 - self.distance / HASH_BITS
+
+
+class NearDupIndex:
+    def __init__(self, max_entries: int, max_distance: int, aspect_tolerance: float):
+        self.max_entries = max(0, int(max_entries))
+        self.max_distance = int(max_distance)
+        self.aspect_tolerance = float(aspect_tolerance)
+        # cache key -> (params, hash, (w, h)), least recently used first
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.lookups = 0
+        self.matches = 0
+
+    def threshold(self, requested: Optional[int] = None) -> int:
+        """Max distance for one lookup: `requested` (the request's own) or the default; -1 = no reuse."""
+        if self.max_entries <= 0:
+            return -1
+        return self.max_distance if requested is None else int(requested)
+
+    def add(self, key: Hashable, params: Hashable, phash: int, size: Tuple[int, int]) -> None:
+        self._entries.pop(key, None)
+        self._entries[key] = (params, phash, tuple(size))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def find(self, params: Hashable, phash: int, size: Tuple[int, int], max_distance: Optional[int] = None) -> Optional[Match]:
+        """Closest entry with the same `params`, within `max_distance` (default: the index's) bits and the aspect tolerance."""
+        max_distance = self.max_distance if max_distance is None else max_distance
+        self.lookups += 1
+        aspect = size[0] / size[1]
+        best = None
+        for key, (p, h, s) in self._entries.items():
+            if p != params or abs(s[0] / s[1] - aspect) > self.aspect_tolerance * aspect:
+                continue
+            distance = (h ^ phash).bit_count()
+            if distance <= max_distance and (best is None or distance < best.distance):
+                best = Match(key, distance, s)
+        if best is not None:
+            self.matches += 1
+            self._entries.move_to_end(best.key)
+        return best
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "maxEntries": self.max_entries,
+            "maxDistance": self.max_distance,
+            "lookups": self.lookups,
+            "matches": self.matches,
+        }
@@ -0,0 +1,82 @@
+"""
+Fused Mask2Former preprocessing.
+--------------------------------
+`AutoImageProcessor` converts the (already resized) PIL image to NumPy, resizes
+it again to its own size rule, rescales in float64, normalizes and stacks. The
+fused path produces the same `pixel_values` / `pixel_mask` from the decoded
+image with a single resize straight to the processor's output size, and one
+uint8 -> float32 conversion written directly into the output tensor followed by
+an in-place multiply-subtract per channel:
+
+  (x * rescale_factor - mean) / std  ==  x * (rescale_factor / std) - mean / std
+
+The output size follows the processor's own rule (shortest/longest edge, then
+rounded up to `size_divisor`) evaluated at the inference size, so tensors have
+exactly the shapes the processor path would produce for that inference size.
+`python check_preprocess.py photo.jpg` checks parity with the processor.
+"""
+
+import math
+from typing import Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class FusedPreprocessor:
+    def __init__(self, processor):
+        self.processor = processor
+        self.do_resize = bool(getattr(processor, "do_resize", True))
+        self.size = dict(getattr(processor, "size", None) or {})
+        self.size_divisor = int(getattr(processor, "size_divisor", 0) or 0)
+        self.resample = Image.Resampling(int(getattr(processor, "resample", Image.BILINEAR)))
+        scale = float(processor.rescale_factor) if getattr(processor, "do_rescale", True) else 1.0
+        if getattr(processor, "do_normalize", True):
+            mean, std = list(processor.image_mean), list(processor.image_std)
+        else:
+            mean, std = [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]
+        self._mul = torch.tensor([scale / s for s in std], dtype=torch.float32).view(1, 3, 1, 1)
+        self._sub = torch.tensor([m / s for m, s in zip(mean, std)], dtype=torch.float32).view(1, 3, 1, 1)
+
+    def output_size(self, width: int, height: int) -> Tuple[int, int]:
+        """(w, h) of `pixel_values` for an image of `width` x `height` (the processor's resize rule)."""
+        if not self.do_resize:
+            return width, height
+        if "height" in self.size and "width" in self.size:
+            out_h, out_w = int(self.size["height"]), int(self.size["width"])
+        else:
+            shortest = int(self.size["shortest_edge"])
+            longest = self.size.get("longest_edge")
+            short, long = (width, height) if width <= height else (height, width)
+            new_short, new_long = shortest, int(shortest * long / short)
+            if longest is not None and new_long > longest:
+                new_short, new_long = int(longest * new_short / new_long), int(longest)
+            out_w, out_h = (new_short, new_long) if width <= height else (new_long, new_short)
+        if self.size_divisor > 0:
+            out_h = int(math.ceil(out_h / self.size_divisor) * self.size_divisor)
+            out_w = int(math.ceil(out_w / self.size_divisor) * self.size_divisor)
+        return out_w, out_h
+
+    def resize(self, image: Image.Image, infer_size: Tuple[int, int]) -> Image.Image:
+        """The one resize: `image` (any size, RGB) to the processor output size for `infer_size`."""
+        out_size = self.output_size(int(infer_size[0]), int(infer_size[1]))
+        return image if image.size == out_size else image.resize(out_size, self.resample)
+
+    def normalize(self, image: Image.Image) -> Tuple[torch.Tensor, torch.Tensor]:
+        """(pixel_values float32 [1, 3, H, W], pixel_mask int64 [1, H, W]) from an RGB image already at output size."""
+        pixel_values = self.normalize_array(np.asarray(image))
+        # A single image is never padded.
+        pixel_mask = torch.ones((1,) + tuple(pixel_values.shape[-2:]), dtype=torch.int64)
+        return pixel_values, pixel_mask
+
+    def normalize_array(self, rgb: np.ndarray) -> torch.Tensor:
+        """pixel_values float32 [1, 3, H, W] from a uint8 HWC RGB array (no resize)."""
+        h, w = rgb.shape[:2]
+        pixel_values = torch.empty((1, 3, h, w), dtype=torch.float32)
+        # uint8 HWC -> float32 CHW in one pass, straight into the tensor's buffer.
+        np.copyto(pixel_values.numpy()[0], rgb.transpose(2, 0, 1), casting="unsafe")
+        return pixel_values.mul_(self._mul).sub_(self._sub)
+
+    def __call__(self, image: Image.Image, infer_size: Tuple[int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.normalize(self.resize(image, infer_size))
@@ -0,0 +1,120 @@
+"""
+Latency-budget quality controller.
+-----------------------------------
+A quality ladder lists (checkpoint, long side) settings from best to fastest:
+
+  M2F_QUALITY_LADDER="facebook/mask2former-swin-large-ade-semantic@768,facebook/mask2former-swin-base-ade-semantic@640"
+
+(`@640` alone means MASK2FORMER_CKPT at 640). For a request with a latency
+budget the controller picks the first rung whose predicted latency fits:
+
+  predicted = expected queue wait + EWMA service time of the rung
+
+Service times are measured online per (checkpoint, long side, variant), where
+the variant is everything else that changes the cost (engine, profile, output
+resolution). A rung that was never measured is estimated from the same
+checkpoint at another long side or variant (cost ~ pixel count); a checkpoint with no
+measurement at all is tried once so the next choice is calibrated. When no rung
+fits, the one with the lowest prediction wins.
+"""
+
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+DEFAULT_ALPHA = 0.3
+# Fallback rungs below the default long side when no ladder is configured.
+_DEFAULT_STEPS = (640, 512, 384)
+
+
+class Rung(NamedTuple):
+    ckpt: str
+    long_side: int
+
+    @property
+    def label(self) -> str:
+        return f"{self.ckpt}@{self.long_side}"
+
+
+def parse_ladder(spec: Optional[str], default_ckpt: str, default_long_side: int) -> List[Rung]:
+    """Rungs from `ckpt@long_side` entries; without a spec, the default checkpoint at decreasing long sides."""
+    rungs: List[Rung] = []
+    if spec and spec.strip():
+        for entry in spec.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            ckpt, _, long_side = entry.rpartition("@")
+            rung = Rung(ckpt.strip() or default_ckpt, int(long_side))
+            if rung not in rungs:
+                rungs.append(rung)
+    else:
+        rungs.append(Rung(default_ckpt, default_long_side))
+        rungs.extend(Rung(default_ckpt, ls) for ls in _DEFAULT_STEPS if 0 < ls < default_long_side)
+    return rungs
+
+
+class LatencyTracker:
+    """EWMA service time (ms) per (checkpoint, long side, variant)."""
+
+    def __init__(self, alpha: float = DEFAULT_ALPHA):
+        self.alpha = alpha
+        self._ewma: Dict[tuple, float] = {}
+        self._count: Dict[tuple, int] = {}
+        # EWMA over every job, used to estimate how long queued work ahead of a request takes.
+        self.typical_ms: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def observe(self, ckpt: str, long_side: int, variant: tuple, ms: float) -> None:
+        key = (ckpt, long_side, variant)
+        with self._lock:
+            prev = self._ewma.get(key)
+            self._ewma[key] = ms if prev is None else prev + self.alpha * (ms - prev)
+            self._count[key] = self._count.get(key, 0) + 1
+            self.typical_ms = ms if self.typical_ms is None else self.typical_ms + self.alpha * (ms - self.typical_ms)
+
+    def estimate(self, ckpt: str, long_side: int, variant: tuple) -> Optional[float]:
+        with self._lock:
+            exact = self._ewma.get((ckpt, long_side, variant))
+            if exact is not None:
+                return exact
+            # Same checkpoint at another long side (preferably the same variant): scale by pixel count.
+            known = [(ls, ms) for (c, ls, v), ms in self._ewma.items() if c == ckpt and v == variant and ls > 0]
+            if not known:
+                known = [(ls, ms) for (c, ls, v), ms in self._ewma.items() if c == ckpt and ls > 0]
+        if not known or long_side <= 0:
+            return None
+        ls, ms = min(known, key=lambda item: abs(item[0] - long_side))
+        return ms * (long_side / ls) ** 2
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "typicalMs": None if self.typical_ms is None else round(self.typical_ms, 1),
+                "settings": [
+                    {"checkpoint": c, "longSide": ls, "variant": "/".join(str(x) for x in v), "ewmaMs": round(ms, 1), "samples": self._count[(c, ls, v)]}
+                    for (c, ls, v), ms in self._ewma.items()
+                ],
+            }
+
+
+class QualityController:
+    def __init__(self, ladder: List[Rung], tracker: LatencyTracker):
+        self.ladder = ladder
+        self.tracker = tracker
+
+    def choose(self, budget_ms: float, variant: tuple, queue_wait_ms: float,
+               available: Callable[[Rung], bool] = lambda rung: True) -> Tuple[Rung, Optional[float]]:
+        """(rung, predicted ms or None if unmeasured) for a request with `budget_ms`."""
+        fallback: Optional[Tuple[Rung, float]] = None
+        candidates = [r for r in self.ladder if available(r)] or self.ladder[:1]
+        for rung in candidates:
+            service = self.tracker.estimate(rung.ckpt, rung.long_side, variant)
+            if service is None:
+                return rung, None
+            predicted = queue_wait_ms + service
+            if predicted <= budget_ms:
+                return rung, predicted
+            if fallback is None or predicted < fallback[1]:
+                fallback = (rung, predicted)
+        assert fallback is not None
+        return fallback
@@ -0,0 +1,165 @@
+"""
+Pre-fork server (run: python serve.py --workers 4 [--host 0.0.0.0] [--port 8000]).
+
+`uvicorn --workers N` starts N interpreters that each load the checkpoint, so
+a host holds N private copies of the weights. This script loads every model
+once in the master (MASK2FORMER_CKPT on M2F_ENGINE, the quality-ladder
+checkpoints, and the M2F_PROFILE variant), then forks the workers. The workers
+share the weight pages copy-on-write and accept on one listening socket.
+
+Keeping the pages shared:
+  - the master never runs a forward pass (warmup happens per worker with
+    M2F_PRELOAD=1) and loads with one intra-op thread, so no OpenMP pool
+    exists at fork time; workers restore the configured thread count;
+  - gc.freeze() moves every object that exists at fork time out of the
+    collector's reach, so collections do not dirty the object headers;
+  - parameters are never written after load (inference runs under
+    inference_mode; other profiles build their own copies).
+
+CPU only: a CUDA/MPS context cannot be inherited across fork(), so the script
+refuses to start there (run one uvicorn process per GPU instead). ONNX Runtime
+sessions are created lazily in each worker and are not shared.
+Dead workers are re-forked from the master and still share its pages; workers
+exit when the master dies.
+SIGTERM/SIGINT shut the workers down gracefully.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+# A worker that exits sooner than this after starting is considered crash-looping; re-forks are delayed.
+_MIN_UPTIME_S = 5.0
+
+
+def _listen(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _load_models(service) -> None:
+    """Everything the workers should share, loaded in the master without running the model."""
+    service.load_mask2former_ade20k()
+    for ckpt in dict.fromkeys(r.ckpt for r in service.quality_controller.ladder):
+        if (service.DEFAULT_ENGINE, ckpt) not in service.loaded_models:
+            service.load_mask2former_ade20k(service.DEFAULT_ENGINE, ckpt)
+    for (engine_name, _), loaded in service.loaded_models.items():
+        profile = loaded.engine.resolve(service.DEFAULT_PROFILE)
+        if engine_name == "torch" and profile != service.inference_profile.BASELINE:
+            # The profile's own weight copy (e.g. int8) is shared too; compiling still happens per worker.
+            loaded.engine.variants.variant(loaded.engine.model, profile, service.DEVICE)
+
+
+def _exit_with_master(master_pid: int) -> None:
+    """Linux: have the kernel send SIGTERM to this worker if the master dies (even by SIGKILL)."""
+    try:
+        import ctypes
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except Exception:
+        return
+    if os.getppid() != master_pid:  # the master died before prctl took effect
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def _run_worker(sock: socket.socket, args, service, intra_threads: int, master_pid: int) -> None:
+    import torch
+    import uvicorn
+
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    _exit_with_master(master_pid)
+    torch.set_num_threads(intra_threads)
+    config = uvicorn.Config(service.app, host=args.host, port=args.port, log_level=args.log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("M2F_WORKERS", "2")))
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    import torch
+
+    import main as service
+
+    if service.DEVICE != "cpu":
+        print(f"[serve] pre-fork mode is CPU only (device is {service.DEVICE}); run uvicorn main:app per GPU instead", file=sys.stderr)
+        return 2
+
+    intra_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    t0 = time.time()
+    _load_models(service)
+    gc.collect()
+    gc.freeze()
+    sock = _listen(args.host, args.port)
+    service.telemetry.log_event("prefork_ready", load_ms=round((time.time() - t0) * 1000, 1), workers=args.workers,
+                                host=args.host, port=args.port)
+
+    master_pid = os.getpid()
+    workers = {}  # pid -> start time
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(sock, args, service, intra_threads, master_pid)
+            except BaseException:
+                code = 1
+                import traceback
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        workers[pid] = time.time()
+
+    def stop(signum, _frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(max(1, args.workers)):
+        spawn()
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        service.telemetry.log_event("worker_exited", level=logging.WARNING, pid=pid, status=os.waitstatus_to_exitcode(status))
+        if time.time() - started < _MIN_UPTIME_S:
+            time.sleep(_MIN_UPTIME_S)
+        if not stopping:
+            spawn()
+    sock.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
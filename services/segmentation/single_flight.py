@@ -0,0 +1,49 @@
+"""
+Single-flight deduplication of in-progress work.
+------------------------------------------------
+Concurrent callers asking for the same key share one computation: the first
+caller starts it as a task, later callers await the same task until it
+finishes. The key is dropped as soon as the task completes, so this only
+covers the window before a result exists; anything longer-lived belongs in a
+cache.
+
+The shared task is shielded: a caller that goes away (client disconnect) does
+not cancel the work for the others. Event-loop only, like AdmissionGate.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, "asyncio.Future"] = {}
+        self.started = 0
+        self.shared = 0
+
+    @property
+    def inflight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """(result of `fn()`, whether it was shared with an earlier caller)."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self.started += 1
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task), shared
+
+    def _done(self, key: Hashable, task: "asyncio.Future") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception retrieved even if every caller went away.
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"inflight": self.inflight, "started": self.started, "shared": self.shared}
@@ -0,0 +1,306 @@
+"""
+Request telemetry: per-stage timings, Prometheus metrics, sampled structured logs.
+----------------------------------------------------------------------------------
+`TelemetryMiddleware` starts a `StageTimer` for every HTTP request and puts it
+in a context variable; code on the request path wraps its work in
+`stage("name")`. Work offloaded to executors sees the same timer as long as it
+is submitted with the caller's context (`bind`, AdmissionGate does this too).
+When the response starts, the middleware adds a `Server-Timing` header; when it
+ends, every stage is observed into `m2f_stage_seconds{endpoint,stage}`.
+
+Metrics are hand-rolled (no client library) and rendered in the Prometheus
+text format by `REGISTRY.render()`; values owned by other modules (queue depth,
+cache counters, RSS, ...) are registered as callbacks read at scrape time.
+
+Logs are JSON lines written by a background thread (stdout never blocks a
+request). Per-request events are sampled with M2F_LOG_SAMPLE (default 0.1);
+errors and lifecycle events are always written.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOG_SAMPLE = float(os.environ.get("M2F_LOG_SAMPLE", "0.1"))
+
+
+def _label_str(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{n}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, v in self._values.items():
+                lines.append(f"{self.name}{_label_str(self.labelnames, labels)} {_fmt(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = STAGE_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for labels, series in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_label_str(names, labels + (_fmt(bound),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_str(self.labelnames, labels)} {_fmt(series[-1])}")
+                lines.append(f"{self.name}_count{_label_str(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Callback:
+    """Gauge or counter whose value is read at scrape time. `fn` returns a number or {label tuple: number}."""
+
+    def __init__(self, name: str, help_text: str, kind: str, fn: Callable, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.kind, self.fn, self.labelnames = name, help_text, kind, fn, tuple(labelnames)
+
+    def render(self) -> list:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for labels, v in items:
+            if v is not None:
+                lines.append(f"{self.name}{_label_str(self.labelnames, labels)} {_fmt(v)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        m = Counter(name, help_text, labelnames)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = STAGE_BUCKETS) -> Histogram:
+        m = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(m)
+        return m
+
+    def gauge_fn(self, name: str, help_text: str, fn: Callable, labelnames: Sequence[str] = ()) -> None:
+        self._metrics.append(Callback(name, help_text, "gauge", fn, labelnames))
+
+    def counter_fn(self, name: str, help_text: str, fn: Callable, labelnames: Sequence[str] = ()) -> None:
+        self._metrics.append(Callback(name, help_text, "counter", fn, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+stage_seconds = REGISTRY.histogram("m2f_stage_seconds", "Time spent per request stage", ("endpoint", "stage"))
+request_seconds = REGISTRY.histogram("m2f_request_seconds", "End-to-end request time", ("endpoint", "status"))
+requests_total = REGISTRY.counter("m2f_requests_total", "Requests served", ("endpoint", "status"))
+_in_flight = [0]
+REGISTRY.gauge_fn("m2f_requests_in_flight", "HTTP requests currently being served", lambda: _in_flight[0])
+
+
+def process_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        try:
+            import resource
+            # Peak, not current, RSS where /proc is unavailable (kB on Linux, bytes on macOS).
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+        except Exception:
+            return None
+
+
+REGISTRY.gauge_fn("process_resident_memory_bytes", "Resident set size of the service process", process_rss_bytes)
+
+
+class StageTimer:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def ms(self) -> Dict[str, float]:
+        return {k: round(v * 1000, 1) for k, v in self.stages.items()}
+
+    def server_timing(self) -> str:
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.t0) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: "contextvars.ContextVar[Optional[StageTimer]]" = contextvars.ContextVar("m2f_stage_timer", default=None)
+
+
+def current() -> Optional[StageTimer]:
+    return _current.get()
+
+
+def use(timer: StageTimer) -> None:
+    """Record stages of the current context into `timer` (background tasks that outlive their request)."""
+    _current.set(timer)
+
+
+@contextmanager
+def stage(name: str):
+    """Time the enclosed block as stage `name` of the current request (no-op outside a request)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = _current.get()
+        if timer is not None:
+            timer.add(name, time.perf_counter() - t0)
+
+
+def record(name: str, seconds: float) -> None:
+    timer = _current.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+def bind(fn: Callable, *args) -> Callable:
+    """`fn(*args)` as a no-arg callable that runs in the caller's context (for executors)."""
+    ctx = contextvars.copy_context()
+    return lambda: ctx.run(fn, *args)
+
+
+class TelemetryMiddleware:
+    """ASGI middleware: stage timer per request, Server-Timing header, request metrics."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timer = StageTimer()
+        token = _current.set(timer)
+        status = [500]
+        _in_flight[0] += 1
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timer.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _in_flight[0] -= 1
+            _current.reset(token)
+            endpoint = getattr(scope.get("endpoint"), "__name__", "other")
+            elapsed = time.perf_counter() - timer.t0
+            labels = (endpoint, str(status[0]))
+            request_seconds.observe(labels, elapsed)
+            requests_total.inc(labels)
+            for name, seconds in timer.stages.items():
+                stage_seconds.observe((endpoint, name), seconds)
+            if status[0] >= 500:
+                log_event("request_failed", endpoint=endpoint, status=status[0], elapsed_ms=round(elapsed * 1000, 1), stages=timer.ms())
+
+
+# --- structured logging -----------------------------------------------------------------------------
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {"ts": round(record.created, 3), "level": record.levelname.lower(), "event": record.getMessage()}
+        payload.update(getattr(record, "fields", {}))
+        return json.dumps(payload, default=str)
+
+
+logger = logging.getLogger("m2f")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(_JsonFormatter())
+_listener = logging.handlers.QueueListener(_log_queue, _stdout_handler)
+_listener.start()
+atexit.register(_listener.stop)
+if hasattr(os, "register_at_fork"):
+    # Threads do not survive fork(): pre-forked workers (serve.py) start their own writer; stopping first flushes.
+    os.register_at_fork(before=_listener.stop, after_in_parent=_listener.start, after_in_child=_listener.start)
+
+
+def log_event(event: str, level: int = logging.INFO, **fields) -> None:
+    """Always-written structured log line."""
+    logger.log(level, event, extra={"fields": fields})
+
+
+def log_request(event: str, **fields) -> None:
+    """Per-request structured log line, written for a M2F_LOG_SAMPLE fraction of requests."""
+    if LOG_SAMPLE >= 1 or random.random() < LOG_SAMPLE:
+        timer = _current.get()
+        if timer is not None and "stages" not in fields:
+            fields["stages"] = timer.ms()
+        log_event(event, **fields)
@@ -0,0 +1,143 @@
+"""
+Tiled full-resolution segmentation.
+-----------------------------------
+Instead of shrinking the photo to the inference long side, the photo is cut
+into overlapping square tiles at the model's native input size (the
+processor's shortest edge, 640 px for the ADE20K checkpoints). Tiles are run in
+batches, and their class scores (softmax(class) x sigmoid(mask), the map the
+processor argmaxes) are blended at mask resolution (1/4 of the input) with
+linear ramps across each overlap. The blended scores are then bilinearly
+upsampled to full resolution and argmaxed.
+
+Memory is bounded by the photo width, not its area: tiles are processed one
+row at a time, and only the mask-resolution rows that later tiles can still
+touch are kept. Finished rows are turned into labels OUTPUT_ROWS mask rows at a
+time; each chunk is interpolated with one neighbouring row on either side, which
+makes it identical to interpolating the whole map at once. Besides the decoded
+photo and the uint8 label map, peak memory is about classes x (tile / 4) x
+(width / 4) floats for the band, plus one chunk of classes x 4 * OUTPUT_ROWS x
+width floats, plus one batch of tiles in the model.
+
+Tile edges that pass the photo border (photos narrower or shorter than a tile,
+and the last row/column) are filled by edge replication and cropped afterwards.
+"""
+
+import math
+from typing import Callable, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import telemetry
+
+# Mask2Former predicts mask logits at 1/4 of its input resolution.
+MASK_STRIDE = 4
+# Mask rows upsampled (to MASK_STRIDE x as many full-resolution rows) and argmaxed at a time.
+OUTPUT_ROWS = 4
+
+
+def offsets(length: int, tile: int, stride: int) -> List[int]:
+    """Tile starts along one axis: every `stride`, the last one reaching `length` (all multiples of MASK_STRIDE)."""
+    if length <= tile:
+        return [0]
+    last = math.ceil((length - tile) / MASK_STRIDE) * MASK_STRIDE
+    n = math.ceil(last / stride) + 1
+    return [min(i * stride, last) for i in range(n)]
+
+
+def grid(width: int, height: int, tile: int, overlap: int) -> Tuple[int, int]:
+    """(columns, rows) of tiles for a `width` x `height` photo."""
+    stride = tile - overlap
+    return len(offsets(width, tile, stride)), len(offsets(height, tile, stride))
+
+
+def _ramp(n: int, ramp: int, rise: bool, fall: bool) -> torch.Tensor:
+    """1-D blend weights: linear ramps over `ramp` cells on the sides shared with a neighbouring tile."""
+    w = torch.ones(n)
+    if ramp > 0:
+        r = torch.arange(1, ramp + 1, dtype=torch.float32) / (ramp + 1)
+        if rise:
+            w[:ramp] = r
+        if fall:
+            w[-ramp:] = torch.minimum(w[-ramp:], r.flip(0))
+    return w
+
+
+def _crop(rgb: np.ndarray, x: int, y: int, tile: int) -> np.ndarray:
+    patch = rgb[y:y + tile, x:x + tile]
+    h, w = patch.shape[:2]
+    if (h, w) != (tile, tile):
+        patch = np.pad(patch, ((0, tile - h), (0, tile - w), (0, 0)), mode="edge")
+    return patch
+
+
+def tiled_label_map(rgb: np.ndarray, tile: int, overlap: int, batch: int,
+                    normalize: Callable[[np.ndarray], torch.Tensor],
+                    forward: Callable[[torch.Tensor], tuple],
+                    dtype=np.uint8) -> np.ndarray:
+    """Label map (H, W) of an (H, W, 3) uint8 photo. `forward(pixel_values)` returns (class, mask) query logits."""
+    height, width = rgb.shape[:2]
+    stride = tile - overlap
+    xs, ys = offsets(width, tile, stride), offsets(height, tile, stride)
+    tq, ramp = tile // MASK_STRIDE, overlap // MASK_STRIDE
+    wq, hq = (xs[-1] + tile) // MASK_STRIDE, (ys[-1] + tile) // MASK_STRIDE
+    wx = [_ramp(tq, ramp, i > 0, i < len(xs) - 1) for i in range(len(xs))]
+
+    out = np.empty((height, width), dtype=dtype)
+    acc = wsum = None  # weighted scores / weights of mask rows [acc_top, acc_top + tq)
+    acc_top = 0
+    done = None  # blended scores of finished mask rows [done_top, acc_top)
+    done_top = 0
+    next_q = 0  # next mask row to turn into labels
+
+    for r, y in enumerate(ys):
+        wy = _ramp(tq, ramp, r > 0, r < len(ys) - 1)
+        for start in range(0, len(xs), batch):
+            cols = list(range(start, min(start + batch, len(xs))))
+            pixel_values = torch.cat([normalize(_crop(rgb, xs[i], y, tile)) for i in cols])
+            with telemetry.stage("forward"):
+                class_logits, mask_logits = forward(pixel_values)
+            with telemetry.stage("postprocess"):
+                if mask_logits.shape[-2:] != (tq, tq):
+                    raise ValueError(f"Unexpected mask logits {tuple(mask_logits.shape[-2:])} for {tile}px tiles")
+                scores = torch.einsum("bqc,bqhw->bchw", class_logits.softmax(-1)[..., :-1], mask_logits.sigmoid())
+                if acc is None:
+                    acc = torch.zeros((scores.shape[1], tq, wq))
+                    wsum = torch.zeros((tq, wq))
+                elif acc.shape[1] < tq:
+                    # Rows below the overlap with the previous tile row enter the band.
+                    acc = torch.cat([acc, acc.new_zeros((acc.shape[0], tq - acc.shape[1], wq))], 1)
+                    wsum = torch.cat([wsum, wsum.new_zeros((tq - wsum.shape[0], wq))], 0)
+                top = y // MASK_STRIDE - acc_top
+                for b, i in enumerate(cols):
+                    left = xs[i] // MASK_STRIDE
+                    weight = wy[:, None] * wx[i][None, :]
+                    acc[:, top:top + tq, left:left + tq] += scores[b] * weight
+                    wsum[top:top + tq, left:left + tq] += weight
+
+        with telemetry.stage("postprocess"):
+            # Mask rows above the next tile row receive no more contributions.
+            finished = ys[r + 1] // MASK_STRIDE if r + 1 < len(ys) else hq
+            n = finished - acc_top
+            blended = acc[:, :n] / wsum[:n]
+            done = blended if done is None else torch.cat([done, blended], 1)
+            acc, wsum, acc_top = acc[:, n:], wsum[n:], finished
+
+        with telemetry.stage("upsample"):
+            while next_q * MASK_STRIDE < height:
+                stop_q = min(next_q + OUTPUT_ROWS, hq)
+                lo, hi = max(next_q - 1, 0), min(stop_q + 1, hq)
+                if hi > finished:
+                    break  # needs mask rows of the next tile row
+                # Channels-last makes the per-pixel class vectors contiguous for both the interpolation and the argmax.
+                band = done[None, :, lo - done_top:hi - done_top].contiguous(memory_format=torch.channels_last)
+                band = F.interpolate(band, size=((hi - lo) * MASK_STRIDE, wq * MASK_STRIDE), mode="bilinear", align_corners=False)
+                top = (next_q - lo) * MASK_STRIDE
+                rows = min(stop_q * MASK_STRIDE, height) - next_q * MASK_STRIDE
+                labels = band[0, :, top:top + rows, :width].argmax(0)
+                out[next_q * MASK_STRIDE:next_q * MASK_STRIDE + rows] = labels.numpy().astype(dtype, copy=False)
+                next_q = stop_q
+            keep = max(next_q - 1, 0)
+            done, done_top = done[:, keep - done_top:], keep
+    return out